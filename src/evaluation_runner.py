@@ -1,26 +1,36 @@
+import copy
 import os
+import time
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from tqdm import tqdm
 
 from src.models.load_model import load_model
-from src.utils.common_utils import strip_trailing_slash
-from src.utils.file_io import save_json_data
-from src.utils.lfss_io import InfoReader, LabelReader, SkipReader
+from src.utils import translation_store
+from src.utils.common_utils import set_output_files, strip_trailing_slash
+from src.utils.file_io import (
+    load_captioning_data,
+    load_classification_data,
+    load_distribution_data,
+    load_vqa_data,
+    save_csv_data,
+    save_json_data,
+)
+from src.utils.leaderboard import build_leaderboard, find_prediction_models, leaderboard_row
+from src.utils.lfss_io import LFSS_POOL, SampleMeta
+from src.utils.lfss_mirror import meta_batch_reader
 
 LOW_CONFIDENCE_COUNT = 0
 HIGH_CONFIDENCE_COUNT = 0
 
-def task(idx: str, lbl_meta_dir: str, distribution_dict: dict):
+def task(idx: str, meta: SampleMeta, distribution_dict: dict):
     global LOW_CONFIDENCE_COUNT, HIGH_CONFIDENCE_COUNT
     
-    r = SkipReader(lbl_meta_dir=lbl_meta_dir)
-    skip = r.get(idx)
-    if skip is not None:
+    if meta.skip is not None:
         return None
 
-    r = LabelReader(lbl_meta_dir=lbl_meta_dir)
-    label = r.get(idx)
+    label = meta.label
     if label is None:
         return None
     
@@ -33,8 +43,7 @@ def task(idx: str, lbl_meta_dir: str, distribution_dict: dict):
         else:
             HIGH_CONFIDENCE_COUNT += 1
     
-    r = InfoReader(lbl_meta_dir=lbl_meta_dir)
-    info = r.get(idx)
+    info = meta.info
     if info is None:
         raise FileExistsError(f"{idx} not found")
     info = info.compact_json()
@@ -52,13 +61,17 @@ def run(args, yaml_cfg, model_cfg):
     else:
         lbl_meta_dir=strip_trailing_slash(yaml_cfg["lfss"]["meta_en_dir"])
     
-    for idx in tqdm(all_indices, desc="Generating distribution.json", dynamic_ncols=True):
-        task(idx, lbl_meta_dir, distribution_dict)
+    # skip/label/info of a whole chunk of indices per request, several chunks in flight
+    metas = meta_batch_reader(lbl_meta_dir).iter(all_indices, workers=args.workers)
+    for idx, meta in tqdm(metas, total=len(all_indices), desc="Generating distribution.json", dynamic_ncols=True):
+        task(idx, meta, distribution_dict)
     
     tqdm.write(f"low_confidence_cnt: {LOW_CONFIDENCE_COUNT}, high_confidence_cnt: {HIGH_CONFIDENCE_COUNT}")
     save_json_data(distribution_dict, os.path.join(args.project_root, args.save_root_dir), "distribution.json")
     
-    if args.subtask == "vqa":
+    if args.sweep:
+        run_sweep(args, yaml_cfg, model_cfg)
+    elif args.subtask == "vqa":
         from src.tasks.vqa.evaluator import run_vqa_evaluation
         run_vqa_evaluation(args)
     elif args.subtask == "classification":
@@ -68,3 +81,91 @@ def run(args, yaml_cfg, model_cfg):
         from src.tasks.captioning.evaluator import run_captioning_evaluation
         model = load_model(args, model_cfg)
         run_captioning_evaluation(model, yaml_cfg, args)
+        if model.response_cache is not None:
+            tqdm.write(model.response_cache.summary())
+        if translation_store.TRANSLATION_STORE is not None:
+            tqdm.write(translation_store.TRANSLATION_STORE.summary())
+        if model.rate_limiter is not None:
+            tqdm.write(model.rate_limiter.summary())
+        if model.usage is not None:
+            tqdm.write(model.usage.summary(f"{args.task} - {args.subtask} - {args.model_name} (judge: {args.evaluator_model_name})"))
+    tqdm.write(LFSS_POOL.summary())
+
+
+# label json and distribution of the sweep, set once per worker process
+SWEEP_INPUTS = {}
+
+def _init_sweep_worker(label_json: dict, distribution: dict):
+    SWEEP_INPUTS["label_json"] = label_json
+    SWEEP_INPUTS["distribution"] = distribution
+
+def _evaluate_model(args) -> dict:
+    """Evaluate one model of a vqa/classification sweep in a worker process."""
+    if args.subtask == "vqa":
+        from src.tasks.vqa.evaluator import run_vqa_evaluation
+        return run_vqa_evaluation(args, SWEEP_INPUTS["label_json"], SWEEP_INPUTS["distribution"])
+    from src.tasks.classification.evaluator import run_classification_evaluation
+    return run_classification_evaluation(args, SWEEP_INPUTS["label_json"], SWEEP_INPUTS["distribution"])
+
+def _model_args(args, model_name: str):
+    model_args = copy.copy(args)
+    model_args.model_name = model_name
+    return model_args
+
+def run_sweep(args, yaml_cfg, model_cfg):
+    """
+    Evaluate every model with predictions under data/prediction/<subtask>/.
+
+    The benchmark labels and distribution.json are loaded once. VQA and classification metrics
+    are CPU-bound, so models are evaluated in parallel processes (--sweep_workers). Captioning
+    models are evaluated one after another in this process, sharing the resident BERTScore model
+    (and its reference embeddings) and the evaluator client. Every model gets its usual metric/
+    outputs; metric/<subtask>/leaderboard.csv ranks them.
+    """
+    prediction_dir = os.path.join(args.project_root, args.save_root_dir, "prediction", args.subtask)
+    model_names = find_prediction_models(prediction_dir)
+    if not model_names:
+        raise FileNotFoundError(f"No model with results.json under '{prediction_dir}', please run predictor first.")
+    tqdm.write(f"[Sweep] {len(model_names)} models under '{prediction_dir}': {', '.join(model_names)}")
+    
+    start = time.time()
+    distribution = load_distribution_data()
+    label_json = {"vqa": load_vqa_data, "classification": load_classification_data, "captioning": load_captioning_data}[args.subtask]()
+    summaries, failed = {}, {}
+    if args.subtask == "captioning":
+        from src.tasks.captioning.evaluator import run_captioning_evaluation
+        model = load_model(args, model_cfg)
+        for model_name in model_names:
+            model_args = _model_args(args, model_name)
+            set_output_files(model_args)
+            try:
+                summaries[model_name] = run_captioning_evaluation(model, yaml_cfg, model_args, label_json, distribution)
+            except Exception as e:
+                failed[model_name] = e
+                tqdm.write(f"[Sweep] {model_name} failed: {type(e).__name__}: {e}")
+        if model.response_cache is not None:
+            tqdm.write(model.response_cache.summary())
+        if translation_store.TRANSLATION_STORE is not None:
+            tqdm.write(translation_store.TRANSLATION_STORE.summary())
+        if model.rate_limiter is not None:
+            tqdm.write(model.rate_limiter.summary())
+        if model.usage is not None:
+            tqdm.write(model.usage.summary(f"{args.task} - {args.subtask} - sweep (judge: {args.evaluator_model_name})"))
+    else:
+        workers = max(1, min(args.sweep_workers or os.cpu_count() or 1, len(model_names)))
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_sweep_worker, initargs=(label_json, distribution)) as executor:
+            futures = {executor.submit(_evaluate_model, _model_args(args, model_name)): model_name for model_name in model_names}
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Sweep", unit="model", dynamic_ncols=True):
+                model_name = futures[future]
+                try:
+                    summaries[model_name] = future.result()
+                except Exception as e:
+                    failed[model_name] = e
+                    tqdm.write(f"[Sweep] {model_name} failed: {type(e).__name__}: {e}")
+    
+    rows = [leaderboard_row(model_name, summaries[model_name]) for model_name in model_names if model_name in summaries]
+    save_csv_data(build_leaderboard(rows), os.path.join(args.project_root, "metric", args.subtask), "leaderboard.csv", title=f"{args.task} - {args.subtask} - sweep")
+    tqdm.write(
+        f"[Sweep] {args.subtask}: {len(summaries)}/{len(model_names)} models evaluated in {time.time() - start:.1f}s"
+        + (f", failed: {', '.join(failed)}" if failed else "")
+    )
@@ -5,7 +5,9 @@ from collections import defaultdict
 from tqdm import tqdm
 
 from src.models.load_model import load_model
+from src.utils import translation_store
 from src.utils.file_io import change_path_suffix, load_data, save_json_data
+from src.utils.lfss_io import LFSS_POOL
 
 
 def run(args, yaml_cfg, model_cfg):
@@ -62,3 +64,13 @@ def run(args, yaml_cfg, model_cfg):
         from src.tasks.captioning.generator import run_captioning_generation
         run_captioning_generation(model, yaml_cfg, args)
         shutil.copy(change_path_suffix(args.outfile, ".json"), os.path.join(args.project_root, args.save_root_dir, "captioning.json"))
+    
+    if model.response_cache is not None:
+        tqdm.write(model.response_cache.summary())
+    if translation_store.TRANSLATION_STORE is not None:
+        tqdm.write(translation_store.TRANSLATION_STORE.summary())
+    if model.rate_limiter is not None:
+        tqdm.write(model.rate_limiter.summary())
+    if model.usage is not None:
+        tqdm.write(model.usage.summary(f"{args.task} - {args.subtask} - {args.model_name}"))
+    tqdm.write(LFSS_POOL.summary())
@@ -1,7 +1,14 @@
 import os
 
-from src import evaluation_runner, generation_runner, prediction_runner
+from src import evaluation_runner, generation_runner, mirror_runner, prediction_runner, translation_runner
+from src.utils.common_utils import set_output_files
 from src.utils.config_loader import load_args, load_model_config, load_yaml_config
+from src.utils.image_cache import IMAGE_CACHE
+from src.utils.lfss_io import LFSS_POOL
+from src.utils.lfss_mirror import open_meta_mirror
+from src.utils.prompt_builder import configure_prompts
+from src.utils.rate_limiter import configure_rate_limits
+from src.utils.translation_store import open_translation_store
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.dirname(current_dir)
@@ -11,6 +18,20 @@ if __name__ == '__main__':
     if args.start > args.end:
         raise ValueError(f"Invalid range: start ({args.start}) must be <= end ({args.end})")
     
+    yaml_cfg = load_yaml_config(args=args)
+    configure_rate_limits(yaml_cfg.get("rate_limits"), args.rate_limit_db)
+    LFSS_POOL.pool_size = args.lfss_pool_size or args.workers
+    if args.task == "mirror":
+        mirror_runner.run(args, yaml_cfg)
+        print("Done!")
+        exit(0)
+    if not args.subtask and args.task != "translate":
+        raise ValueError(f"--subtask is required for task '{args.task}'")
+    if args.sweep and args.task != "evaluation":
+        raise ValueError("--sweep is only supported for the evaluation task")
+    if not args.model_name and not args.sweep:
+        raise ValueError(f"--model_name is required for task '{args.task}' (or --sweep for evaluation)")
+    
     if args.client_type == "api":
         if not args.api_base_url:
             args.api_base_url = os.getenv("API_BASE_URL")
@@ -21,7 +42,10 @@ if __name__ == '__main__':
             if not args.api_key:
                 raise ValueError("--api_key is required for API mode")
     else:
-        args.workers = 1
+        # one producer thread per batch slot; with --local_batch_size 1 this is the old single-threaded behaviour
+        args.workers = args.local_batch_size
+        if args.async_mode:
+            raise ValueError("--async_mode is only supported for --client_type api")
     
     if args.task == "evaluation" and args.subtask == "captioning" and not args.evaluator_model_name:
         raise ValueError("--evaluator_model_name is required for evaluation task and subtask is captioning.")
@@ -29,26 +53,21 @@ if __name__ == '__main__':
     if args.gpus:
         os.environ["CUDA_VISIBLE_DEVICES"] = args.gpus
     
+    IMAGE_CACHE.max_bytes = int(args.image_cache_mb * 1024 * 1024)
+    if args.lfss_mirror:
+        open_meta_mirror(args.lfss_mirror_path)
+    # before the translation store, whose version depends on the prompt layout
+    configure_prompts(args.prefix_cache_prompts)
+    if args.translation_store or args.task == "translate":
+        open_translation_store(args.translation_store_path, args.translation_version)
+    
     args.project_root = project_root
     args.save_root_dir = "data"
     
-    if args.task == "generation" or args.task == "prediction" or (args.task == "evaluation" and args.subtask == "captioning"):
-        args.outfile = os.path.join(args.save_root_dir, args.task, args.subtask, args.model_name, "results.jsonl")
-        os.makedirs(os.path.dirname(args.outfile), exist_ok=True)
-        args.translatefile = os.path.join(args.save_root_dir, args.task, args.subtask, args.model_name, "translate.jsonl")
-        os.makedirs(os.path.dirname(args.translatefile), exist_ok=True)
-        args.failfile = os.path.join(args.save_root_dir, args.task, args.subtask, args.model_name, "failures.jsonl")
-        os.makedirs(os.path.dirname(args.failfile), exist_ok=True)
+    # a sweep sets the output files of every model it evaluates
+    if (args.task == "generation" or args.task == "prediction" or (args.task == "evaluation" and args.subtask == "captioning")) and args.model_name:
+        set_output_files(args)
     
-        if os.path.exists(args.failfile):
-            os.remove(args.failfile)
-            print(f"Deleted '{args.failfile}'.")
-        
-        # captioning
-        args.refinefile = os.path.join(args.save_root_dir, args.task, args.subtask, args.model_name, "refine.jsonl")
-        os.makedirs(os.path.dirname(args.refinefile), exist_ok=True)
-    
-    yaml_cfg = load_yaml_config(args=args)
     model_cfg = load_model_config(args)
     args.served_model_name = model_cfg.get("served_model_name") if (model_cfg and model_cfg.get("served_model_name")) else args.model_name
     
@@ -58,6 +77,8 @@ if __name__ == '__main__':
         prediction_runner.run(args, yaml_cfg, model_cfg)
     elif args.task == "evaluation":
         evaluation_runner.run(args, yaml_cfg, model_cfg)
+    elif args.task == "translate":
+        translation_runner.run(args, yaml_cfg, model_cfg)
     else:
         raise ValueError(f"Unknown task: {args.task}")
     
@@ -0,0 +1,24 @@
+import time
+
+from tqdm import tqdm
+
+from src.utils.common_utils import strip_trailing_slash
+from src.utils.lfss_io import LFSS_POOL
+from src.utils.lfss_mirror import MetaMirror
+
+
+def run(args, yaml_cfg):
+    if args.lfss_meta_type == "cn":
+        lbl_meta_dir=strip_trailing_slash(yaml_cfg["lfss"]["meta_cn_dir"])
+    else:
+        lbl_meta_dir=strip_trailing_slash(yaml_cfg["lfss"]["meta_en_dir"])
+    
+    mirror = MetaMirror(args.lfss_mirror_path)
+    t0 = time.time()
+    stats = mirror.sync(LFSS_POOL.get(), lbl_meta_dir, args.start, args.end, workers=args.workers)
+    tqdm.write(
+        f"[MetaMirror] '{lbl_meta_dir}' [{args.start}, {args.end}] -> '{args.lfss_mirror_path}': "
+        f"listed: {stats['listed']}, downloaded: {stats['downloaded']}, unchanged: {stats['unchanged']}, "
+        f"removed: {stats['removed']} ({time.time() - t0:.1f}s)"
+    )
+    tqdm.write(LFSS_POOL.summary())
@@ -1,40 +1,148 @@
+import asyncio
 from typing import TypeVar
 
-from openai import OpenAI
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAI
 
 from src.models.base_model import BaseModel
-from src.utils.common_utils import encode_image
+from src.utils.image_cache import get_encoded_image
+from src.utils.rate_limiter import RateLimiter
+from src.utils.usage_meter import CHARS_PER_TOKEN, UsageMeter
 
 JSON_T = dict | list
 JSON_T_VAR = TypeVar("JSON_T_VAR", bound=JSON_T)
 
+def image_and_text_messages(image_url: str, prompt: str) -> list:
+    return [
+        {
+        "role": "user",
+        "content": [
+                {
+                    "type": "text",
+                    "text": prompt
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_url
+                    }
+                }
+            ]
+        }
+    ]
+
 class APIModel(BaseModel):
     def __init__(self, model_name: str, temperature: float, base_url: str, api_key: str):
         self.model_name = model_name
         self.temperature = temperature
         self.client = OpenAI(api_key=api_key, base_url=base_url)
+        self.usage = UsageMeter()
+    
+    def set_rate_limiter(self, limiter: RateLimiter) -> None:
+        """Send all requests through `limiter`, whose retries replace the client's built-in ones."""
+        self.rate_limiter = limiter
+        self.client = self.client.with_options(max_retries=0)
+    
+    def create_completion(self, prompt: str, **kwargs):
+        if self.rate_limiter is None:
+            response = self.client.chat.completions.create(**kwargs)
+        else:
+            # image tokens are unknown up front, settle() corrects the estimate from the reported usage
+            estimate = len(prompt) / CHARS_PER_TOKEN
+            response = self.rate_limiter.call(lambda: self.client.chat.completions.create(**kwargs), tokens=estimate)
+            self.rate_limiter.settle(estimate, getattr(response.usage, "total_tokens", None))
+        self.usage.record(response.usage)
+        return response
 
     def generate_from_image_and_text(self, image_path: str, prompt: str, output_type: type[JSON_T_VAR] = dict):
-        response = self.client.chat.completions.create(
+        cache_key = self.cache_key(prompt, image_path, self.temperature, output_type)
+        if (res_text:=self.cache_get(cache_key)) is not None:
+            return self.t2j(res_text, output_type)
+        response = self.create_completion(
+            prompt,
             extra_body={},
             model=self.model_name,
+            messages=image_and_text_messages(get_encoded_image(image_path).data_url, prompt),
+            temperature=self.temperature,
+        )
+        assert (res_text:=response.choices[0].message.content)
+        try:
+            res = self.t2j(res_text, output_type)
+        except Exception as e:
+            raise type(e)(f"[{str(e)}] Original Text: {res_text}")
+        self.cache_put(cache_key, res_text)
+        return res
+
+    def generate_from_text(self, prompt: str, output_type: type[JSON_T_VAR] = dict, temperature: float = None):
+        temperature = temperature if temperature else self.temperature
+        cache_key = self.cache_key(prompt, None, temperature, output_type)
+        if (res_text:=self.cache_get(cache_key)) is not None:
+            return self.t2j(res_text, output_type)
+        response = self.create_completion(
+            prompt,
+            model=self.model_name,
             messages=[
-                {
-                "role": "user",
-                "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{encode_image(image_path)}"
-                            }
-                        }
-                    ]
-                }
+                {"role": "user", "content": prompt}
             ],
+            temperature=temperature,
+        )
+        assert (res_text:=response.choices[0].message.content)
+        try:
+            res = self.t2j(res_text, output_type)
+        except Exception as e:
+            raise type(e)(f"[{str(e)}] Original Text: {res_text}")
+        self.cache_put(cache_key, res_text)
+        return res
+
+class AsyncAPIModel(BaseModel):
+    """
+    Coroutine-based counterpart of APIModel built on AsyncOpenAI.
+
+    All requests share one connection pool and are bounded by a semaphore, so a single
+    event loop can keep `max_concurrency` requests in flight without one thread per request.
+    The generate methods have the same signatures as APIModel but must be awaited.
+    """
+    def __init__(self, model_name: str, temperature: float, base_url: str, api_key: str, max_concurrency: int = 1024):
+        self.model_name = model_name
+        self.temperature = temperature
+        self.max_concurrency = max_concurrency
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+            ),
+        )
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.usage = UsageMeter()
+    
+    def set_rate_limiter(self, limiter: RateLimiter) -> None:
+        """Send all requests through `limiter`, whose retries replace the client's built-in ones."""
+        self.rate_limiter = limiter
+        self.client = self.client.with_options(max_retries=0)
+    
+    async def create_completion(self, prompt: str, **kwargs):
+        async with self.semaphore:
+            if self.rate_limiter is None:
+                response = await self.client.chat.completions.create(**kwargs)
+            else:
+                estimate = len(prompt) / CHARS_PER_TOKEN
+                response = await self.rate_limiter.async_call(lambda: self.client.chat.completions.create(**kwargs), tokens=estimate)
+                await asyncio.to_thread(self.rate_limiter.settle, estimate, getattr(response.usage, "total_tokens", None))
+        self.usage.record(response.usage)
+        return response
+
+    async def generate_from_image_and_text(self, image_path: str, prompt: str, output_type: type[JSON_T_VAR] = dict):
+        cache_key = self.cache_key(prompt, image_path, self.temperature, output_type)
+        # the cache lookup, reading and base64-encoding the image are blocking I/O, keep them off the event loop
+        if (res_text:=await asyncio.to_thread(self.cache_get, cache_key)) is not None:
+            return self.t2j(res_text, output_type)
+        image = await asyncio.to_thread(get_encoded_image, image_path)
+        response = await self.create_completion(
+            prompt,
+            extra_body={},
+            model=self.model_name,
+            messages=image_and_text_messages(image.data_url, prompt),
             temperature=self.temperature,
         )
         assert (res_text:=response.choices[0].message.content)
@@ -42,19 +150,26 @@ class APIModel(BaseModel):
             res = self.t2j(res_text, output_type)
         except Exception as e:
             raise type(e)(f"[{str(e)}] Original Text: {res_text}")
+        await asyncio.to_thread(self.cache_put, cache_key, res_text)
         return res
 
-    def generate_from_text(self, prompt: str, output_type: type[JSON_T_VAR] = dict, temperature: float = None):
-        response = self.client.chat.completions.create(
+    async def generate_from_text(self, prompt: str, output_type: type[JSON_T_VAR] = dict, temperature: float = None):
+        temperature = temperature if temperature else self.temperature
+        cache_key = self.cache_key(prompt, None, temperature, output_type)
+        if (res_text:=await asyncio.to_thread(self.cache_get, cache_key)) is not None:
+            return self.t2j(res_text, output_type)
+        response = await self.create_completion(
+            prompt,
             model=self.model_name,
             messages=[
                 {"role": "user", "content": prompt}
-            ], 
-            temperature=temperature if temperature else self.temperature,
+            ],
+            temperature=temperature,
         )
         assert (res_text:=response.choices[0].message.content)
         try:
             res = self.t2j(res_text, output_type)
         except Exception as e:
             raise type(e)(f"[{str(e)}] Original Text: {res_text}")
+        await asyncio.to_thread(self.cache_put, cache_key, res_text)
         return res
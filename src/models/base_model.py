@@ -1,11 +1,19 @@
 import json
 from abc import ABC, abstractmethod
-from typing import TypeVar
+from typing import Optional, TypeVar
 
 from json_repair import repair_json
 
+from src.utils.rate_limiter import RateLimiter
+from src.utils.response_cache import ResponseCache
+from src.utils.usage_meter import UsageMeter
+
 JSON_T = dict | list
 JSON_T_VAR = TypeVar("JSON_T_VAR", bound=JSON_T)
+# errors of a reply that arrived but is not the expected JSON (parse_json, t2j, reply validation;
+# json.JSONDecodeError is a ValueError);
+# request errors (connection, timeout, HTTP status) are not among them
+MALFORMED_REPLY_ERRORS = (ValueError, KeyError, AssertionError)
 def parse_json(json_str: str, ret_t: type[JSON_T_VAR] = dict) -> JSON_T_VAR:
     if json_str.startswith("```json") and json_str.endswith("```"):
         json_str = json_str[7:-3].strip()
@@ -20,9 +28,27 @@ def parse_json(json_str: str, ret_t: type[JSON_T_VAR] = dict) -> JSON_T_VAR:
     return res_json
 
 class BaseModel(ABC):
+    model_name: str = ""
+    response_cache: Optional[ResponseCache] = None
+    usage: Optional[UsageMeter] = None
+    rate_limiter: Optional[RateLimiter] = None
+    
     def __init__(self):
         pass
     
+    def cache_key(self, prompt: str, image_path: Optional[str], temperature: Optional[float], output_type: type) -> Optional[str]:
+        """Response cache key for one call, or None if the call must not be cached."""
+        if self.response_cache is None or not self.response_cache.enabled_for(temperature):
+            return None
+        return self.response_cache.make_key(self.model_name, prompt, image_path, temperature, output_type)
+    
+    def cache_get(self, key: Optional[str]) -> Optional[str]:
+        return self.response_cache.get(key) if key else None
+    
+    def cache_put(self, key: Optional[str], res_text: str) -> None:
+        if key:
+            self.response_cache.put(key, self.model_name, res_text)
+    
     @staticmethod
     def j2t(json_dict: JSON_T) -> str:
         return json.dumps(json_dict, ensure_ascii=False, indent=2)
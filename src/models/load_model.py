@@ -1,19 +1,28 @@
 from argparse import Namespace
 from typing import Any, Dict, Optional
 
-from src.models.api_model import APIModel
+from src.models.api_model import APIModel, AsyncAPIModel
 from src.models.base_model import BaseModel
 from src.models.local_model import BaichuanOmni1d5Model
+from src.models.micro_batcher import MicroBatchingModel
 from src.utils.common_utils import strip_trailing_slash
+from src.utils.rate_limiter import get_rate_limiter
+from src.utils.response_cache import ResponseCache
 
 
 def load_model(args: Namespace, model_cfg: Optional[Dict[str, Any]]) -> BaseModel:
-    if args.task == "generation" or args.task == "prediction":
+    if args.task == "generation" or args.task == "prediction" or args.task == "translate":
         if args.client_type == "local":
             if args.served_model_name == "baichuan-inc/Baichuan-Omni-1d5":
-                model = BaichuanOmni1d5Model(strip_trailing_slash(model_cfg["model_dir"]), args.temperature, args.do_sample, args.max_new_tokens)
+                if args.local_batch_size > 1:
+                    # left-padded batches rely on the checkpoint's own prepare_inputs_for_generation and image-token
+                    # placement to honour the attention mask, which has not been checked against unbatched output
+                    raise ValueError(f"--local_batch_size > 1 is not supported for {args.served_model_name} until its batched output has been checked against unbatched output.")
+                model = BaichuanOmni1d5Model(strip_trailing_slash(model_cfg["model_dir"]), args.temperature, args.do_sample, args.max_new_tokens, device=args.device)
             else:
                 raise ValueError(f"Unsupported model: {args.served_model_name}")
+        elif args.async_mode:
+            model = AsyncAPIModel(args.served_model_name, args.temperature, args.api_base_url, args.api_key, max_concurrency=args.max_inflight)
         else:
             model = APIModel(args.served_model_name, args.temperature, args.api_base_url, args.api_key)
     
@@ -22,4 +31,16 @@ def load_model(args: Namespace, model_cfg: Optional[Dict[str, Any]]) -> BaseMode
             raise ValueError(f"Unsupported local client for evaluation task.")
         else:
             model = APIModel(args.served_model_name, args.temperature, args.api_base_url, args.api_key)
+    
+    if args.response_cache:
+        model.response_cache = ResponseCache(
+            args.response_cache_path,
+            max_size_mb=args.response_cache_max_mb,
+            max_age_days=args.response_cache_max_age_days,
+            cache_sampled=args.response_cache_sampled,
+        )
+    if args.client_type == "api" and (limiter:=get_rate_limiter(args.api_base_url)) is not None:
+        model.set_rate_limiter(limiter)
+    if args.client_type == "local" and args.local_batch_size > 1:
+        model = MicroBatchingModel(model, args.local_batch_size, args.local_batch_wait_ms)
     return model
\ No newline at end of file
@@ -1,6 +1,7 @@
-from typing import TypeVar
+from typing import Any, List, Tuple, TypeVar
 
 import torch
+import torch.nn.functional as F
 import ujson
 from PIL import Image
 from transformers import AutoModelForCausalLM, AutoTokenizer
@@ -11,28 +12,36 @@ JSON_T = dict | list
 JSON_T_VAR = TypeVar("JSON_T_VAR", bound=JSON_T)
 
 class BaichuanOmni1d5Model(BaseModel):
-    def __init__(self, model_path: str, temperature: float, do_sample: bool, max_new_tokens: int):
+    def __init__(self, model_path: str, temperature: float, do_sample: bool, max_new_tokens: int, device: str = "cuda"):
         self.role_prefix = {
             'system': '<B_SYS>',
             'user': '<C_Q>',
             'assistant': '<C_A>',
             'audiogen': '<audiotext_start_baichuan>'
         }
+        self.model_name = model_path
         self.do_sample = do_sample
         self.temperature = temperature
         self.max_new_tokens = max_new_tokens
+        self.device = torch.device(device)
         
         self.model = AutoModelForCausalLM.from_pretrained(
             model_path,
-            torch_dtype=torch.bfloat16,
+            # bfloat16 matmuls are very slow on most CPUs
+            torch_dtype=torch.bfloat16 if self.device.type == "cuda" else torch.float32,
             trust_remote_code=True
-        ).cuda()
+        ).to(self.device)
         self.tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True)
         self.model.training = False
         self.model.bind_processor(self.tokenizer, training=False)
         self.image_start_token = self.tokenizer.convert_ids_to_tokens(self.model.config.video_config.image_start_token_id)
         self.image_end_token = self.tokenizer.convert_ids_to_tokens(self.model.config.video_config.image_end_token_id)
-        print("BaiChuanOmni1d5Model loaded.")
+        print(f"BaiChuanOmni1d5Model loaded on {self.device}.")
+
+    def build_message(self, image_path: str, prompt: str) -> str:
+        image_info = self.image_start_token + ujson.dumps({'local': image_path}, ensure_ascii=False) + self.image_end_token
+        content = image_info + prompt
+        return self.role_prefix["user"] + content + self.role_prefix["assistant"]
 
     def generate_from_image_and_text(self, image_path: str, prompt: str, output_type: type[JSON_T_VAR] = dict):
         try:
@@ -42,17 +51,18 @@ class BaichuanOmni1d5Model(BaseModel):
             print(f"[ERROR] {image_path}")
             raise e
         
-        image_info = self.image_start_token + ujson.dumps({'local': image_path}, ensure_ascii=False) + self.image_end_token
-        content = image_info + prompt
+        cache_key = self.cache_key(prompt, image_path, self.temperature if self.do_sample else 0.0, output_type)
+        if (res_text:=self.cache_get(cache_key)) is not None:
+            return self.t2j(res_text, output_type)
         
-        message = self.role_prefix["user"] + content + self.role_prefix["assistant"]
+        message = self.build_message(image_path, prompt)
         processed_input = self.model.processor([message])
         plen = processed_input.input_ids.shape[1]
         
         text_output = self.model.generate(
-            input_ids=processed_input.input_ids.cuda(),
-            attention_mask=processed_input.attention_mask.cuda() if processed_input.attention_mask is not None else None,
-            images=[torch.tensor(img, dtype=torch.float32).cuda() for img in processed_input.images] if processed_input.images is not None else None,
+            input_ids=processed_input.input_ids.to(self.device),
+            attention_mask=processed_input.attention_mask.to(self.device) if processed_input.attention_mask is not None else None,
+            images=[torch.tensor(img, dtype=torch.float32).to(self.device) for img in processed_input.images] if processed_input.images is not None else None,
             patch_nums=processed_input.patch_nums if processed_input.patch_nums is not None else None,
             images_grid=processed_input.images_grid if processed_input.images_grid is not None else None,
             tokenizer=self.tokenizer,
@@ -64,15 +74,95 @@ class BaichuanOmni1d5Model(BaseModel):
             return_dict_in_generate=True,
             pad_token_id=self.tokenizer.eos_token_id     # Setting `pad_token_id` to `eos_token_id`:None for open-end generation.
         )
-        
+
         new_text = self.tokenizer.decode(text_output.sequences[0, plen:])
         assert (res_text:=new_text.replace('<|endoftext|>', '').strip())
         try:
             res = self.t2j(res_text, output_type)
         except Exception as e:
             raise type(e)(f"[{str(e)}] Original Text: {res_text}")
+        self.cache_put(cache_key, res_text)
         return res
 
+    def generate_batch(self, requests: List[Tuple[str, str, type]]) -> List[Any]:
+        """
+        Run several image+prompt requests through one `model.generate` call.
+
+        Args:
+            requests (list): (image_path, prompt, output_type) tuples.
+
+        Returns:
+            list: For each request, the parsed result or the exception raised for it.
+        """
+        results: List[Any] = [None] * len(requests)
+        todo = []
+        for i, (image_path, prompt, output_type) in enumerate(requests):
+            try:
+                Image.open(image_path).close()
+                cache_key = self.cache_key(prompt, image_path, self.temperature if self.do_sample else 0.0, output_type)
+                if (res_text:=self.cache_get(cache_key)) is not None:
+                    results[i] = self.t2j(res_text, output_type)
+                    continue
+                todo.append((i, cache_key, self.model.processor([self.build_message(image_path, prompt)])))
+            except Exception as e:
+                results[i] = e
+        if not todo:
+            return results
+
+        try:
+            texts = self._generate_padded([processed for _, _, processed in todo])
+        except Exception as e:
+            for i, _, _ in todo:
+                results[i] = e
+            return results
+
+        for (i, cache_key, _), res_text in zip(todo, texts):
+            try:
+                assert res_text
+                results[i] = self.t2j(res_text, requests[i][2])
+                self.cache_put(cache_key, res_text)
+            except Exception as e:
+                results[i] = type(e)(f"[{str(e)}] Original Text: {res_text}")
+        return results
+
+    def _generate_padded(self, processed_inputs: list) -> List[str]:
+        # decoder-only generation: left-pad every prompt to the longest one in the batch
+        pad_token_id = self.tokenizer.pad_token_id if self.tokenizer.pad_token_id is not None else self.tokenizer.eos_token_id
+        plen = max(p.input_ids.shape[1] for p in processed_inputs)
+        input_ids, attention_mask = [], []
+        images, patch_nums, images_grid = [], [], []
+        for p in processed_inputs:
+            pad = plen - p.input_ids.shape[1]
+            mask = p.attention_mask if p.attention_mask is not None else torch.ones_like(p.input_ids)
+            input_ids.append(F.pad(p.input_ids, (pad, 0), value=pad_token_id))
+            attention_mask.append(F.pad(mask, (pad, 0), value=0))
+            if p.images is not None:
+                images.extend(p.images)
+            if p.patch_nums is not None:
+                patch_nums.extend(p.patch_nums)
+            if p.images_grid is not None:
+                images_grid.extend(p.images_grid)
+
+        text_output = self.model.generate(
+            input_ids=torch.cat(input_ids).to(self.device),
+            attention_mask=torch.cat(attention_mask).to(self.device),
+            images=[torch.tensor(img, dtype=torch.float32).to(self.device) for img in images] if images else None,
+            patch_nums=patch_nums if patch_nums else None,
+            images_grid=images_grid if images_grid else None,
+            tokenizer=self.tokenizer,
+            max_new_tokens=self.max_new_tokens,
+            stop_strings=['<|endoftext|>'],
+            do_sample=self.do_sample,
+            temperature=self.temperature,
+            repetition_penalty=1.1,
+            return_dict_in_generate=True,
+            pad_token_id=self.tokenizer.eos_token_id
+        )
+        return [
+            self.tokenizer.decode(seq[plen:]).replace('<|endoftext|>', '').strip()
+            for seq in text_output.sequences
+        ]
+
     def generate_from_text(self, prompt: str, output_type: type[JSON_T_VAR] = dict):
         """
         LocalModel does not support text-only generation.
@@ -0,0 +1,99 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Tuple, TypeVar
+
+from src.models.base_model import BaseModel
+
+JSON_T = dict | list
+JSON_T_VAR = TypeVar("JSON_T_VAR", bound=JSON_T)
+
+
+class MicroBatcher:
+    """
+    Collects single requests from many producer threads and runs them through
+    `model.generate_batch` in groups of up to `max_batch_size`.
+
+    A batch is dispatched as soon as it is full, or `max_wait_ms` after its first request
+    arrived, so a lone request is never delayed by more than that.
+    """
+
+    def __init__(self, model: BaseModel, max_batch_size: int, max_wait_ms: float = 50):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue: "queue.Queue[Tuple[Tuple[str, str, type], Future]]" = queue.Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        self.worker = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+        self.worker.start()
+
+    def submit(self, image_path: str, prompt: str, output_type: type) -> Future:
+        future = Future()
+        self.queue.put(((image_path, prompt, output_type), future))
+        return future
+
+    def _collect(self) -> List[Tuple[Tuple[str, str, type], Future]]:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            try:
+                results = self.model.generate_batch([req for req, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            with self.lock:
+                self.batches += 1
+                self.requests += len(batch)
+            for (_, future), res in zip(batch, results):
+                if isinstance(res, Exception):
+                    future.set_exception(res)
+                else:
+                    future.set_result(res)
+
+    def summary(self) -> str:
+        with self.lock:
+            avg = self.requests / self.batches if self.batches else 0.0
+            return f"[MicroBatcher] requests: {self.requests}, batches: {self.batches}, avg batch size: {avg:.2f} (max {self.max_batch_size})"
+
+
+class MicroBatchingModel(BaseModel):
+    """
+    Drop-in wrapper that routes `generate_from_image_and_text` through a MicroBatcher,
+    so the thread-pool based predictors feed batched generation without changes.
+    """
+
+    def __init__(self, model: BaseModel, max_batch_size: int, max_wait_ms: float = 50):
+        self.model = model
+        self.batcher = MicroBatcher(model, max_batch_size, max_wait_ms)
+
+    @property
+    def model_name(self) -> str:
+        return self.model.model_name
+
+    @property
+    def response_cache(self):
+        return self.model.response_cache
+
+    @property
+    def usage(self):
+        return self.model.usage
+
+    def generate_from_image_and_text(self, image_path: str, prompt: str, output_type: type[JSON_T_VAR] = dict):
+        return self.batcher.submit(image_path, prompt, output_type).result()
+
+    def generate_from_text(self, prompt: str, output_type: type[JSON_T_VAR] = dict):
+        return self.model.generate_from_text(prompt, output_type)
@@ -1,5 +1,9 @@
+from tqdm import tqdm
+
 from src.models.load_model import load_model
+from src.models.micro_batcher import MicroBatchingModel
 from src.utils.common_utils import *
+from src.utils.image_cache import IMAGE_CACHE
 
 
 def run(args, yaml_cfg, model_cfg):
@@ -16,3 +20,13 @@ def run(args, yaml_cfg, model_cfg):
     elif args.subtask == "captioning":
         from src.tasks.captioning.predictor import run_captioning_prediction
         run_captioning_prediction(model, yaml_cfg, args)
+    
+    if model.response_cache is not None:
+        tqdm.write(model.response_cache.summary())
+    if model.rate_limiter is not None:
+        tqdm.write(model.rate_limiter.summary())
+    if model.usage is not None:
+        tqdm.write(model.usage.summary(f"{args.task} - {args.subtask} - {args.model_name}"))
+    tqdm.write(IMAGE_CACHE.summary())
+    if isinstance(model, MicroBatchingModel):
+        tqdm.write(model.batcher.summary())
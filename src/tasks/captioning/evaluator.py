@@ -1,39 +1,43 @@
-import json
 import os
 from argparse import Namespace
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from decimal import Decimal
 
 import numpy as np
-from bert_score import score
 from tqdm import tqdm
 from transformers import logging
 
 from src.models.base_model import BaseModel
 from src.utils import prompt
+from src.utils.aggregation import DatasetGroups, field, quantize
+from src.utils.bert_scorer import BertScoreEngine, bert_scorer_from_args
 from src.utils.common_utils import confirm_restart_if_exists, strip_trailing_slash
+from src.utils.eval_state import EvaluationState, fingerprint, incremental_summary, merge_per_sample
 from src.utils.file_io import (
     convert_jsonl_to_json,
+    iter_data,
     load_captioning_data,
     load_completed_indices,
     load_data,
     load_distribution_data,
+    open_output,
     save_json_data,
+    write_record,
 )
-from src.utils.lfss_io import LabelReader, SkipReader
+from src.utils.lfss_mirror import meta_batch_reader
+from src.utils.prompt_builder import build_prompt
+from src.utils.translation_store import translate_case
 
 logging.set_verbosity_error()
 
 
 def task(idx: str, model: BaseModel, lbl_meta_dir: str, vlm_captioning: str, args: Namespace) -> dict:
-    r = SkipReader(lbl_meta_dir=lbl_meta_dir)
-    skip = r.get(idx)
-    if skip is not None:
+    # skip and label in one request
+    meta = meta_batch_reader(lbl_meta_dir).get([idx], fields=("skip", "label"))[idx]
+    if meta.skip is not None:
         return None
     
-    r = LabelReader(lbl_meta_dir=lbl_meta_dir)
-    label = r.get(idx)
+    label = meta.label
     if label is None:
         return None
     
@@ -43,21 +47,18 @@ def task(idx: str, model: BaseModel, lbl_meta_dir: str, vlm_captioning: str, arg
     try:
         # translate the label to English
         if args.lfss_meta_type == "cn":
-            p = prompt.translate_dent_json_zh2en.substitute(
-                case=model.j2t(label)
-                )
-            case_en = model.generate_from_text(prompt=p)
+            case_en = translate_case(label, model)
         else:
             case_en = label
         
         # refine captioning (Refine all observed abnormalities from the captioning)
-        p = prompt.captioning_extraction_intraoral_condition.substitute(
+        p = build_prompt(prompt.captioning_extraction_intraoral_condition,
             case=model.j2t(vlm_captioning)
         )
         refine = model.generate_from_text(prompt=p, output_type=list)
         
         # generate the confusion matrix
-        p = prompt.captioning_score_intraoral_condition.substitute(
+        p = build_prompt(prompt.captioning_score_intraoral_condition,
             reference=model.j2t(case_en['items']),
             prediction=model.j2t(refine)
         )
@@ -76,13 +77,33 @@ def task(idx: str, model: BaseModel, lbl_meta_dir: str, vlm_captioning: str, arg
             "res": {idx: {"failed": str(e)}}
         }
 
-def generate_captioning_confusion_matrix(model: BaseModel, yaml_cfg, args):
-    data = load_data(os.path.join(args.project_root, args.save_root_dir, "prediction/captioning", args.model_name, "results.json"))
+def generate_captioning_confusion_matrix(model: BaseModel, yaml_cfg, args, label_json: dict = None) -> set:
+    """
+    Judge the captions of `args.model_name` with the evaluator model, resuming from `args.outfile`.
+
+    With --incremental, samples whose caption or reference changed since they were judged are
+    judged again (instead of asking whether to restart from scratch).
+
+    Returns:
+        set: Changed samples whose new judgement failed; their stored result is outdated.
+    """
+    all_indices = [f"{i:09d}" for i in range(args.start, args.end + 1)]
+    # the predictions are streamed, only those of [start, end] are kept
+    wanted = set(all_indices)
+    data = {idx: value for idx, value in iter_data(os.path.join(args.project_root, args.save_root_dir, "prediction/captioning", args.model_name, "results.json")) if idx in wanted}
     data_keys = set(data.keys())
     
     completed = load_completed_indices(args)
-    completed = confirm_restart_if_exists(args, completed)
-    all_indices = [f"{i:09d}" for i in range(args.start, args.end + 1)]
+    if args.incremental:
+        # samples judged before the state existed are taken as up to date, as when resuming
+        state = EvaluationState(os.path.join(args.project_root, "metric", args.subtask, "confusion_matrix", args.model_name))
+        fingerprints = {idx: fingerprint(data[idx], (label_json or {}).get(idx)) for idx in data_keys}
+        stale = {idx for idx in completed if idx in state.fingerprints and state.fingerprints[idx] != fingerprints.get(idx)}
+        completed -= stale
+        tqdm.write(f"[Incremental] {args.subtask} - {args.model_name}: {len(stale)} judged samples changed")
+    else:
+        completed = confirm_restart_if_exists(args, completed)
+    judged = set()
     pending = [idx for idx in all_indices if idx not in completed and idx in data_keys]
     tqdm.write(f"Total tasks: {len(all_indices)} | Completed: {len(completed)} | Skipped: {len(all_indices) - len(completed) - len(pending)} | Pending: {len(pending)}")
     
@@ -94,10 +115,10 @@ def generate_captioning_confusion_matrix(model: BaseModel, yaml_cfg, args):
         else:
             lbl_meta_dir=strip_trailing_slash(yaml_cfg["lfss"]["meta_en_dir"])
         
-        with open(args.outfile, "a", encoding="utf-8") as f_out, \
-            open(args.translatefile, "a", encoding="utf-8") as f_translate, \
-            open(args.refinefile, "a", encoding="utf-8") as f_refine, \
-            open(args.failfile, "a", encoding="utf-8") as f_fail:
+        with open_output(args, "results") as f_out, \
+            open_output(args, "translate") as f_translate, \
+            open_output(args, "refine") as f_refine, \
+            open_output(args, "failures") as f_fail:
             
             with ThreadPoolExecutor(max_workers=args.workers) as executor:
                 futures = {executor.submit(task, idx, model, lbl_meta_dir, data[idx], args): idx for idx in pending}
@@ -110,30 +131,33 @@ def generate_captioning_confusion_matrix(model: BaseModel, yaml_cfg, args):
                         result = out["res"]
                         if case_en:
                             if "failed" in case_en or (isinstance(case_en, dict)and "failed" in case_en[list(case_en.keys())[0]]):
-                                f_fail.write(json.dumps(case_en, ensure_ascii=False) + "\n")
-                                f_fail.flush()
+                                write_record(f_fail, case_en)
                             else:
-                                f_translate.write(json.dumps(case_en, ensure_ascii=False) + "\n")
-                                f_translate.flush()
+                                write_record(f_translate, case_en)
                         if refine:
                             if "failed" in refine or (isinstance(refine, dict) and "failed" in refine[list(refine.keys())[0]]):
-                                f_fail.write(json.dumps(refine, ensure_ascii=False) + "\n")
-                                f_fail.flush()
+                                write_record(f_fail, refine)
                             else:
-                                f_refine.write(json.dumps(refine, ensure_ascii=False) + "\n")
-                                f_refine.flush()
+                                write_record(f_refine, refine)
                         if result:
                             if "failed" in result or (isinstance(result, dict) and "failed" in result[list(result.keys())[0]]):
-                                f_fail.write(json.dumps(result, ensure_ascii=False) + "\n")
-                                f_fail.flush()
+                                write_record(f_fail, result)
                             else:
-                                f_out.write(json.dumps(result, ensure_ascii=False) + "\n")
-                                f_out.flush()
+                                write_record(f_out, result)
+                                judged.update(result.keys())
     
     convert_jsonl_to_json(args, jsonl_type="results")
     convert_jsonl_to_json(args, jsonl_type="translate")
     convert_jsonl_to_json(args, jsonl_type="failures")
     convert_jsonl_to_json(args, jsonl_type="refine")
+    
+    if not args.incremental:
+        return set()
+    # changed samples whose judgement failed keep their old fingerprint, so they stay stale
+    updated = dict(state.fingerprints)
+    updated.update({idx: fingerprints[idx] for idx in (completed | judged) if idx in fingerprints})
+    state.save(updated)
+    return stale - judged
 
 def compute_confusion_matrix(confusion_dict):
     TP = confusion_dict.get("TP", 0)
@@ -150,36 +174,15 @@ def compute_confusion_matrix(confusion_dict):
         "F1": f1
     }
 
-def statistical_BERTScore(cands, refs, chunk=False, chunk_size=512):
-    all_P, all_R, all_F1 = [], [], []
-
+def statistical_BERTScore(cands, refs, scorer: BertScoreEngine, chunk=False, chunk_size=512, idf_refs=None):
     if not chunk:
-        while True:
-            try:
-                P, R, F1 = score(
-                    cands,
-                    refs,
-                    lang="en",
-                    verbose=True,
-                    rescale_with_baseline=True
-                )
-                break
-            except Exception as e:
-                tqdm.write(e)
-                tqdm.write(f"Retrying ...")
-                continue
-        return P, R, F1
+        return scorer.score(cands, refs, verbose=True, idf_refs=idf_refs)
 
+    all_P, all_R, all_F1 = [], [], []
     for i in tqdm(range(0, len(cands), chunk_size), desc="Scoring chunks", dynamic_ncols=True):
         batch_cands = cands[i:i+chunk_size]
         batch_refs = refs[i:i+chunk_size]
-        P, R, F1 = score(
-            batch_cands,
-            batch_refs,
-            lang="en",
-            verbose=False,
-            rescale_with_baseline=True
-        )
+        P, R, F1 = scorer.score(batch_cands, batch_refs, idf_refs=idf_refs)
         all_P.append(P)
         all_R.append(R)
         all_F1.append(F1)
@@ -188,79 +191,95 @@ def statistical_BERTScore(cands, refs, chunk=False, chunk_size=512):
     return cat(all_P), cat(all_R), cat(all_F1)
 
 def calculated_all_matrice(model_json: dict, distribution: dict, save_dir: str, args: Namespace):
-    model_summary = defaultdict(dict)
-    for key, item in tqdm(model_json.items(), total=len(model_json), dynamic_ncols=True, desc=f"{args.model_name}"):
-        for dataset_name, ids in distribution.items():
-            if key in ids:
-                if not model_summary[dataset_name]:
-                    model_summary[dataset_name] = defaultdict(dict)
-                if not model_summary[dataset_name][args.model_name]:
-                    model_summary[dataset_name][args.model_name] = defaultdict(float)
-                if not model_summary[args.model_name]:
-                    model_summary[args.model_name] = defaultdict(float)
-                
-                # DS1, DS2, DS3
-                model_summary[dataset_name][args.model_name]["total_P"] += item["P"]
-                model_summary[dataset_name][args.model_name]["total_R"] += item["R"]
-                model_summary[dataset_name][args.model_name]["total_F1"] += item["F1"]
-                model_summary[dataset_name][args.model_name]["count"] += 1
-                
-                model_summary[dataset_name][args.model_name]["Avg_P"] =  model_summary[dataset_name][args.model_name]["total_P"] / model_summary[dataset_name][args.model_name]["count"]
-                model_summary[dataset_name][args.model_name]["Avg_R"] =  model_summary[dataset_name][args.model_name]["total_R"] / model_summary[dataset_name][args.model_name]["count"]
-                model_summary[dataset_name][args.model_name]["Avg_F1"] =  model_summary[dataset_name][args.model_name]["total_F1"] / model_summary[dataset_name][args.model_name]["count"]
-            
-                # MetaDent
-                model_summary[args.model_name]["total_P"] += item["P"]
-                model_summary[args.model_name]["total_R"] += item["R"]
-                model_summary[args.model_name]["total_F1"] += item["F1"]
-                model_summary[args.model_name]["count"] += 1
-                
-                model_summary[args.model_name]["Avg_P"] =  model_summary[args.model_name]["total_P"] / model_summary[args.model_name]["count"]
-                model_summary[args.model_name]["Avg_R"] =  model_summary[args.model_name]["total_R"] / model_summary[args.model_name]["count"]
-                model_summary[args.model_name]["Avg_F1"] =  model_summary[args.model_name]["total_F1"] / model_summary[args.model_name]["count"]
-                
-                # Keep three decimal places
-                point = '0.000'
-                model_summary[dataset_name][args.model_name]["Avg_P_decimal"] = float(Decimal(str(model_summary[dataset_name][args.model_name]["Avg_P"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                model_summary[dataset_name][args.model_name]["Avg_R_decimal"] = float(Decimal(str(model_summary[dataset_name][args.model_name]["Avg_R"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                model_summary[dataset_name][args.model_name]["Avg_F1_decimal"] = float(Decimal(str(model_summary[dataset_name][args.model_name]["Avg_F1"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                
-                model_summary[args.model_name]["Avg_P_decimal"] = float(Decimal(str(model_summary[args.model_name]["Avg_P"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                model_summary[args.model_name]["Avg_R_decimal"] = float(Decimal(str(model_summary[args.model_name]["Avg_R"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                model_summary[args.model_name]["Avg_F1_decimal"] = float(Decimal(str(model_summary[args.model_name]["Avg_F1"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                
-                break
+    groups = DatasetGroups(model_json.keys(), distribution)
+    items = list(model_json.values())
+    sums = {name: groups.sum(field(items, name)) for name in ("P", "R", "F1")}
+    counts = groups.count()
     
+    def build(i: int) -> dict:
+        res = {}
+        res["total_P"] = float(sums["P"][i])
+        res["total_R"] = float(sums["R"][i])
+        res["total_F1"] = float(sums["F1"][i])
+        res["count"] = float(counts[i])
+        
+        res["Avg_P"] = res["total_P"] / res["count"]
+        res["Avg_R"] = res["total_R"] / res["count"]
+        res["Avg_F1"] = res["total_F1"] / res["count"]
+        
+        # Keep three decimal places
+        res["Avg_P_decimal"] = quantize(res["Avg_P"])
+        res["Avg_R_decimal"] = quantize(res["Avg_R"])
+        res["Avg_F1_decimal"] = quantize(res["Avg_F1"])
+        return res
+    
+    # DS1, DS2, DS3 and MetaDent
+    model_summary = groups.summary(args.model_name, build)
     save_json_data(model_summary, save_dir, "results.json", title=f"{args.task} - {args.subtask} - {args.model_name}")
+    return model_summary
+
+def run_captioning_evaluation(model: BaseModel, yaml_cfg, args, label_json: dict = None, distribution: dict = None) -> dict:
+    """
+    Evaluate the captions of `args.model_name` (BERTScore and LLM-judged confusion matrix).
+    `label_json` and `distribution` are loaded from data/ unless given (a sweep loads them once
+    for all models).
 
-def run_captioning_evaluation(model: BaseModel, yaml_cfg, args):
-    distribution = load_distribution_data()
+    Returns:
+        dict: {metric directory: summary of results.json}.
+    """
+    if distribution is None:
+        distribution = load_distribution_data()
+    if label_json is None:
+        label_json = load_captioning_data()
     save_BertScore_dir = os.path.join(args.project_root, "metric", args.subtask, "BertScore", args.model_name)
     save_confusion_dir = os.path.join(args.project_root, "metric", args.subtask, "confusion_matrix", args.model_name)
     
     # 1. generate the BERTScore
-    label_json = load_captioning_data()
     vlm_json_path = os.path.join(args.project_root, args.save_root_dir, "prediction/captioning", args.model_name, "results.json")
     if not os.path.exists(vlm_json_path):
         raise FileNotFoundError(f"{vlm_json_path} not found, please run predictor first.")
-    with open(vlm_json_path, "r") as f:
-        vlm_json = json.load(f)
+    # the predictions are streamed, only the captions are kept
+    captions = {k: str(v["description"]) for k, v in iter_data(vlm_json_path) if k in label_json}
 
-    common_keys = [k for k in label_json if k in vlm_json]
-    cands = [str(vlm_json[k]["description"]) for k in common_keys]
+    common_keys = [k for k in label_json if k in captions]
+    cands = [captions[k] for k in common_keys]
     refs = [str(label_json[k]["description"]) for k in common_keys]
     
-    tqdm.write(f"Scoring {len(cands)} samples...")
-    P, R, F1 = statistical_BERTScore(cands, refs, chunk=args.chunk, chunk_size=args.chunk_size)
-
-    bert_score_json = {}
-    for i, key in enumerate(common_keys):
-        bert_score_json[key] = {
-            "P": P[i].item(),
-            "R": R[i].item(),
-            "F1": F1[i].item()
+    scorer = bert_scorer_from_args(args)
+    previous, changed = {}, common_keys
+    if args.incremental:
+        # IDF weights are computed on all references, so with --bertscore_idf they are part of the config
+        config = {
+            "model": args.bertscore_model, "num_layers": args.bertscore_num_layers, "baseline_path": args.bertscore_baseline_path,
+            "dtype": args.bertscore_dtype, "idf": fingerprint(refs) if args.bertscore_idf else False,
         }
+        state = EvaluationState(save_BertScore_dir, config)
+        fingerprints = {key: fingerprint(cand, ref) for key, cand, ref in zip(common_keys, cands, refs)}
+        per_sample_path = os.path.join(save_BertScore_dir, "per_sample.json")
+        if state.exists and os.path.exists(per_sample_path):
+            previous = load_data(per_sample_path)
+            changed = state.changed(fingerprints, previous)
+        tqdm.write(incremental_summary(f"{args.subtask} - BERTScore - {args.model_name}", len(changed), len(common_keys), len(set(previous) - set(common_keys))))
+    
+    positions = {key: i for i, key in enumerate(common_keys)}
+    updated = {}
+    if changed:
+        tqdm.write(f"Scoring {len(changed)} samples...")
+        P, R, F1 = statistical_BERTScore(
+            [cands[positions[key]] for key in changed], [refs[positions[key]] for key in changed], scorer,
+            chunk=args.chunk, chunk_size=args.chunk_size, idf_refs=refs if args.incremental else None,
+        )
+        tqdm.write(scorer.summary())
+        for i, key in enumerate(changed):
+            updated[key] = {
+                "P": P[i].item(),
+                "R": R[i].item(),
+                "F1": F1[i].item()
+            }
+    bert_score_json = merge_per_sample(previous, updated, common_keys)
     save_json_data(bert_score_json, save_BertScore_dir, "per_sample.json", title=f"{args.task} - {args.subtask} - {args.model_name}")
+    if args.incremental:
+        state.save(fingerprints)
 
     # 2. calculate the average score
     model_summary_BERTScore = {}
@@ -298,15 +317,17 @@ def run_captioning_evaluation(model: BaseModel, yaml_cfg, args):
     save_json_data(model_summary_BERTScore, save_BertScore_dir, "per_sample_summary.json", title=f"{args.task} - {args.subtask} - {args.model_name}")
     
     # 3. generate the confusion matrix
-    generate_captioning_confusion_matrix(model, yaml_cfg, args)
+    stale = generate_captioning_confusion_matrix(model, yaml_cfg, args, label_json)
     
-    merge_captioning_json = load_captioning_data()
     confusion_json_path = os.path.join(args.project_root, args.save_root_dir, args.task, args.subtask, args.model_name, "results.json")
-    confusion_json = load_data(confusion_json_path)
+    confusion_json = {
+        key: {name: value[name] for name in ("TP", "FP", "FN", "TN") if name in value}
+        for key, value in iter_data(confusion_json_path) if key in label_json
+    }
     
     model_summary_confusion = defaultdict(dict)
-    for key, value in tqdm(merge_captioning_json.items(), total=len(merge_captioning_json), dynamic_ncols=True, desc=f"{args.model_name}"):
-        if key not in confusion_json:
+    for key, value in tqdm(label_json.items(), total=len(label_json), dynamic_ncols=True, desc=f"{args.model_name}"):
+        if key not in confusion_json or key in stale:
             continue
         try:
             confusion = {
@@ -325,5 +346,7 @@ def run_captioning_evaluation(model: BaseModel, yaml_cfg, args):
     save_json_data(model_summary_confusion, save_confusion_dir, "confusion_matrix.json", title=f"{args.task} - {args.subtask} - {args.model_name}")
     
     # 4. MetaDent, DS1, DS2, DS3
-    calculated_all_matrice(bert_score_json, distribution, save_BertScore_dir, args)
-    calculated_all_matrice(model_summary_confusion, distribution, save_confusion_dir, args)
+    return {
+        "BertScore": calculated_all_matrice(bert_score_json, distribution, save_BertScore_dir, args),
+        "confusion_matrix": calculated_all_matrice(model_summary_confusion, distribution, save_confusion_dir, args),
+    }
@@ -1,20 +1,22 @@
 import os
 from argparse import Namespace
-from collections import defaultdict
-from decimal import Decimal
+from typing import Dict, Iterable, Sequence, Tuple
 
+import numpy as np
 import pandas as pd
-from sklearn.metrics import confusion_matrix, f1_score, precision_score, recall_score
 from tqdm import tqdm
 
+from src.utils.aggregation import DatasetGroups, field, quantize
+from src.utils.eval_state import EvaluationState, fingerprint, incremental_summary
 from src.utils.file_io import (
+    iter_data,
     load_classification_data,
-    load_data,
     load_distribution_data,
     save_csv_data,
     save_json_data,
 )
 
+CLASSIFICATION_CATEGORIES = ['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8', 'C9', 'C10', 'C11', 'C12', 'C13', 'C14', 'C15', 'C16', 'C17', 'C18']
 
 def compute_confusion_matrix(reference, prediction, all_labels=None):
     try:
@@ -67,263 +69,239 @@ def compute_metrics(confusion_dict):
     }
 
 def calculate_all_metrics(model_json: dict, distribution: dict, save_dir: str, args: Namespace):
-    model_summary = defaultdict(dict)
-    classification_categories = ['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'C7', 'C8', 'C9', 'C10', 'C11', 'C12', 'C13', 'C14', 'C15', 'C16', 'C17', 'C18']
-    for key, item in tqdm(model_json.items(), total=len(model_json), dynamic_ncols=True, desc=f"{args.model_name}"):
-        for dataset_name, ids in distribution.items():
-            if key in ids:
-                if not model_summary[dataset_name]:
-                    model_summary[dataset_name] = defaultdict(dict)
-                if not model_summary[dataset_name][args.model_name]:
-                    model_summary[dataset_name][args.model_name] = defaultdict(float)
-                    for category in classification_categories:
-                        model_summary[dataset_name][args.model_name][category] = 0
-                        model_summary[dataset_name][args.model_name][f"{category}_cnt"] = 0
-                        model_summary[dataset_name][args.model_name][f"Avg_{category}"] = 0
-                    model_summary[dataset_name][args.model_name][f"total_C_cnt"] = 0
-                if not model_summary[args.model_name]:
-                    model_summary[args.model_name] = defaultdict(float)
-                    for category in classification_categories:
-                        model_summary[args.model_name][category] = 0
-                        model_summary[args.model_name][f"{category}_cnt"] = 0
-                        model_summary[args.model_name][f"Avg_{category}"] = 0
-                    model_summary[args.model_name][f"total_C_cnt"] = 0
-                
-                # DS1, DS2, DS3
-                for category in classification_categories:
-                    if item[category] is None:
-                        continue
-                    model_summary[dataset_name][args.model_name][category] += item[category]
-                    model_summary[dataset_name][args.model_name][f"{category}_cnt"] += 1
-                    model_summary[dataset_name][args.model_name][f"total_C_cnt"] += 1
-                    model_summary[dataset_name][args.model_name][f"Avg_{category}"] = model_summary[dataset_name][args.model_name][category] / model_summary[dataset_name][args.model_name][f"{category}_cnt"]
-                model_summary[dataset_name][args.model_name]["total_P"] += item["P"]
-                model_summary[dataset_name][args.model_name]["total_R"] += item["R"]
-                model_summary[dataset_name][args.model_name]["total_F1"] += item["F1"]
-                model_summary[dataset_name][args.model_name]["total_Exact_Match"] += item["Exact_Match"]
-                model_summary[dataset_name][args.model_name]["count"] += 1
-                
-                model_summary[dataset_name][args.model_name]["Avg_P"] =  model_summary[dataset_name][args.model_name]["total_P"] / model_summary[dataset_name][args.model_name]["count"]
-                model_summary[dataset_name][args.model_name]["Avg_R"] =  model_summary[dataset_name][args.model_name]["total_R"] / model_summary[dataset_name][args.model_name]["count"]
-                model_summary[dataset_name][args.model_name]["Avg_F1"] =  model_summary[dataset_name][args.model_name]["total_F1"] / model_summary[dataset_name][args.model_name]["count"]
-                model_summary[dataset_name][args.model_name]["Avg_Exact_Match"] =  model_summary[dataset_name][args.model_name]["total_Exact_Match"] / model_summary[dataset_name][args.model_name]["count"]
-            
-                # MetaDent
-                for category in classification_categories:
-                    if item[category] is None:
-                        continue
-                    model_summary[args.model_name][category] += item[category]
-                    model_summary[args.model_name][f"{category}_cnt"] += 1
-                    model_summary[args.model_name][f"total_C_cnt"] += 1
-                    model_summary[args.model_name][f"Avg_{category}"] = model_summary[args.model_name][category] / model_summary[args.model_name][f"{category}_cnt"]
-                model_summary[args.model_name]["total_P"] += item["P"]
-                model_summary[args.model_name]["total_R"] += item["R"]
-                model_summary[args.model_name]["total_F1"] += item["F1"]
-                model_summary[args.model_name]["total_Exact_Match"] += item["Exact_Match"]
-                model_summary[args.model_name]["count"] += 1
-                
-                model_summary[args.model_name]["Avg_P"] =  model_summary[args.model_name]["total_P"] / model_summary[args.model_name]["count"]
-                model_summary[args.model_name]["Avg_R"] =  model_summary[args.model_name]["total_R"] / model_summary[args.model_name]["count"]
-                model_summary[args.model_name]["Avg_F1"] =  model_summary[args.model_name]["total_F1"] / model_summary[args.model_name]["count"]
-                model_summary[args.model_name]["Avg_Exact_Match"] =  model_summary[args.model_name]["total_Exact_Match"] / model_summary[args.model_name]["count"]
-                
-                # Keep three decimal places
-                point = '0.000'
-                model_summary[dataset_name][args.model_name]["Avg_P_decimal"] = float(Decimal(str(model_summary[dataset_name][args.model_name]["Avg_P"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                model_summary[dataset_name][args.model_name]["Avg_R_decimal"] = float(Decimal(str(model_summary[dataset_name][args.model_name]["Avg_R"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                model_summary[dataset_name][args.model_name]["Avg_F1_decimal"] = float(Decimal(str(model_summary[dataset_name][args.model_name]["Avg_F1"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                model_summary[dataset_name][args.model_name]["Avg_Exact_Match_decimal"] = float(Decimal(str(model_summary[dataset_name][args.model_name]["Avg_Exact_Match"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                
-                model_summary[args.model_name]["Avg_P_decimal"] = float(Decimal(str(model_summary[args.model_name]["Avg_P"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                model_summary[args.model_name]["Avg_R_decimal"] = float(Decimal(str(model_summary[args.model_name]["Avg_R"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                model_summary[args.model_name]["Avg_F1_decimal"] = float(Decimal(str(model_summary[args.model_name]["Avg_F1"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                model_summary[args.model_name]["Avg_Exact_Match_decimal"] = float(Decimal(str(model_summary[args.model_name]["Avg_Exact_Match"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                
-                break
+    groups = DatasetGroups(model_json.keys(), distribution)
+    items = list(model_json.values())
+    # categories without a label (None) are not counted
+    category_sums = {category: groups.sum(field(items, category, default=0)) for category in CLASSIFICATION_CATEGORIES}
+    category_cnts = {category: groups.sum([item[category] is not None for item in items]) for category in CLASSIFICATION_CATEGORIES}
+    sums = {name: groups.sum(field(items, name)) for name in ("P", "R", "F1", "Exact_Match")}
+    counts = groups.count()
     
+    def build(i: int) -> dict:
+        res = {}
+        total_C_cnt = 0
+        for category in CLASSIFICATION_CATEGORIES:
+            res[category] = int(category_sums[category][i])
+            res[f"{category}_cnt"] = int(category_cnts[category][i])
+            res[f"Avg_{category}"] = res[category] / res[f"{category}_cnt"] if res[f"{category}_cnt"] else 0
+            total_C_cnt += res[f"{category}_cnt"]
+        res["total_C_cnt"] = total_C_cnt
+        res["total_P"] = float(sums["P"][i])
+        res["total_R"] = float(sums["R"][i])
+        res["total_F1"] = float(sums["F1"][i])
+        res["total_Exact_Match"] = float(sums["Exact_Match"][i])
+        res["count"] = float(counts[i])
+        
+        res["Avg_P"] = res["total_P"] / res["count"]
+        res["Avg_R"] = res["total_R"] / res["count"]
+        res["Avg_F1"] = res["total_F1"] / res["count"]
+        res["Avg_Exact_Match"] = res["total_Exact_Match"] / res["count"]
+        
+        # Keep three decimal places
+        res["Avg_P_decimal"] = quantize(res["Avg_P"])
+        res["Avg_R_decimal"] = quantize(res["Avg_R"])
+        res["Avg_F1_decimal"] = quantize(res["Avg_F1"])
+        res["Avg_Exact_Match_decimal"] = quantize(res["Avg_Exact_Match"])
+        return res
+    
+    # DS1, DS2, DS3 and MetaDent
+    model_summary = groups.summary(args.model_name, build)
     save_json_data(model_summary, save_dir, "results.json", title=f"{args.task} - {args.subtask} - {args.model_name}")
+    return model_summary
 
 
-def run_classification_evaluation(args):
-    distribution_json = load_distribution_data()
-    label_json = load_classification_data()
-    # 18-class
-    cls_labels = set(["C1", "C2", "C3", "C4", "C5", "C6", "C7", "C8", "C9", "C10", "C11", "C12", "C13", "C14", "C15", "C16", "C17", "C18"])
+def parse_prediction(prediction: list, cls_labels: set) -> set:
+    """Category ids predicted for one sample."""
+    ids = set()
+    for item in prediction:
+        try:
+            if not item or isinstance(item, str):
+                continue
+            if isinstance(item, list):
+                for tmp in item:
+                    if "id" in tmp:
+                        ids.add(tmp["id"])
+                    elif "1" in tmp:
+                        ids.add(tmp["1"])
+                    else:
+                        raise Exception("")
+            else:
+                if "id" in item:
+                    ids.add(item["id"])
+                elif "1" in item:
+                    ids.add(item["1"])
+                else:
+                    raise Exception("")
+        except Exception as e:
+            # There are other error formats, directly through string matching.
+            s = str(prediction)
+            for l in cls_labels:
+                if l in s:
+                    ids.add(l)
+            break
+    return ids
+
+def multi_hot(label_sets: Sequence[Iterable[str]], categories: Sequence[str] = CLASSIFICATION_CATEGORIES) -> np.ndarray:
+    """N x len(categories) uint8 matrix, 1 where a sample has the category. Other labels are ignored."""
+    column = {c: j for j, c in enumerate(categories)}
+    hot = np.zeros((len(label_sets), len(categories)), dtype=np.uint8)
+    for i, labels in enumerate(label_sets):
+        for label in labels:
+            j = column.get(label)
+            if j is not None:
+                hot[i, j] = 1
+    return hot
+
+def _safe_divide(numerator, denominator) -> np.ndarray:
+    """numerator / denominator as float64, 0.0 where the denominator is 0."""
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+def sample_metrics(reference: np.ndarray, prediction: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    `compute_confusion_matrix` + `compute_metrics` for every row of two multi-hot matrices.
     
-    # df_not_exact_match = pd.DataFrame(columns=["ID", "Label", "Prediction"])
-    # df_exact_match = pd.DataFrame(columns=["ID", "Label", "Prediction"])
-    df_per_class_acc = pd.DataFrame(columns=["ID", "Label", "Prediction", "C1", "C2", "C3", "C4", "C5", "C6", "C7", "C8", "C9", "C10", "C11", "C12", "C13", "C14", "C15", "C16", "C17", "C18"])
+    Returns:
+        dict: TP, FN, FP, Exact_Match, P, R and F1, one value per sample.
+    """
+    ref, pred = reference.astype(bool), prediction.astype(bool)
+    tp = (ref & pred).sum(axis=1)
+    fn = (ref & ~pred).sum(axis=1)
+    fp = (~ref & pred).sum(axis=1)
+    exact_match = ((fn == 0) & (fp == 0)).astype(np.int64)
+    # an empty label predicted as empty counts as one true positive
+    tp = np.where(~ref.any(axis=1) & ~pred.any(axis=1), 1, tp)
+    
+    precision = _safe_divide(tp, tp + fp)
+    recall = _safe_divide(tp, tp + fn)
+    f1 = _safe_divide(2 * precision * recall, precision + recall)
+    return {"TP": tp, "FN": fn, "FP": fp, "Exact_Match": exact_match, "P": precision, "R": recall, "F1": f1}
+
+def class_metrics(reference: np.ndarray, prediction: np.ndarray, categories: Sequence[str] = CLASSIFICATION_CATEGORIES) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Per-class confusion and P/R/F1, and their macro/micro averages, with the same definitions
+    as sklearn's `confusion_matrix`/`precision_score`/`recall_score`/`f1_score` (zero_division=0).
+    
+    Returns:
+        tuple: (classwise metrics, overall metrics) data frames.
+    """
+    ref, pred = reference.astype(bool), prediction.astype(bool)
+    tp = (ref & pred).sum(axis=0)
+    fp = (~ref & pred).sum(axis=0)
+    fn = (ref & ~pred).sum(axis=0)
+    tn = len(ref) - tp - fp - fn
+    df_result = pd.DataFrame({
+        "Class": list(categories),
+        "TP": tp,
+        "FP": fp,
+        "FN": fn,
+        "TN": tn,
+        "Precision": _safe_divide(tp, tp + fp),
+        "Recall": _safe_divide(tp, tp + fn),
+        "F1": _safe_divide(2 * tp, 2 * tp + fp + fn),
+    })
+    
+    tp, fp, fn = tp.sum(), fp.sum(), fn.sum()
+    summary = pd.DataFrame({
+        "Metric": ["Macro", "Micro"],
+        "Precision": [df_result["Precision"].mean(), float(_safe_divide(tp, tp + fp))],
+        "Recall": [df_result["Recall"].mean(), float(_safe_divide(tp, tp + fn))],
+        "F1": [df_result["F1"].mean(), float(_safe_divide(2 * tp, 2 * tp + fp + fn))]
+    })
+    return df_result, summary
+
+def run_classification_evaluation(args, label_json: dict = None, distribution_json: dict = None) -> dict:
+    """
+    Evaluate the classification predictions of `args.model_name`. `label_json` and
+    `distribution_json` are loaded from data/ unless given (a sweep loads them once for all models).
+
+    Returns:
+        dict: {metric directory: summary of results.json}.
+    """
+    if distribution_json is None:
+        distribution_json = load_distribution_data()
+    if label_json is None:
+        label_json = load_classification_data()
+    # 18-class
+    cls_labels = set(CLASSIFICATION_CATEGORIES)
     data_path = os.path.join(args.project_root, args.save_root_dir, "prediction", args.subtask, args.model_name, "results.json")
-    model_json = load_data(data_path)
     
-    per_sample = defaultdict(dict)
-    columns = ["ID"] + [f"C{i}" for i in range(1, 19)]
-    rows = []
-    for id_, labels in tqdm(label_json.items(), total=len(label_json), dynamic_ncols=True, desc=f"{args.model_name}"):
-        row = {"ID": id_}
-        for i in range(1, 19):
-            label = f"C{i}"
-            row[label] = 1 if label in labels else 0
-        rows.append(row)
-    df = pd.DataFrame(rows, columns=columns)
-    rows = []
-    gt = df.copy()
+    save_dir = os.path.join(args.project_root, "metric", args.subtask, "Exact_Match", args.model_name)
     
-    for key, value in tqdm(label_json.items(), total=len(label_json), dynamic_ncols=True, desc=f"{args.model_name}"):
-        if key not in model_json:
+    # parsing the raw predictions is the per-sample work, the metrics below are vectorized;
+    # the predictions are streamed and parsed as they are read, with --incremental only new
+    # or changed predictions are parsed again
+    state = EvaluationState(save_dir) if args.incremental else None
+    parsed = state.payloads if state is not None and state.exists else {}
+    sample_fingerprints, parsed_predictions, changed = {}, {}, set()
+    for key, prediction in tqdm(iter_data(data_path), dynamic_ncols=True, desc=f"{args.model_name}", unit="sample"):
+        if key not in label_json:
             continue
-        
-        ids = set()
-        for item in model_json[key]:
-            try:
-                if not item or isinstance(item, str):
-                    continue
-                if isinstance(item, list):
-                    for tmp in item:
-                        if "id" in tmp:
-                            ids.add(tmp["id"])
-                        elif "1" in tmp:
-                            ids.add(tmp["1"])
-                        else:
-                            raise Exception("")
-                else:
-                    if "id" in item:
-                        ids.add(item["id"])
-                    elif "1" in item:
-                        ids.add(item["1"])
-                    else:
-                        raise Exception("")
-            except Exception as e:
-                # There are other error formats, directly through string matching.
-                s = str(model_json[key])
-                for l in cls_labels:
-                    if l in s:
-                        ids.add(l)
-                break
-        confusion = compute_confusion_matrix(value, list(ids))
-        row = {"ID": key}
-        for i in range(1, 19):
-            label = f"C{i}"
-            row[label] = 1 if label in ids else 0
-        rows.append(row)
-        
-        df_per_class_acc = pd.concat([
-            df_per_class_acc,
-            pd.DataFrame([{
-                "ID": str(key), 
-                "Label": "#".join(value) if value else "None", 
-                "Prediction": "#".join(list(ids)) if list(ids) else "None", 
-                "C1": confusion["C1"] if confusion["C1"] is not None else 1, 
-                "C2": confusion["C2"] if confusion["C2"] is not None else 1, 
-                "C3": confusion["C3"] if confusion["C3"] is not None else 1, 
-                "C4": confusion["C4"] if confusion["C4"] is not None else 1, 
-                "C5": confusion["C5"] if confusion["C5"] is not None else 1, 
-                "C6": confusion["C6"] if confusion["C6"] is not None else 1, 
-                "C7": confusion["C7"] if confusion["C7"] is not None else 1, 
-                "C8": confusion["C8"] if confusion["C8"] is not None else 1, 
-                "C9": confusion["C9"] if confusion["C9"] is not None else 1, 
-                "C10": confusion["C10"] if confusion["C10"] is not None else 1, 
-                "C11": confusion["C11"] if confusion["C11"] is not None else 1, 
-                "C12": confusion["C12"] if confusion["C12"] is not None else 1, 
-                "C13": confusion["C13"] if confusion["C13"] is not None else 1, 
-                "C14": confusion["C14"] if confusion["C14"] is not None else 1, 
-                "C15": confusion["C15"] if confusion["C15"] is not None else 1, 
-                "C16": confusion["C16"] if confusion["C16"] is not None else 1, 
-                "C17": confusion["C17"] if confusion["C17"] is not None else 1, 
-                "C18": confusion["C18"] if confusion["C18"] is not None else 1
-            }])
-        ], ignore_index=True)
-        
-        # # Record the pictures that are not completely matched
-        # if key in distribution_json["DS2"]:
-        #     if confusion["Exact_Match"] != 1:
-        #         df_not_exact_match = pd.concat([
-        #             df_not_exact_match,
-        #             pd.DataFrame([{"ID": str(key), "Label": "#".join(value) if value else "None", "Prediction": "#".join(list(ids)) if list(ids) else "None"}])
-        #         ], ignore_index=True)
-        #     else:
-        #         df_exact_match = pd.concat([
-        #             df_exact_match,
-        #             pd.DataFrame([{"ID": str(key), "Label": "#".join(value) if value else "None", "Prediction": "#".join(list(ids)) if list(ids) else "None"}])
-        #         ], ignore_index=True)
-        
-        metrics = compute_metrics(confusion)
-        confusion.update(metrics)
-        per_sample[key] = confusion
+        sample_fingerprints[key] = fingerprint(label_json[key], prediction)
+        if state is None or key not in parsed or state.changed({key: sample_fingerprints[key]}):
+            parsed_predictions[key] = parse_prediction(prediction, cls_labels)
+            changed.add(key)
+        else:
+            parsed_predictions[key] = set(parsed[key])
+            changed.discard(key)
     
-    save_result_dir = os.path.join(args.project_root, "metric", args.subtask, "Exact_Match", args.model_name)
-    save_json_data(per_sample, save_result_dir, "per_sample.json", title=f"{args.task} - {args.subtask} - {args.model_name}")
+    keys, references, predictions = [], [], []
+    for key, value in label_json.items():
+        if key not in parsed_predictions:
+            continue
+        keys.append(key)
+        references.append(value)
+        predictions.append(parsed_predictions[key])
+    fingerprints = {key: sample_fingerprints[key] for key in keys}
+    if state is not None:
+        tqdm.write(incremental_summary(f"{args.subtask} - {args.model_name}", len(changed), len(keys), len(set(parsed) - set(keys))))
+        state.save(fingerprints, {key: sorted(prediction) for key, prediction in zip(keys, predictions)})
     
-    save_dir = os.path.join(args.project_root, "metric", args.subtask, "Exact_Match", args.model_name)
+    # everything below is computed on the two N x 18 multi-hot matrices
+    ref = multi_hot(references)
+    pred = multi_hot(predictions)
+    
+    metrics = {name: values.tolist() for name, values in sample_metrics(ref, pred).items()}
+    hits = np.where(ref == 1, pred.astype(np.int8), -1).tolist()
+    per_sample = {}
+    for i, key in enumerate(keys):
+        if not cls_labels.issuperset(references[i]) or not cls_labels.issuperset(predictions[i]):
+            # labels outside C1-C18 also count as FN/FP
+            confusion = compute_confusion_matrix(references[i], list(predictions[i]))
+            confusion.update(compute_metrics(confusion))
+        else:
+            confusion = {c: None if hit < 0 else hit for c, hit in zip(CLASSIFICATION_CATEGORIES, hits[i])}
+            confusion.update({
+                "TP": metrics["TP"][i],
+                "FN": metrics["FN"][i],
+                "FP": metrics["FP"][i],
+                "TN": None,
+                "Exact_Match": metrics["Exact_Match"][i],
+                "P": metrics["P"][i],
+                "R": metrics["R"][i],
+                "F1": metrics["F1"][i],
+            })
+        per_sample[key] = confusion
+    
+    save_json_data(per_sample, save_dir, "per_sample.json", title=f"{args.task} - {args.subtask} - {args.model_name}")
     
     # [Classification] P, R, F1
-    pred = pd.DataFrame(rows, columns=columns)
-    save_csv_data(pred, save_dir, "results.csv", title=f"{args.task} - {args.subtask} - {args.model_name}")
-    common_ids = set(gt["ID"]) & set(pred["ID"])
-    gt = gt[gt["ID"].isin(common_ids)].set_index("ID")
-    pred = pred[pred["ID"].isin(common_ids)].set_index("ID")
-    cols = [c for c in gt.columns if c.startswith("C")]
-    results = []
-    for c in cols:
-        y_true = gt[c]
-        y_pred = pred[c]
-        tn, fp, fn, tp = confusion_matrix(y_true, y_pred, labels=[0, 1]).ravel()
-        precision = precision_score(y_true, y_pred, zero_division=0)
-        recall = recall_score(y_true, y_pred, zero_division=0)
-        f1 = f1_score(y_true, y_pred, zero_division=0)
-        results.append({
-            "Class": c,
-            "TP": tp,
-            "FP": fp,
-            "FN": fn,
-            "TN": tn,
-            "Precision": precision,
-            "Recall": recall,
-            "F1": f1
-        })
-    df_result = pd.DataFrame(results)
-    macro_P = df_result["Precision"].mean()
-    macro_R = df_result["Recall"].mean()
-    macro_F1 = df_result["F1"].mean()
-    micro_P = precision_score(gt[cols].values.flatten(), pred[cols].values.flatten(), zero_division=0)
-    micro_R = recall_score(gt[cols].values.flatten(), pred[cols].values.flatten(), zero_division=0)
-    micro_F1 = f1_score(gt[cols].values.flatten(), pred[cols].values.flatten(), zero_division=0)
-    summary = pd.DataFrame({
-        "Metric": ["Macro", "Micro"],
-        "Precision": [macro_P, micro_P],
-        "Recall": [macro_R, micro_R],
-        "F1": [macro_F1, micro_F1]
-    })
+    df_pred = pd.DataFrame(pred, columns=CLASSIFICATION_CATEGORIES)
+    df_pred.insert(0, "ID", keys)
+    save_csv_data(df_pred, save_dir, "results.csv", title=f"{args.task} - {args.subtask} - {args.model_name}")
+    df_result, summary = class_metrics(ref, pred)
     save_csv_data(df_result, save_dir, "classwise_metrics.csv", title=f"{args.task} - {args.subtask} - {args.model_name}")
     save_csv_data(summary, save_dir, "overall_metrics.csv", title=f"{args.task} - {args.subtask} - {args.model_name}")
     
-    # Calculate the accuracy of each category
-    df_per_class_acc = pd.concat([
-        df_per_class_acc,
-        pd.DataFrame([{
-            "ID": "Accuracy", 
-            "Label": "Accuracy", 
-            "Prediction": "Accuracy", 
-            "C1": df_per_class_acc["C1"].mean(), 
-            "C2": df_per_class_acc["C2"].mean(), 
-            "C3": df_per_class_acc["C3"].mean(), 
-            "C4": df_per_class_acc["C4"].mean(), 
-            "C5": df_per_class_acc["C5"].mean(), 
-            "C6": df_per_class_acc["C6"].mean(), 
-            "C7": df_per_class_acc["C7"].mean(), 
-            "C8": df_per_class_acc["C8"].mean(), 
-            "C9": df_per_class_acc["C9"].mean(), 
-            "C10": df_per_class_acc["C10"].mean(), 
-            "C11": df_per_class_acc["C11"].mean(), 
-            "C12": df_per_class_acc["C12"].mean(), 
-            "C13": df_per_class_acc["C13"].mean(), 
-            "C14": df_per_class_acc["C14"].mean(), 
-            "C15": df_per_class_acc["C15"].mean(), 
-            "C16": df_per_class_acc["C16"].mean(), 
-            "C17": df_per_class_acc["C17"].mean(), 
-            "C18": df_per_class_acc["C18"].mean()
-        }])
-    ])
+    # Calculate the accuracy of each category, a category absent from the label counts as correct
+    per_class_acc = np.where(ref == 1, pred, 1)
+    rows = [
+        [str(key), "#".join(value) if value else "None", "#".join(list(ids)) if ids else "None", *acc]
+        for key, value, ids, acc in zip(keys, references, predictions, per_class_acc.tolist())
+    ]
+    rows.append(["Accuracy", "Accuracy", "Accuracy", *per_class_acc.mean(axis=0).tolist()])
+    df_per_class_acc = pd.DataFrame(rows, columns=["ID", "Label", "Prediction", *CLASSIFICATION_CATEGORIES], dtype=object)
     save_csv_data(df_per_class_acc, save_dir, "per_class_acc.csv", title=f"{args.task} - {args.subtask} - {args.model_name}")
     
-    calculate_all_metrics(per_sample, distribution_json, save_dir, args)
+    return {"Exact_Match": calculate_all_metrics(per_sample, distribution_json, save_dir, args)}
@@ -1,57 +1,93 @@
-import json
-import os
+import asyncio
 from argparse import Namespace
-from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from tqdm import tqdm
 
 from src.models.base_model import BaseModel
 from src.utils import prompt
+from src.utils.async_utils import run_async_tasks
 from src.utils.common_utils import confirm_restart_if_exists, strip_trailing_slash
-from src.utils.file_io import convert_jsonl_to_json, load_completed_indices
-from src.utils.lfss_io import LabelReader, SkipReader
+from src.utils.file_io import (
+    convert_jsonl_to_json,
+    load_completed_indices,
+    open_output,
+    write_task_output,
+)
+from src.utils.lfss_mirror import meta_batch_reader
+from src.utils.pipeline import Finished, Pipeline, Stage, stage_workers
+from src.utils.prompt_builder import build_prompt
+from src.utils.translation_store import async_translate_case, translate_case
 
 
-def task(idx: str, model: BaseModel, lbl_meta_dir: str, args: Namespace) -> dict:
-    r = SkipReader(lbl_meta_dir=lbl_meta_dir)
-    skip = r.get(idx)
-    if skip is not None:
-        return None
+def fetch_label(idx: str, lbl_meta_dir: str, args: Namespace):
+    """Pipeline stage: skip and label in one request."""
+    meta = meta_batch_reader(lbl_meta_dir).get([idx], fields=("skip", "label"))[idx]
+    if meta.skip is not None:
+        return Finished(None)
     
-    r = LabelReader(lbl_meta_dir=lbl_meta_dir)
-    label = r.get(idx)
+    label = meta.label
     if label is None:
-        return None
+        return Finished(None)
     
     label = label.compact_json()
+    return {"idx": idx, "label": label, "case_en": None if args.lfss_meta_type == "cn" else label}
+
+def drop_retractor_items(label: dict) -> dict:
+    """Drop the items that only mention the retractor (拉钩)."""
+    label["items"] = [entry for entry in label['items'] if not ("拉钩" in entry['description'] and not ("," in entry['description'] or "，" in entry['description']))]
+    return label
+
+def translate_label(item: dict, model: BaseModel) -> dict:
+    """Pipeline stage (cn labels): zh->en translation of the label."""
+    item["case_en"] = translate_case(drop_retractor_items(item["label"]), model)
+    return item
+
+def classify_prompt(case_en: dict, model: BaseModel) -> str:
+    return build_prompt(prompt.classify_intraoral_condition,
+        label_desc=prompt.label_desc_en_json,
+        case=model.j2t(case_en)
+    )
+
+def classified_output(item: dict, res: list) -> dict:
+    return {
+        "case_en": {item["idx"]: item["case_en"]},
+        "res": {item["idx"]: res}
+    }
+
+def classify_case(item: dict, model: BaseModel) -> dict:
+    """Pipeline stage: classify the case, the last stage returns the task output."""
+    res = model.generate_from_text(prompt=classify_prompt(item["case_en"], model), output_type=list)
+    return classified_output(item, res)
+
+def failed_output(item: dict, e: Exception) -> dict:
+    case_en = item["case_en"]
+    return {
+        "case_en": {item["idx"]: case_en if case_en else {"failed": str(e)}},
+        "res": {item["idx"]: {"failed": str(e)}}
+    }
+
+async def async_translate_label(item: dict, model: BaseModel) -> dict:
+    """Coroutine version of translate_label()."""
+    item["case_en"] = await async_translate_case(drop_retractor_items(item["label"]), model)
+    return item
+
+async def async_classify_case(item: dict, model: BaseModel) -> dict:
+    """Coroutine version of classify_case()."""
+    res = await model.generate_from_text(prompt=classify_prompt(item["case_en"], model), output_type=list)
+    return classified_output(item, res)
+
+async def async_task(idx: str, model: BaseModel, lbl_meta_dir: str, args: Namespace) -> dict:
+    """The stages of one sample in one coroutine, for AsyncAPIModel; the LFSS read runs in a worker thread."""
+    item = await asyncio.to_thread(fetch_label, idx, lbl_meta_dir, args)
+    if isinstance(item, Finished):
+        return item.output
     
-    case_en = None
     try:
         if args.lfss_meta_type == "cn":
-            label["items"] = [item for item in label['items'] if not ("拉钩" in item['description'] and not ("," in item['description'] or "，" in item['description']))]
-            p = prompt.translate_dent_json_zh2en.substitute(
-                case=model.j2t(label)
-                )
-            case_en = model.generate_from_text(prompt=p)
-        else:
-            case_en = label
-        
-        p = prompt.classify_intraoral_condition.substitute(
-            label_desc=model.j2t(prompt.label_desc_en),
-            case=model.j2t(case_en)
-        )
-        res = model.generate_from_text(prompt=p, output_type=list)
-        
-        return {
-            "case_en": {idx: case_en},
-            "res": {idx: res}
-        }
-    
+            item = await async_translate_label(item, model)
+        return await async_classify_case(item, model)
     except Exception as e:
-        return {
-            "case_en": {idx: case_en if case_en else {"failed": str(e)}},
-            "res": {idx: {"failed": str(e)}}
-        }
+        return failed_output(item, e)
 
 def run_classification_generation(model: BaseModel, yaml_cfg, args):
     completed = load_completed_indices(args)
@@ -67,32 +103,27 @@ def run_classification_generation(model: BaseModel, yaml_cfg, args):
             lbl_meta_dir=strip_trailing_slash(yaml_cfg["lfss"]["meta_cn_dir"])
         else:
             lbl_meta_dir=strip_trailing_slash(yaml_cfg["lfss"]["meta_en_dir"])
-        with open(args.outfile, "a", encoding="utf-8") as f_out, \
-            open(args.translatefile, "a", encoding="utf-8") as f_translate, \
-            open(args.failfile, "a", encoding="utf-8") as f_fail:
+        with open_output(args, "results") as f_out, \
+            open_output(args, "translate") as f_translate, \
+            open_output(args, "failures") as f_fail:
             
-            with ThreadPoolExecutor(max_workers=args.workers) as executor:
-                futures = {executor.submit(task, idx, model, lbl_meta_dir, args): idx for idx in pending}
-                
-                for future in tqdm(as_completed(futures), total=len(futures), desc="Processing", unit="task", dynamic_ncols=True):
-                    out = future.result()
-                    if out:
-                        case_en = out["case_en"]
-                        result = out["res"]
-                        if case_en:
-                            if "failed" in case_en or (isinstance(case_en, dict)and "failed" in case_en[list(case_en.keys())[0]]):
-                                f_fail.write(json.dumps(case_en, ensure_ascii=False) + "\n")
-                                f_fail.flush()
-                            else:
-                                f_translate.write(json.dumps(case_en, ensure_ascii=False) + "\n")
-                                f_translate.flush()
-                        if result:
-                            if "failed" in result or (isinstance(result, dict) and "failed" in result[list(result.keys())[0]]):
-                                f_fail.write(json.dumps(result, ensure_ascii=False) + "\n")
-                                f_fail.flush()
-                            else:
-                                f_out.write(json.dumps(result, ensure_ascii=False) + "\n")
-                                f_out.flush()
+            outputs = {"case_en": f_translate, "res": f_out}
+            if args.async_mode:
+                run_async_tasks(
+                    lambda idx: async_task(idx, model, lbl_meta_dir, args),
+                    pending,
+                    lambda out: write_task_output(out, outputs, f_fail),
+                    max_inflight=args.max_inflight,
+                )
+            else:
+                # LFSS reads, translation and generation overlap across samples
+                stages = [Stage("fetch", lambda idx: fetch_label(idx, lbl_meta_dir, args), stage_workers(args, "fetch"))]
+                if args.lfss_meta_type == "cn":
+                    stages.append(Stage("translate", lambda item: translate_label(item, model), stage_workers(args, "translate"), on_error=failed_output))
+                stages.append(Stage("generate", lambda item: classify_case(item, model), stage_workers(args, "generate"), on_error=failed_output))
+                pipeline = Pipeline(stages, queue_size=args.pipeline_queue_size, name="Classification generation")
+                pipeline.run(pending, lambda out: write_task_output(out, outputs, f_fail))
+                tqdm.write(pipeline.summary())
     
     convert_jsonl_to_json(args, jsonl_type="results")
     convert_jsonl_to_json(args, jsonl_type="translate")
@@ -1,4 +1,3 @@
-import json
 import os
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
@@ -6,30 +5,51 @@ from tqdm import tqdm
 
 from src.models.base_model import BaseModel
 from src.utils import prompt
+from src.utils.async_utils import run_async_tasks
 from src.utils.common_utils import confirm_restart_if_exists, strip_trailing_slash
 from src.utils.file_io import (
     convert_jsonl_to_json,
     load_classification_data,
     load_completed_indices,
+    open_output,
+    write_task_output,
 )
+from src.utils.prompt_builder import build_prompt
 
 
-def task(idx: str, image_dir: str, model: BaseModel) -> dict:
+def find_image(idx: str, image_dir: str) -> str:
+    """The .png image of the sample, else its .jpg; raise FileNotFoundError if neither exists."""
     image_path= os.path.join(image_dir, f"{idx}.png")
     if not os.path.exists(image_path):
         image_path= os.path.join(image_dir, f"{idx}.jpg")
     if not os.path.exists(image_path):
-        return {
-            "res": {idx: {"failed": f"Image file not found: {image_path}"}}
-        }
-    p = prompt.classify_intraoral_condition_for_image.substitute(label_desc=model.j2t(prompt.label_desc_en))
+        raise FileNotFoundError(f"Image file not found: {image_path}")
+    return image_path
+
+def classify_prompt() -> str:
+    return build_prompt(prompt.classify_intraoral_condition_for_image, label_desc=prompt.label_desc_en_json)
+
+def failed_output(idx: str, e: Exception) -> dict:
+    return {
+        "res": {idx: {"failed": str(e)}}
+    }
+
+def task(idx: str, image_dir: str, model: BaseModel) -> dict:
+    try:
+        res = model.generate_from_image_and_text(image_path=find_image(idx, image_dir), prompt=classify_prompt(), output_type=list)
+    except Exception as e:
+        return failed_output(idx, e)
+
+    return {
+        "res": {idx: res}
+    }
 
+async def async_task(idx: str, image_dir: str, model: BaseModel) -> dict:
+    """Coroutine version of task() for AsyncAPIModel."""
     try:
-        res = model.generate_from_image_and_text(image_path=image_path, prompt=p, output_type=list)
+        res = await model.generate_from_image_and_text(image_path=find_image(idx, image_dir), prompt=classify_prompt(), output_type=list)
     except Exception as e:
-        return {
-            "res": {idx: {"failed": str(e)}}
-        }
+        return failed_output(idx, e)
 
     return {
         "res": {idx: res}
@@ -39,34 +59,33 @@ def run_classification_prediction(model: BaseModel, yaml_cfg, args):
     # image_dir=yaml_cfg["lfss"]["image_dir"]
     image_dir=strip_trailing_slash(yaml_cfg["data"]["image_dir"])
     data = load_classification_data()
-    data_keys = set(data.keys())
     
     completed = load_completed_indices(args)
     completed = confirm_restart_if_exists(args, completed)
     all_indices = [f"{i:09d}" for i in range(args.start, args.end + 1)]
-    pending = [idx for idx in all_indices if idx not in completed and idx in data_keys]
+    pending = [idx for idx in all_indices if idx not in completed and idx in data]
     tqdm.write(f"Total tasks: {len(all_indices)} | Completed: {len(completed)} | Skipped: {len(all_indices) - len(completed) - len(pending)} | Pending: {len(pending)}")
     
     if not pending:
         print("All tasks already completed.")
     else:
-        with open(args.outfile, "a", encoding="utf-8") as f_out, \
-            open(args.failfile, "a", encoding="utf-8") as f_fail:
+        with open_output(args, "results") as f_out, \
+            open_output(args, "failures") as f_fail:
             
-            with ThreadPoolExecutor(max_workers=args.workers) as executor:
-                futures = {executor.submit(task, idx, image_dir, model): idx for idx in pending}
-                
-                for future in tqdm(as_completed(futures), total=len(futures), desc="Processing", unit="task", dynamic_ncols=True):
-                    out = future.result()
-                    if out:
-                        result = out["res"]
-                        if result:
-                            if "failed" in result or (isinstance(result, dict) and "failed" in result[list(result.keys())[0]]):
-                                f_fail.write(json.dumps(result, ensure_ascii=False) + "\n")
-                                f_fail.flush()
-                            else:
-                                f_out.write(json.dumps(result, ensure_ascii=False) + "\n")
-                                f_out.flush()
+            outputs = {"res": f_out}
+            if args.async_mode:
+                run_async_tasks(
+                    lambda idx: async_task(idx, image_dir, model),
+                    pending,
+                    lambda out: write_task_output(out, outputs, f_fail),
+                    max_inflight=args.max_inflight,
+                )
+            else:
+                with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                    futures = {executor.submit(task, idx, image_dir, model): idx for idx in pending}
+                    
+                    for future in tqdm(as_completed(futures), total=len(futures), desc="Processing", unit="task", dynamic_ncols=True):
+                        write_task_output(future.result(), outputs, f_fail)
     
     convert_jsonl_to_json(args, jsonl_type="results")
     convert_jsonl_to_json(args, jsonl_type="failures")
\ No newline at end of file
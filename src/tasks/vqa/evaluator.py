@@ -1,107 +1,99 @@
 import os
 from argparse import Namespace
-from collections import defaultdict
-from decimal import Decimal
 
+import pandas as pd
 from tqdm import tqdm
 
+from src.utils.aggregation import DatasetGroups, build_id_index, field, quantize
+from src.utils.eval_state import EvaluationState, fingerprint, incremental_summary, merge_per_sample
 from src.utils.file_io import (
+    iter_data,
     load_data,
     load_distribution_data,
     load_vqa_data,
     save_json_data,
+    save_parquet_data,
 )
+from src.utils.vqa_table import build_question_table, merge_question_tables, per_sample_accuracy
 
 
 def calculate_all_metrics(model_json: dict, distribution: dict, save_dir: str, args: Namespace):
-    model_summary = defaultdict(dict)
-    for key, item in tqdm(model_json.items(), total=len(model_json), dynamic_ncols=True, desc=f"{args.model_name}"):
-        for dataset_name, ids in distribution.items():
-            if key in ids:
-                if not model_summary[dataset_name]:
-                    model_summary[dataset_name] = defaultdict(dict)
-                if not model_summary[dataset_name][args.model_name]:
-                    model_summary[dataset_name][args.model_name] = defaultdict(float)
-                if not model_summary[args.model_name]:
-                    model_summary[args.model_name] = defaultdict(float)
-                
-                # DS1, DS2, DS3
-                model_summary[dataset_name][args.model_name]["multiple_choice_acc_count"] += item["multiple_choice_acc_count"]
-                model_summary[dataset_name][args.model_name]["multiple_choice_count"] += item["multiple_choice_count"]
-                model_summary[dataset_name][args.model_name]["multiple_choice_acc"] = model_summary[dataset_name][args.model_name]["multiple_choice_acc_count"] / model_summary[dataset_name][args.model_name]["multiple_choice_count"] if model_summary[dataset_name][args.model_name]["multiple_choice_count"] else 1
-                
-                model_summary[dataset_name][args.model_name]["judge_acc_count"] += item["judge_acc_count"]
-                model_summary[dataset_name][args.model_name]["judge_count"] += item["judge_count"]
-                model_summary[dataset_name][args.model_name]["judge_acc"] = model_summary[dataset_name][args.model_name]["judge_acc_count"] / model_summary[dataset_name][args.model_name]["judge_count"] if model_summary[dataset_name][args.model_name]["judge_count"] else 1
-                
-                model_summary[dataset_name][args.model_name]["total_acc"] = (model_summary[dataset_name][args.model_name]["multiple_choice_acc_count"] + model_summary[dataset_name][args.model_name]["judge_acc_count"]) / (model_summary[dataset_name][args.model_name]["multiple_choice_count"] + model_summary[dataset_name][args.model_name]["judge_count"])
-                
-                # MetaDent
-                model_summary[args.model_name]["multiple_choice_acc_count"] += item["multiple_choice_acc_count"]
-                model_summary[args.model_name]["multiple_choice_count"] += item["multiple_choice_count"]
-                model_summary[args.model_name]["multiple_choice_acc"] = model_summary[args.model_name]["multiple_choice_acc_count"] / model_summary[args.model_name]["multiple_choice_count"] if model_summary[args.model_name]["multiple_choice_count"] else 1
-                
-                model_summary[args.model_name]["judge_acc_count"] += item["judge_acc_count"]
-                model_summary[args.model_name]["judge_count"] += item["judge_count"]
-                model_summary[args.model_name]["judge_acc"] = model_summary[args.model_name]["judge_acc_count"] / model_summary[args.model_name]["judge_count"] if model_summary[args.model_name]["judge_count"] else 1
-                
-                model_summary[args.model_name]["total_acc"] = (model_summary[args.model_name]["multiple_choice_acc_count"] + model_summary[args.model_name]["judge_acc_count"]) / (model_summary[args.model_name]["multiple_choice_count"] + model_summary[args.model_name]["judge_count"])
-                
-                # Keep three decimal places
-                point = '0.000'
-                model_summary[dataset_name][args.model_name]["multiple_choice_acc_decimal"] = float(Decimal(str(model_summary[dataset_name][args.model_name]["multiple_choice_acc"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                model_summary[dataset_name][args.model_name]["judge_acc_decimal"] = float(Decimal(str(model_summary[dataset_name][args.model_name]["judge_acc"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                model_summary[dataset_name][args.model_name]["total_acc_decimal"] = float(Decimal(str(model_summary[dataset_name][args.model_name]["total_acc"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                
-                model_summary[args.model_name]["multiple_choice_acc_decimal"] = float(Decimal(str(model_summary[args.model_name]["multiple_choice_acc"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                model_summary[args.model_name]["judge_acc_decimal"] = float(Decimal(str(model_summary[args.model_name]["judge_acc"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                model_summary[args.model_name]["total_acc_decimal"] = float(Decimal(str(model_summary[args.model_name]["total_acc"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
-                
-                break
+    groups = DatasetGroups(model_json.keys(), distribution)
+    items = list(model_json.values())
+    sums = {
+        name: groups.sum(field(items, name))
+        for name in ("multiple_choice_acc_count", "multiple_choice_count", "judge_acc_count", "judge_count")
+    }
     
+    def build(i: int) -> dict:
+        res = {}
+        res["multiple_choice_acc_count"] = float(sums["multiple_choice_acc_count"][i])
+        res["multiple_choice_count"] = float(sums["multiple_choice_count"][i])
+        res["multiple_choice_acc"] = res["multiple_choice_acc_count"] / res["multiple_choice_count"] if res["multiple_choice_count"] else 1
+        
+        res["judge_acc_count"] = float(sums["judge_acc_count"][i])
+        res["judge_count"] = float(sums["judge_count"][i])
+        res["judge_acc"] = res["judge_acc_count"] / res["judge_count"] if res["judge_count"] else 1
+        
+        res["total_acc"] = (res["multiple_choice_acc_count"] + res["judge_acc_count"]) / (res["multiple_choice_count"] + res["judge_count"])
+        
+        # Keep three decimal places
+        res["multiple_choice_acc_decimal"] = quantize(res["multiple_choice_acc"])
+        res["judge_acc_decimal"] = quantize(res["judge_acc"])
+        res["total_acc_decimal"] = quantize(res["total_acc"])
+        return res
+    
+    # DS1, DS2, DS3 and MetaDent
+    model_summary = groups.summary(args.model_name, build)
     save_json_data(model_summary, save_dir, "results.json", title=f"{args.task} - {args.subtask} - {args.model_name}")
+    return model_summary
 
 
-def run_vqa_evaluation(args):
-    distribution_json = load_distribution_data()
-    label_json = load_vqa_data()
+def run_vqa_evaluation(args, label_json: dict = None, distribution_json: dict = None) -> dict:
+    """
+    Evaluate the VQA predictions of `args.model_name`. `label_json` and `distribution_json`
+    are loaded from data/ unless given (a sweep loads them once for all models).
+
+    Returns:
+        dict: {metric directory: summary of results.json}.
+    """
+    if distribution_json is None:
+        distribution_json = load_distribution_data()
+    if label_json is None:
+        label_json = load_vqa_data()
     data_path = os.path.join(args.project_root, args.save_root_dir, "prediction", args.subtask, args.model_name, "results.json")
-    model_json = load_data(data_path)
+    save_result_dir = os.path.join(args.project_root, "metric", args.subtask, "Accuracy", args.model_name)
+    per_sample_path = os.path.join(save_result_dir, "per_sample.json")
+    questions_path = os.path.join(save_result_dir, "questions.parquet")
     
-    per_sample = defaultdict(dict)
-    for key, value in tqdm(label_json.items(), total=len(label_json), dynamic_ncols=True, desc=f"{args.model_name}"):
-        if key not in model_json:
+    # a question row also records the dataset of its sample
+    dataset_index = build_id_index(distribution_json)
+    datasets = list(distribution_json.keys())
+    # the predictions are streamed, a sample keeps only the fields of its question rows
+    model_json, sample_fingerprints = {}, {}
+    for key, value in iter_data(data_path):
+        if key not in label_json:
             continue
-        if not per_sample[key]:
-            per_sample[key] = defaultdict(float)
-            per_sample[key]["multiple_choice_acc_count"] = 0
-            per_sample[key]["multiple_choice_count"] = 0
-            per_sample[key]["multiple_choice_acc"] = 1
-            per_sample[key]["judge_acc_count"] = 0
-            per_sample[key]["judge_count"] = 0
-            per_sample[key]["judge_acc"] = 1
-            per_sample[key]["total_acc"] = 1
-        for item in model_json[key]:
-            if not item["AI_answer"]:
-                continue
-            
-            if item["question_type"] == "multiple_choice":
-                per_sample[key]["multiple_choice_count"] += 1
-                if item["answer"] == item["AI_answer"]:
-                    per_sample[key]["multiple_choice_acc_count"] += 1
-            else:
-                per_sample[key]["judge_count"] += 1
-                if item["answer"] == item["AI_answer"]:
-                    per_sample[key]["judge_acc_count"] += 1
-        
-        if per_sample[key]["multiple_choice_count"]:
-            per_sample[key]["multiple_choice_acc"] = per_sample[key]["multiple_choice_acc_count"] / per_sample[key]["multiple_choice_count"]
-        if per_sample[key]["judge_count"]:
-            per_sample[key]["judge_acc"] = per_sample[key]["judge_acc_count"] / per_sample[key]["judge_count"]
-        if per_sample[key]["multiple_choice_count"] + per_sample[key]["judge_count"] > 0:
-            per_sample[key]["total_acc"] = (per_sample[key]["multiple_choice_acc_count"] + per_sample[key]["judge_acc_count"]) / (per_sample[key]["multiple_choice_count"] + per_sample[key]["judge_count"])
+        sample_fingerprints[key] = fingerprint(label_json[key], value, datasets[dataset_index[key]] if key in dataset_index else None)
+        model_json[key] = [{"question_type": item["question_type"], "answer": item["answer"], "AI_answer": item["AI_answer"]} for item in value]
     
-    save_result_dir = os.path.join(args.project_root, "metric", args.subtask, "Accuracy", args.model_name)
+    # one row per question, all metrics are group-by reductions over this table
+    sample_ids = [key for key in label_json if key in model_json]
+    fingerprints = {key: sample_fingerprints[key] for key in sample_ids}
+    state = EvaluationState(save_result_dir) if args.incremental else None
+    if state is not None and state.exists and os.path.exists(per_sample_path) and os.path.exists(questions_path):
+        previous = load_data(per_sample_path)
+        changed = state.changed(fingerprints, previous)
+        updated = build_question_table(model_json, distribution_json, args.model_name, changed)
+        table = merge_question_tables(pd.read_parquet(questions_path), updated, sample_ids, changed)
+        per_sample = merge_per_sample(previous, per_sample_accuracy(updated, changed), sample_ids)
+        tqdm.write(incremental_summary(f"{args.subtask} - {args.model_name}", len(changed), len(sample_ids), len(set(previous) - set(sample_ids))))
+    else:
+        table = build_question_table(model_json, distribution_json, args.model_name, sample_ids)
+        per_sample = per_sample_accuracy(table, sample_ids)
+    save_parquet_data(table, save_result_dir, "questions.parquet", title=f"{args.task} - {args.subtask} - {args.model_name}")
     save_json_data(per_sample, save_result_dir, "per_sample.json", title=f"{args.task} - {args.subtask} - {args.model_name}")
+    if state is not None:
+        state.save(fingerprints)
     
-    calculate_all_metrics(per_sample, distribution_json, save_result_dir, args)
+    return {"Accuracy": calculate_all_metrics(per_sample, distribution_json, save_result_dir, args)}
@@ -1,75 +1,257 @@
+import asyncio
 import json
-import os
+import threading
+import time
 from argparse import Namespace
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Optional
 
 from tqdm import tqdm
 
-from src.models.base_model import BaseModel
+from src.models.base_model import MALFORMED_REPLY_ERRORS, BaseModel
 from src.utils import prompt
+from src.utils.async_utils import run_async_tasks
 from src.utils.common_utils import confirm_restart_if_exists, strip_trailing_slash
-from src.utils.file_io import convert_jsonl_to_json, load_completed_indices
-from src.utils.lfss_io import LabelReader, SkipReader
+from src.utils.file_io import (
+    convert_jsonl_to_json,
+    load_completed_indices,
+    open_output,
+    write_task_output,
+)
+from src.utils.lfss_mirror import meta_batch_reader
+from src.utils.pipeline import Finished, Pipeline, Stage, stage_workers
+from src.utils.prompt_builder import build_prompt
+from src.utils.translation_store import async_translate_case, translate_case
+from src.utils.usage_meter import CHARS_PER_TOKEN, usage_tag
 
 
-def task(idx: str, model: BaseModel, lbl_meta_dir: str, args: Namespace) -> dict:
-    r = SkipReader(lbl_meta_dir=lbl_meta_dir)
-    skip = r.get(idx)
-    if skip is not None:
-        return None
-
-    r = LabelReader(lbl_meta_dir=lbl_meta_dir)
-    label = r.get(idx)
+def fetch_label(idx: str, lbl_meta_dir: str, args: Namespace):
+    """Pipeline stage: skip and label in one request."""
+    meta = meta_batch_reader(lbl_meta_dir).get([idx], fields=("skip", "label"))[idx]
+    if meta.skip is not None:
+        return Finished(None)
+    
+    label = meta.label
     if label is None:
-        return None
+        return Finished(None)
     
     label = label.compact_json()
+    return {"idx": idx, "label": label, "case_en": None if args.lfss_meta_type == "cn" else label}
+
+def translate_label(item: dict, model: BaseModel) -> dict:
+    """Pipeline stage (cn labels): zh->en translation of the label."""
+    item["case_en"] = translate_case(item["label"], model)
+    return item
+
+def questions_prompt(case_en: dict, model: BaseModel) -> str:
+    if len(case_en["items"]) <= 2:
+        multiple_choice, true_false = 3, 2
+    else:
+        multiple_choice, true_false = 6, 4
     
-    case_en = None
-    try:
-        if args.lfss_meta_type == "cn":
-            p = prompt.translate_dent_json_zh2en.substitute(
-                case=model.j2t(label)
-                )
-            case_en = model.generate_from_text(prompt=p)
-        else:
-            case_en = label
-        
-        if len(case_en["items"]) <= 2:
-            multiple_choice, true_false = 3, 2
+    return build_prompt(prompt.vqa_intraoral_condition,
+        multiple_choice=multiple_choice,
+        true_false=true_false,
+        case=model.j2t(case_en)
+    )
+
+def generate_questions(item: dict, model: BaseModel) -> dict:
+    """Pipeline stage: generate the questions of the case."""
+    item["res"] = model.generate_from_text(prompt=questions_prompt(item["case_en"], model), output_type=list)
+    return item
+
+def verify_prompt(case_en: dict, ai_input: dict, model: BaseModel) -> str:
+    return build_prompt(prompt.verifier_intraoral_condition,
+        case=model.j2t(case_en),
+        ai_input=model.j2t(ai_input)
+    )
+
+def batch_verify_prompt(case_en: dict, res: list, model: BaseModel) -> str:
+    return build_prompt(prompt.verifier_intraoral_condition_batch,
+        count=len(res),
+        case=model.j2t(case_en),
+        ai_input=model.j2t([{"index": i, **ai_input} for i, ai_input in enumerate(res)])
+    )
+
+def apply_verdicts(res: list, verify_list: list) -> list:
+    """Replace the questions marked invalid by their revised version."""
+    for index, verify_res in enumerate(verify_list):
+        if verify_res["invalid"] and verify_res["new_question"]:
+            if isinstance(verify_res["new_question"], list):
+                res[index] = verify_res["new_question"][0]
+            else:
+                res[index] = verify_res["new_question"]
+    return res
+
+def parse_batch_verdicts(verdicts: list, res: list) -> list:
+    """Map a batched verifier reply back to one verdict per question; raise ValueError if malformed."""
+    if len(verdicts) != len(res):
+        raise ValueError(f"Expected {len(res)} verdicts, got {len(verdicts)}")
+    parsed = [None] * len(res)
+    for pos, verdict in enumerate(verdicts):
+        if not isinstance(verdict, dict) or not isinstance(verdict.get("invalid"), bool):
+            raise ValueError(f"Malformed verdict: {json.dumps(verdict, ensure_ascii=False)}")
+        i = verdict.get("index", pos)
+        if not isinstance(i, int) or not 0 <= i < len(res) or parsed[i] is not None:
+            raise ValueError(f"Invalid or duplicated index: {i}")
+        if verdict["invalid"] and not isinstance(verdict.get("new_question"), (dict, list, type(None))):
+            raise ValueError(f"Malformed new_question of question {i}")
+        parsed[i] = {"invalid": verdict["invalid"], "new_question": verdict.get("new_question")}
+    return parsed
+
+class BatchVerifyStats:
+    """Counters of the batched verifier, used to report savings against the per-question path."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batched_samples = 0
+        self.fallback_samples = 0
+        self.batched_questions = 0
+        self.fallback_questions = 0
+        self.batch_prompt_chars = 0
+        self.single_prompt_chars = 0
+        self.batch_seconds = 0.0
+        self.fallback_seconds = 0.0
+    
+    def add(self, n_questions: int, batch_prompt: str, single_prompts: list, seconds: float, fallback: bool):
+        with self.lock:
+            if fallback:
+                self.fallback_samples += 1
+                self.fallback_questions += n_questions
+                self.fallback_seconds += seconds
+            else:
+                self.batched_samples += 1
+                self.batched_questions += n_questions
+                self.batch_prompt_chars += len(batch_prompt)
+                self.single_prompt_chars += sum(len(p) for p in single_prompts)
+                self.batch_seconds += seconds
+    
+    def report(self, model: BaseModel):
+        total_questions = self.batched_questions + self.fallback_questions
+        tqdm.write(f"[VQA batched verify] samples: {self.batched_samples + self.fallback_samples} | "
+                   f"batched: {self.batched_samples} | fell back to per-question: {self.fallback_samples}")
+        if self.batched_samples:
+            per_sample = self.batch_seconds / self.batched_samples
+            line = f"[VQA batched verify] latency: {per_sample:.2f}s per batched sample ({self.batched_questions / self.batched_samples:.1f} questions)"
+            if self.fallback_questions:
+                # fallback samples include the failed batched call, so this overestimates a per-question call a little
+                per_question = self.fallback_seconds / self.fallback_questions
+                line += f" vs ~{per_question * self.batched_questions / self.batched_samples:.2f}s per-question"
+            tqdm.write(line)
+        if model.usage is None:
+            return
+        batch = model.usage.get("vqa_verify_batch")
+        single = model.usage.get("vqa_verify_single")
+        requests = batch.get("requests", 0) + single.get("requests", 0)
+        tqdm.write(f"[VQA batched verify] requests: {requests} sent vs {total_questions} per-question "
+                   f"-> saved {total_questions - requests}")
+        if not batch.get("requests") or not self.batched_samples:
+            return
+        # text only: the per-question prompts scale with their length; take measured fallback calls when available
+        if single.get("requests"):
+            baseline = self.batched_questions * single["prompt_tokens"] / single["requests"]
+        elif self.batch_prompt_chars:
+            baseline = batch["prompt_tokens"] * self.single_prompt_chars / self.batch_prompt_chars
         else:
-            multiple_choice, true_false = 6, 4
-        
-        p = prompt.vqa_intraoral_condition.substitute(
-            multiple_choice=multiple_choice,
-            true_false=true_false,
-            case=model.j2t(case_en)
-        )
-        res = model.generate_from_text(prompt=p, output_type=list)
-        
-        # verify res
-        for index, ai_input in enumerate(res):
-            p = prompt.verifier_intraoral_condition.substitute(
-                case=model.j2t(case_en),
-                ai_input=model.j2t(ai_input)
-            )
-            verify_res = model.generate_from_text(prompt=p)
-            if verify_res["invalid"] and verify_res["new_question"]:
-                if isinstance(verify_res["new_question"], list):
-                    res[index] = verify_res["new_question"][0]
-                else:
-                    res[index] = verify_res["new_question"]
-        
-        return {
-            "case_en": {idx: case_en},
-            "res": {idx: res}
-        }
+            baseline = self.single_prompt_chars / CHARS_PER_TOKEN
+        tqdm.write(f"[VQA batched verify] prompt tokens: {batch['prompt_tokens']} sent for batched samples vs "
+                   f"~{baseline:.0f} per-question -> saved ~{baseline - batch['prompt_tokens']:.0f}")
+
+def verified_output(item: dict, verify_list: list) -> dict:
+    """Task output of the sample, with the verdicts of its questions applied."""
+    return {
+        "case_en": {item["idx"]: item["case_en"]},
+        "res": {item["idx"]: apply_verdicts(item["res"], verify_list)}
+    }
+
+def verify_questions(item: dict, model: BaseModel) -> dict:
+    """Pipeline stage: verify the questions one request each, the last stage returns the task output."""
+    verify_list = []
+    for ai_input in item["res"]:
+        verify_list.append(model.generate_from_text(prompt=verify_prompt(item["case_en"], ai_input, model)))
+    return verified_output(item, verify_list)
+
+def verify_questions_batched(item: dict, model: BaseModel, stats: BatchVerifyStats) -> dict:
+    """Pipeline stage: verify all questions in one request; fall back to verify_questions() if the reply is malformed."""
+    case_en, res = item["case_en"], item["res"]
+    if not res:
+        return verify_questions(item, model)
+    p = batch_verify_prompt(case_en, res, model)
+    start = time.monotonic()
+    
+    try:
+        with usage_tag("vqa_verify_batch"):
+            verdicts = model.generate_from_text(prompt=p, output_type=list)
+        verify_list = parse_batch_verdicts(verdicts, res)
+    except MALFORMED_REPLY_ERRORS:
+        with usage_tag("vqa_verify_single"):
+            try:
+                return verify_questions(item, model)
+            finally:
+                stats.add(len(res), p, [], time.monotonic() - start, fallback=True)
+    
+    stats.add(len(res), p, [verify_prompt(case_en, ai_input, model) for ai_input in res], time.monotonic() - start, fallback=False)
+    return verified_output(item, verify_list)
+
+def failed_output(item: dict, e: Exception) -> dict:
+    case_en = item["case_en"]
+    return {
+        "case_en": {item["idx"]: case_en if case_en else {"failed": str(e)}},
+        "res": {item["idx"]: {"failed": str(e)}}
+    }
+
+async def async_translate_label(item: dict, model: BaseModel) -> dict:
+    """Coroutine version of translate_label()."""
+    item["case_en"] = await async_translate_case(item["label"], model)
+    return item
+
+async def async_generate_questions(item: dict, model: BaseModel) -> dict:
+    """Coroutine version of generate_questions()."""
+    item["res"] = await model.generate_from_text(prompt=questions_prompt(item["case_en"], model), output_type=list)
+    return item
+
+async def async_verify_questions(item: dict, model: BaseModel) -> dict:
+    """Coroutine version of verify_questions(); the questions of the sample are verified concurrently."""
+    verify_list = await asyncio.gather(*(
+        model.generate_from_text(prompt=verify_prompt(item["case_en"], ai_input, model)) for ai_input in item["res"]
+    ))
+    return verified_output(item, verify_list)
+
+async def async_verify_questions_batched(item: dict, model: BaseModel, stats: BatchVerifyStats) -> dict:
+    """Coroutine version of verify_questions_batched()."""
+    case_en, res = item["case_en"], item["res"]
+    if not res:
+        return await async_verify_questions(item, model)
+    p = batch_verify_prompt(case_en, res, model)
+    start = time.monotonic()
     
+    try:
+        with usage_tag("vqa_verify_batch"):
+            verdicts = await model.generate_from_text(prompt=p, output_type=list)
+        verify_list = parse_batch_verdicts(verdicts, res)
+    except MALFORMED_REPLY_ERRORS:
+        with usage_tag("vqa_verify_single"):
+            try:
+                return await async_verify_questions(item, model)
+            finally:
+                stats.add(len(res), p, [], time.monotonic() - start, fallback=True)
+    
+    stats.add(len(res), p, [verify_prompt(case_en, ai_input, model) for ai_input in res], time.monotonic() - start, fallback=False)
+    return verified_output(item, verify_list)
+
+async def async_task(idx: str, model: BaseModel, lbl_meta_dir: str, args: Namespace, stats: Optional[BatchVerifyStats] = None) -> dict:
+    """The stages of one sample in one coroutine, for AsyncAPIModel; the LFSS read runs in a worker thread."""
+    item = await asyncio.to_thread(fetch_label, idx, lbl_meta_dir, args)
+    if isinstance(item, Finished):
+        return item.output
+    
+    try:
+        if args.lfss_meta_type == "cn":
+            item = await async_translate_label(item, model)
+        item = await async_generate_questions(item, model)
+        if stats is not None:
+            return await async_verify_questions_batched(item, model, stats)
+        return await async_verify_questions(item, model)
     except Exception as e:
-        return {
-            "case_en": {idx: case_en if case_en else {"failed": str(e)}},
-            "res": {idx: {"failed": str(e)}}
-        }
+        return failed_output(item, e)
 
 def run_vqa_generation(model: BaseModel, yaml_cfg, args):
     completed = load_completed_indices(args)
@@ -85,32 +267,36 @@ def run_vqa_generation(model: BaseModel, yaml_cfg, args):
             lbl_meta_dir=strip_trailing_slash(yaml_cfg["lfss"]["meta_cn_dir"])
         else:
             lbl_meta_dir=strip_trailing_slash(yaml_cfg["lfss"]["meta_en_dir"])
-        with open(args.outfile, "a", encoding="utf-8") as f_out, \
-            open(args.translatefile, "a", encoding="utf-8") as f_translate, \
-            open(args.failfile, "a", encoding="utf-8") as f_fail:
+        with open_output(args, "results") as f_out, \
+            open_output(args, "translate") as f_translate, \
+            open_output(args, "failures") as f_fail:
+            
+            outputs = {"case_en": f_translate, "res": f_out}
+            stats = BatchVerifyStats() if args.vqa_batch_verify else None
+            if args.async_mode:
+                run_async_tasks(
+                    lambda idx: async_task(idx, model, lbl_meta_dir, args, stats),
+                    pending,
+                    lambda out: write_task_output(out, outputs, f_fail),
+                    max_inflight=args.max_inflight,
+                )
+            else:
+                # LFSS reads, translation, generation and verification overlap across samples
+                stages = [Stage("fetch", lambda idx: fetch_label(idx, lbl_meta_dir, args), stage_workers(args, "fetch"))]
+                if args.lfss_meta_type == "cn":
+                    stages.append(Stage("translate", lambda item: translate_label(item, model), stage_workers(args, "translate"), on_error=failed_output))
+                stages.append(Stage("generate", lambda item: generate_questions(item, model), stage_workers(args, "generate"), on_error=failed_output))
+                if stats is not None:
+                    verify = lambda item: verify_questions_batched(item, model, stats)
+                else:
+                    verify = lambda item: verify_questions(item, model)
+                stages.append(Stage("verify", verify, stage_workers(args, "verify"), on_error=failed_output))
+                pipeline = Pipeline(stages, queue_size=args.pipeline_queue_size, name="VQA generation")
+                pipeline.run(pending, lambda out: write_task_output(out, outputs, f_fail))
+                tqdm.write(pipeline.summary())
             
-            with ThreadPoolExecutor(max_workers=args.workers) as executor:
-                futures = {executor.submit(task, idx, model, lbl_meta_dir, args): idx for idx in pending}
-                
-                for future in tqdm(as_completed(futures), total=len(futures), desc="Processing", unit="task", dynamic_ncols=True):
-                    out = future.result()
-                    if out:
-                        case_en = out["case_en"]
-                        result = out["res"]
-                        if case_en:
-                            if "failed" in case_en or (isinstance(case_en, dict)and "failed" in case_en[list(case_en.keys())[0]]):
-                                f_fail.write(json.dumps(case_en, ensure_ascii=False) + "\n")
-                                f_fail.flush()
-                            else:
-                                f_translate.write(json.dumps(case_en, ensure_ascii=False) + "\n")
-                                f_translate.flush()
-                        if result:
-                            if "failed" in result or (isinstance(result, dict) and "failed" in result[list(result.keys())[0]]):
-                                f_fail.write(json.dumps(result, ensure_ascii=False) + "\n")
-                                f_fail.flush()
-                            else:
-                                f_out.write(json.dumps(result, ensure_ascii=False) + "\n")
-                                f_out.flush()
+            if stats is not None:
+                stats.report(model)
     
     convert_jsonl_to_json(args, jsonl_type="results")
     convert_jsonl_to_json(args, jsonl_type="translate")
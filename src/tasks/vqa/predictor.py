@@ -1,100 +1,266 @@
+import asyncio
 import json
 import os
+import threading
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 
 from tqdm import tqdm
 
-from src.models.base_model import BaseModel
+from src.models.base_model import MALFORMED_REPLY_ERRORS, BaseModel
 from src.utils import prompt
+from src.utils.async_utils import run_async_tasks
 from src.utils.common_utils import confirm_restart_if_exists, strip_trailing_slash
 from src.utils.file_io import (
     convert_jsonl_to_json,
     load_completed_indices,
     load_vqa_data,
+    open_output,
+    write_task_output,
 )
+from src.utils.prompt_builder import build_prompt
+from src.utils.usage_meter import CHARS_PER_TOKEN, usage_tag
 
 
+def find_image(idx: str, image_dir: str) -> str:
+    """The .png image of the sample, else its .jpg; raise FileNotFoundError if neither exists."""
+    image_path= os.path.join(image_dir, f"{idx}.png")
+    if not os.path.exists(image_path):
+        image_path= os.path.join(image_dir, f"{idx}.jpg")
+    if not os.path.exists(image_path):
+        raise FileNotFoundError(f"Image file not found: {image_path}")
+    return image_path
+
+def failed_output(idx: str, e: Exception) -> dict:
+    return {
+        "res": {idx: {"failed": str(e)}}
+    }
+
+def single_prompt(item: dict, model: BaseModel) -> str:
+    return build_prompt(prompt.vqa_answer_intraoral_condition,
+        question=item["question"],
+        choice=model.j2t(item["choice"]),
+        answer_options='"A", "B", "C", or "D"' if item["question_type"] == 'multiple_choice' else '"A" or "B"'
+        )
+
+def answer_record(item: dict, AI_answer, AI_reason) -> dict:
+    return {
+        "question_type": item["question_type"],
+        "question": item["question"],
+        "choice": item["choice"],
+        "answer": item["answer"],
+        "reason": item["reason"],
+        "AI_answer": AI_answer,
+        "AI_reason": AI_reason
+    }
+
+def answer_question(item: dict, image_path: str, model: BaseModel) -> dict:
+    p = single_prompt(item, model)
+    try:
+        res = model.generate_from_image_and_text(image_path=image_path, prompt=p)
+        return answer_record(item, res["answer"], res["reason"])
+    except Exception as e:
+        return answer_record(item, None, str(e))
+
 def task(idx: str, items: list, image_dir: str, model: BaseModel) -> dict:
-    new_question_list = []
+    try:
+        image_path = find_image(idx, image_dir)
+    except FileNotFoundError as e:
+        return failed_output(idx, e)
     
-    for item in items:
-        question_type = item["question_type"]
-        question = item["question"]
-        choice = item["choice"]
-        
-        image_path= os.path.join(image_dir, f"{idx}.png")
-        if not os.path.exists(image_path):
-            image_path= os.path.join(image_dir, f"{idx}.jpg")
-        if not os.path.exists(image_path):
-            return {
-                "res": {idx: {"failed": f"Image file not found: {image_path}"}}
-            }
-        p = prompt.vqa_answer_intraoral_condition.substitute(
-            question=question,
-            choice=model.j2t(choice),
-            answer_options='"A", "B", "C", or "D"' if question_type == 'multiple_choice' else '"A" or "B"'
-            )
-
-        try:
-            res = model.generate_from_image_and_text(image_path=image_path, prompt=p)
-            AI_answer = res["answer"]
-            AI_reason = res["reason"]
-            new_question_list.append({
-                "question_type": question_type,
-                "question": question,
-                "choice": choice,
-                "answer": item["answer"],
-                "reason": item["reason"],
-                "AI_answer": AI_answer,
-                "AI_reason": AI_reason
-            })
-        except Exception as e:
-            new_question_list.append({
-                "question_type": question_type,
-                "question": question,
-                "choice": choice,
-                "answer": item["answer"],
-                "reason": item["reason"],
-                "AI_answer": None,
-                "AI_reason": str(e)
-            })
+    return {
+        "res": {idx: [answer_question(item, image_path, model) for item in items]}
+    }
+
+async def async_answer_question(item: dict, image_path: str, model: BaseModel) -> dict:
+    """Coroutine version of answer_question()."""
+    p = single_prompt(item, model)
+    try:
+        res = await model.generate_from_image_and_text(image_path=image_path, prompt=p)
+        return answer_record(item, res["answer"], res["reason"])
+    except Exception as e:
+        return answer_record(item, None, str(e))
+
+async def async_task(idx: str, items: list, image_dir: str, model: BaseModel) -> dict:
+    """Coroutine version of task(); the questions of one sample are answered concurrently."""
+    try:
+        image_path = find_image(idx, image_dir)
+    except FileNotFoundError as e:
+        return failed_output(idx, e)
     
+    new_question_list = await asyncio.gather(*(async_answer_question(item, image_path, model) for item in items))
     return {
-        "res": {idx: new_question_list}
+        "res": {idx: list(new_question_list)}
     }
 
+class BatchAnswerStats:
+    """Counters of the multi-question mode, used to report savings against the per-question path."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.batched_samples = 0
+        self.fallback_samples = 0
+        self.batched_questions = 0
+        self.fallback_questions = 0
+        self.batch_prompt_chars = 0
+        self.single_prompt_chars = 0
+    
+    def add(self, n_questions: int, batch_prompt: str, single_prompts: list, fallback: bool):
+        with self.lock:
+            if fallback:
+                self.fallback_samples += 1
+                self.fallback_questions += n_questions
+            else:
+                self.batched_samples += 1
+                self.batched_questions += n_questions
+                self.batch_prompt_chars += len(batch_prompt)
+                self.single_prompt_chars += sum(len(p) for p in single_prompts)
+    
+    def report(self, model: BaseModel):
+        total_questions = self.batched_questions + self.fallback_questions
+        tqdm.write(f"[VQA multi-question] samples: {self.batched_samples + self.fallback_samples} | "
+                   f"batched: {self.batched_samples} | fell back to per-question: {self.fallback_samples}")
+        if model.usage is None:
+            return
+        batch = model.usage.get("vqa_batch")
+        single = model.usage.get("vqa_single")
+        requests = batch.get("requests", 0) + single.get("requests", 0)
+        tqdm.write(f"[VQA multi-question] requests: {requests} sent vs {total_questions} per-question "
+                   f"-> saved {total_questions - requests}")
+        if not batch.get("requests") or not self.batched_samples:
+            return
+        # per-question prompt = image tokens + its own text; take measured fallback calls when available
+        if single.get("requests"):
+            per_question_tokens = single["prompt_tokens"] / single["requests"]
+            baseline = self.batched_questions * per_question_tokens
+        else:
+            image_tokens = max(0.0, (batch["prompt_tokens"] - self.batch_prompt_chars / CHARS_PER_TOKEN) / batch["requests"])
+            baseline = self.batched_questions * image_tokens + self.single_prompt_chars / CHARS_PER_TOKEN
+        tqdm.write(f"[VQA multi-question] prompt tokens: {batch['prompt_tokens']} sent for batched samples vs "
+                   f"~{baseline:.0f} per-question -> saved ~{baseline - batch['prompt_tokens']:.0f}")
+
+def batch_prompt(items: list, model: BaseModel) -> str:
+    questions = [
+        {
+            "index": i,
+            "question": item["question"],
+            "choice": item["choice"],
+            "answer_options": ["A", "B", "C", "D"] if item["question_type"] == "multiple_choice" else ["A", "B"]
+        } for i, item in enumerate(items)
+    ]
+    return build_prompt(prompt.vqa_answer_intraoral_condition_batch,
+        count=len(items),
+        questions=model.j2t(questions)
+    )
+
+def parse_batch_answers(res: list, items: list) -> list:
+    """Map a multi-question reply back to one (answer, reason) per question; raise ValueError if malformed."""
+    if len(res) != len(items):
+        raise ValueError(f"Expected {len(items)} answers, got {len(res)}")
+    answers = [None] * len(items)
+    for pos, ans in enumerate(res):
+        if not isinstance(ans, dict) or "answer" not in ans or "reason" not in ans:
+            raise ValueError(f"Malformed answer: {json.dumps(ans, ensure_ascii=False)}")
+        i = ans.get("index", pos)
+        if not isinstance(i, int) or not 0 <= i < len(items) or answers[i] is not None:
+            raise ValueError(f"Invalid or duplicated index: {i}")
+        allowed = ["A", "B", "C", "D"] if items[i]["question_type"] == "multiple_choice" else ["A", "B"]
+        if ans["answer"] not in allowed:
+            raise ValueError(f"Answer {ans['answer']!r} of question {i} is not one of {allowed}")
+        answers[i] = (ans["answer"], ans["reason"])
+    return answers
+
+def batch_result(idx: str, items: list, answers: list) -> dict:
+    return {
+        "res": {idx: [answer_record(item, AI_answer, AI_reason) for item, (AI_answer, AI_reason) in zip(items, answers)]}
+    }
+
+def task_batched(idx: str, items: list, image_dir: str, model: BaseModel, stats: BatchAnswerStats) -> dict:
+    """
+    Answer all questions of a sample in one request; fall back to task() if the reply is malformed.
+    A failed request (connection, timeout, HTTP error) makes the sample a failure record instead.
+    """
+    try:
+        image_path = find_image(idx, image_dir)
+    except FileNotFoundError as e:
+        return failed_output(idx, e)
+    p = batch_prompt(items, model)
+    
+    try:
+        with usage_tag("vqa_batch"):
+            res = model.generate_from_image_and_text(image_path=image_path, prompt=p, output_type=list)
+        answers = parse_batch_answers(res, items)
+    except MALFORMED_REPLY_ERRORS:
+        stats.add(len(items), p, [], fallback=True)
+        with usage_tag("vqa_single"):
+            return task(idx, items, image_dir, model)
+    except Exception as e:
+        return failed_output(idx, e)
+    
+    stats.add(len(items), p, [single_prompt(item, model) for item in items], fallback=False)
+    return batch_result(idx, items, answers)
+
+async def async_task_batched(idx: str, items: list, image_dir: str, model: BaseModel, stats: BatchAnswerStats) -> dict:
+    """Coroutine version of task_batched()."""
+    try:
+        image_path = find_image(idx, image_dir)
+    except FileNotFoundError as e:
+        return failed_output(idx, e)
+    p = batch_prompt(items, model)
+    
+    try:
+        with usage_tag("vqa_batch"):
+            res = await model.generate_from_image_and_text(image_path=image_path, prompt=p, output_type=list)
+        answers = parse_batch_answers(res, items)
+    except MALFORMED_REPLY_ERRORS:
+        stats.add(len(items), p, [], fallback=True)
+        with usage_tag("vqa_single"):
+            return await async_task(idx, items, image_dir, model)
+    except Exception as e:
+        return failed_output(idx, e)
+    
+    stats.add(len(items), p, [single_prompt(item, model) for item in items], fallback=False)
+    return batch_result(idx, items, answers)
+
 def run_vqa_prediction(model: BaseModel, yaml_cfg, args):
     # image_dir=yaml_cfg["lfss"]["image_dir"]
     image_dir=strip_trailing_slash(yaml_cfg["data"]["image_dir"])
     data = load_vqa_data()
-    data_keys = set(data.keys())
     
     completed = load_completed_indices(args)
     completed = confirm_restart_if_exists(args, completed)
     all_indices = [f"{i:09d}" for i in range(args.start, args.end + 1)]
-    pending = [idx for idx in all_indices if idx not in completed and idx in data_keys]
+    pending = [idx for idx in all_indices if idx not in completed and idx in data]
     tqdm.write(f"Total tasks: {len(all_indices)} | Completed: {len(completed)} | Skipped: {len(all_indices) - len(completed) - len(pending)} | Pending: {len(pending)}")
     
     if not pending:
         print("All tasks already completed.")
     else:
-        with open(args.outfile, "a", encoding="utf-8") as f_out, \
-            open(args.failfile, "a", encoding="utf-8") as f_fail:
+        with open_output(args, "results") as f_out, \
+            open_output(args, "failures") as f_fail:
+            
+            outputs = {"res": f_out}
+            if args.vqa_batch_questions:
+                stats = BatchAnswerStats()
+                sync_fn, async_fn = partial(task_batched, stats=stats), partial(async_task_batched, stats=stats)
+            else:
+                sync_fn, async_fn = task, async_task
+            
+            if args.async_mode:
+                run_async_tasks(
+                    lambda idx: async_fn(idx, data[idx], image_dir, model),
+                    pending,
+                    lambda out: write_task_output(out, outputs, f_fail),
+                    max_inflight=args.max_inflight,
+                )
+            else:
+                with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                    futures = {executor.submit(sync_fn, idx, data[idx], image_dir, model): idx for idx in pending}
+                    
+                    for future in tqdm(as_completed(futures), total=len(futures), desc="Processing", unit="task", dynamic_ncols=True):
+                        write_task_output(future.result(), outputs, f_fail)
             
-            with ThreadPoolExecutor(max_workers=args.workers) as executor:
-                futures = {executor.submit(task, idx, data[idx], image_dir, model): idx for idx in pending}
-                
-                for future in tqdm(as_completed(futures), total=len(futures), desc="Processing", unit="task", dynamic_ncols=True):
-                    out = future.result()
-                    if out:
-                        result = out["res"]
-                        if result:
-                            if "failed" in result or (isinstance(result, dict) and "failed" in result[list(result.keys())[0]]):
-                                f_fail.write(json.dumps(result, ensure_ascii=False) + "\n")
-                                f_fail.flush()
-                            else:
-                                f_out.write(json.dumps(result, ensure_ascii=False) + "\n")
-                                f_out.flush()
+            if args.vqa_batch_questions:
+                stats.report(model)
     
     convert_jsonl_to_json(args, jsonl_type="results")
     convert_jsonl_to_json(args, jsonl_type="failures")
\ No newline at end of file
@@ -0,0 +1,88 @@
+import asyncio
+from argparse import Namespace
+
+from tqdm import tqdm
+
+from src.models.base_model import BaseModel
+from src.models.load_model import load_model
+from src.utils import translation_store
+from src.utils.async_utils import run_async_tasks
+from src.utils.common_utils import strip_trailing_slash
+from src.utils.lfss_io import LFSS_POOL
+from src.utils.lfss_mirror import meta_batch_reader
+from src.utils.pipeline import Finished, Pipeline, Stage, stage_workers
+from src.utils.translation_store import async_translate_case, translate_case
+
+
+def fetch_label(idx: str, lbl_meta_dir: str, model: BaseModel):
+    """Pipeline stage: the label of the sample, unless it is skipped, missing or already translated."""
+    meta = meta_batch_reader(lbl_meta_dir).get([idx], fields=("skip", "label"))[idx]
+    if meta.skip is not None or meta.label is None:
+        return Finished("skipped")
+
+    label = meta.label.compact_json()
+    if translation_store.TRANSLATION_STORE.contains(label, model.model_name):
+        return Finished("stored")
+    return {"idx": idx, "label": label}
+
+def translate_label(item: dict, model: BaseModel) -> str:
+    translate_case(item["label"], model)
+    return "translated"
+
+def failed_output(item: dict, e: Exception) -> str:
+    tqdm.write(f"[TranslationStore] Failed to translate {item['idx']}: {e}")
+    return "failed"
+
+async def async_task(idx: str, model: BaseModel, lbl_meta_dir: str) -> str:
+    r = meta_batch_reader(lbl_meta_dir)
+    meta = (await asyncio.to_thread(r.get, [idx], ("skip", "label")))[idx]
+    if meta.skip is not None or meta.label is None:
+        return "skipped"
+
+    label = meta.label.compact_json()
+    if await asyncio.to_thread(translation_store.TRANSLATION_STORE.contains, label, model.model_name):
+        return "stored"
+    try:
+        await async_translate_case(label, model)
+    except Exception as e:
+        return failed_output({"idx": idx}, e)
+    return "translated"
+
+def run(args: Namespace, yaml_cfg, model_cfg):
+    """
+    Translate the cn labels of [start, end] into the translation store once, so that the
+    generation and evaluation runs with `--translation_store` only read them.
+    """
+    model = load_model(args, model_cfg)
+    lbl_meta_dir = strip_trailing_slash(yaml_cfg["lfss"]["meta_cn_dir"])
+    indices = [f"{i:09d}" for i in range(args.start, args.end + 1)]
+    counts = {"translated": 0, "stored": 0, "skipped": 0, "failed": 0}
+
+    def count(status: str):
+        counts[status] += 1
+
+    if args.async_mode:
+        run_async_tasks(
+            lambda idx: async_task(idx, model, lbl_meta_dir),
+            indices,
+            count,
+            max_inflight=args.max_inflight,
+            desc="Translating",
+        )
+    else:
+        pipeline = Pipeline([
+            Stage("fetch", lambda idx: fetch_label(idx, lbl_meta_dir, model), stage_workers(args, "fetch")),
+            Stage("translate", lambda item: translate_label(item, model), stage_workers(args, "translate"), on_error=failed_output),
+        ], queue_size=args.pipeline_queue_size, name="Translation prefill")
+        pipeline.run(indices, count, desc="Translating")
+        tqdm.write(pipeline.summary())
+
+    tqdm.write(f"[TranslationStore] '{lbl_meta_dir}' [{args.start}, {args.end}] with '{model.model_name}': "
+               f"translated: {counts['translated']}, already stored: {counts['stored']}, "
+               f"skipped: {counts['skipped']}, failed: {counts['failed']}")
+    tqdm.write(translation_store.TRANSLATION_STORE.summary())
+    if model.rate_limiter is not None:
+        tqdm.write(model.rate_limiter.summary())
+    if model.usage is not None:
+        tqdm.write(model.usage.summary(f"{args.task} - {model.model_name}"))
+    tqdm.write(LFSS_POOL.summary())
@@ -0,0 +1,87 @@
+from decimal import Decimal
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+
+def quantize(value: float, point: str = "0.000") -> float:
+    """
+    Round half up to the precision of `point` (three decimal places by default).
+
+    Example:
+        >>> quantize(0.12345)
+        0.123
+    """
+    return float(Decimal(str(value)).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
+
+def build_id_index(distribution: Dict[str, List[str]]) -> Dict[str, int]:
+    """
+    Map every sample id of distribution.json to the position of its dataset.
+
+    An id listed under several datasets belongs to the first one, as with the previous
+    `if key in ids: ... break` lookup.
+    """
+    index = {}
+    for pos, ids in enumerate(distribution.values()):
+        for id_ in ids:
+            index.setdefault(id_, pos)
+    return index
+
+
+class DatasetGroups:
+    """
+    Assignment of per-sample results to the datasets (DS1, DS2, DS3, ...) of distribution.json.
+
+    The id→dataset index is built once; `sum()` then reduces a per-sample metric for every
+    dataset and overall in one pass. Sums are accumulated sequentially in sample order
+    (np.bincount), so they are bit-identical to adding the samples one by one.
+    """
+
+    def __init__(self, keys: Iterable[str], distribution: Dict[str, List[str]]):
+        index = build_id_index(distribution)
+        self.names = list(distribution.keys())
+        self.positions: List[int] = []
+        codes = []
+        for pos, key in enumerate(keys):
+            code = index.get(key)
+            if code is None:
+                continue
+            self.positions.append(pos)
+            codes.append(code)
+        self.codes = np.asarray(codes, dtype=np.intp)
+        # datasets that have samples, in the order of their first sample
+        self.order = list(dict.fromkeys(codes))
+
+    def sum(self, values: Sequence[float]) -> np.ndarray:
+        """Per-dataset sums of `values` (one per sample, in key order), followed by the overall sum."""
+        weights = np.asarray(values, dtype=np.float64)[self.positions] if self.positions else np.zeros(0)
+        per_dataset = np.bincount(self.codes, weights=weights, minlength=len(self.names))
+        overall = np.bincount(np.zeros(len(weights), dtype=np.intp), weights=weights, minlength=1)
+        return np.concatenate([per_dataset, overall])
+
+    def count(self) -> np.ndarray:
+        """Number of samples per dataset, followed by the overall count."""
+        per_dataset = np.bincount(self.codes, minlength=len(self.names)).astype(np.float64)
+        return np.append(per_dataset, float(len(self.codes)))
+
+    def summary(self, model_name: str, build: Callable[[int], Dict]) -> Dict[str, Dict]:
+        """
+        Assemble {dataset: {model_name: metrics}, model_name: metrics} with `build(i)` giving
+        the metrics of dataset i, or overall for i = -1.
+
+        Key order matches the previous incremental implementation: datasets in order of
+        their first sample, with the overall entry right after the first dataset.
+        """
+        model_summary = {}
+        for n, code in enumerate(self.order):
+            model_summary[self.names[code]] = {model_name: build(code)}
+            if n == 0:
+                model_summary[model_name] = build(-1)
+        return model_summary
+
+
+def field(items: Sequence[Dict], name: str, default: Optional[float] = None) -> List:
+    """Column `name` of a list of per-sample dicts, with None replaced by `default` if given."""
+    if default is None:
+        return [item[name] for item in items]
+    return [default if item[name] is None else item[name] for item in items]
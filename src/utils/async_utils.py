@@ -0,0 +1,47 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Iterable
+
+from tqdm import tqdm
+
+
+def run_async_tasks(
+    task_fn: Callable[[Any], Awaitable[Any]],
+    items: Iterable[Any],
+    on_result: Callable[[Any], None],
+    max_inflight: int = 1024,
+    desc: str = "Processing",
+) -> None:
+    """
+    Run `task_fn(item)` for every item from a single event loop.
+
+    At most `max_inflight` tasks are alive at any time; new ones are started as soon as
+    earlier ones finish. `on_result` is called on the event-loop thread for each finished
+    task, in completion order (same contract as iterating `as_completed` on futures).
+
+    Args:
+        task_fn (Callable): Coroutine function taking one item.
+        items (Iterable): Items to process.
+        on_result (Callable): Called with the return value of each task.
+        max_inflight (int): Maximum number of concurrently running tasks.
+        desc (str): Progress bar description.
+    """
+    items = list(items)
+
+    async def _drive():
+        pending = set()
+        it = iter(items)
+        with tqdm(total=len(items), desc=desc, unit="task", dynamic_ncols=True) as pbar:
+            while True:
+                while len(pending) < max_inflight:
+                    item = next(it, None)
+                    if item is None:
+                        break
+                    pending.add(asyncio.create_task(task_fn(item)))
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    on_result(t.result())
+                    pbar.update(1)
+
+    asyncio.run(_drive())
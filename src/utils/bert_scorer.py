@@ -0,0 +1,261 @@
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from bert_score import BERTScorer
+from bert_score.utils import bert_encode, get_idf_dict, greedy_cos_idf, padding, sent_encode
+from torch.nn.utils.rnn import pad_sequence
+from tqdm import tqdm
+
+from src.utils.embedding_cache import EmbeddingCache, cache_dir_for
+from src.utils.length_batching import fixed_batches, padded_tokens, token_budget_batches
+
+DTYPES = {"float32": torch.float32, "float16": torch.float16, "bfloat16": torch.bfloat16}
+
+
+def is_out_of_memory(e: Exception) -> bool:
+    return isinstance(e, torch.cuda.OutOfMemoryError) or "out of memory" in str(e).lower()
+
+
+class BertScoreEngine:
+    """
+    Resident `bert_score.BERTScorer`.
+
+    The model, tokenizer and rescale baseline are loaded once (on first use) and reused for every
+    chunk and every evaluated model of the process, where `bert_score.score()` rebuilt them per call.
+    Failed calls are retried a bounded number of times; out-of-memory errors halve the batch size.
+
+    Scoring follows `bert_score.utils.bert_cos_score_idf` (same tokenization, embedding batches
+    and greedy matching), with two additions: with `cache_root` set, reference embeddings are
+    kept in an EmbeddingCache, so later evaluations only embed the candidates; with
+    `token_budget` set, sentences and pairs are batched by token length under that many padded
+    tokens per batch instead of `batch_size` at a time (see `token_budget_batches`).
+    """
+
+    def __init__(
+        self,
+        lang: str = "en",
+        model_type: Optional[str] = None,
+        num_layers: Optional[int] = None,
+        device: Optional[str] = None,
+        batch_size: int = 64,
+        token_budget: Optional[int] = None,
+        dtype: str = "float32",
+        rescale_with_baseline: bool = True,
+        baseline_path: Optional[str] = None,
+        idf: bool = False,
+        cache_root: Optional[str] = None,
+        max_retries: int = 3,
+        retry_delay: float = 5.0,
+    ):
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported dtype {dtype!r}, expected one of {list(DTYPES)}")
+        self.lang = lang
+        self.model_type = model_type
+        self.num_layers = num_layers
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.batch_size = batch_size
+        self.token_budget = token_budget
+        self.dtype = dtype
+        self.rescale_with_baseline = rescale_with_baseline
+        self.baseline_path = baseline_path
+        self.idf = idf
+        self.cache_root = cache_root
+        self.embedding_cache: Optional[EmbeddingCache] = None
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+
+        self.lock = threading.Lock()
+        self._scorer = None
+        self.load_seconds = 0.0
+        self.calls = 0
+        self.pairs = 0
+        self.embedded = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+        self.retries = 0
+        self.score_seconds = 0.0
+
+    @property
+    def scorer(self):
+        """The underlying `bert_score.BERTScorer`, loaded on first access."""
+        if self._scorer is None:
+            start = time.time()
+            scorer = BERTScorer(
+                model_type=self.model_type,
+                num_layers=self.num_layers,
+                lang=self.lang,
+                device=self.device,
+                batch_size=self.batch_size,
+                rescale_with_baseline=self.rescale_with_baseline,
+                baseline_path=self.baseline_path,
+            )
+            scorer._model.to(dtype=DTYPES[self.dtype]).eval()
+            if self.rescale_with_baseline:
+                # read the baseline file now rather than inside the first score() call
+                scorer.baseline_vals
+            if self.cache_root:
+                self.embedding_cache = EmbeddingCache(
+                    cache_dir_for(self.cache_root, scorer.model_type, scorer.num_layers, self.dtype, scorer._tokenizer.model_max_length),
+                    dim=scorer._model.config.hidden_size,
+                )
+            self._scorer = scorer
+            self.load_seconds = time.time() - start
+        return self._scorer
+
+    def embed(self, sentences: List[str], verbose: bool = False) -> Dict[str, Tuple[torch.Tensor, torch.Tensor]]:
+        """
+        Returns:
+            dict: sentence -> (float32 CPU embeddings [tokens, dim], token ids [tokens]).
+        """
+        scorer = self.scorer
+        tokenizer = scorer._tokenizer
+        if self.token_budget:
+            sentences = list(dict.fromkeys(sentences))
+            tokens = [sent_encode(tokenizer, sentence) for sentence in sentences]
+            batches = token_budget_batches([len(t) for t in tokens], self.token_budget)
+        else:
+            # as bert_score: longest sentences (in words) first, `batch_size` at a time
+            sentences = sorted(set(sentences), key=lambda x: len(x.split(" ")), reverse=True)
+            tokens = [sent_encode(tokenizer, sentence) for sentence in sentences]
+            batches = fixed_batches(len(sentences), self.batch_size)
+        self.real_tokens += sum(len(t) for t in tokens)
+        self.padded_tokens += padded_tokens([len(t) for t in tokens], batches)
+
+        res = {}
+        for batch in (tqdm(batches, desc="Embedding", dynamic_ncols=True) if verbose else batches):
+            padded, lens, mask = padding([tokens[i] for i in batch], tokenizer.pad_token_id, dtype=torch.long)
+            embeddings = bert_encode(scorer._model, padded.to(self.device), attention_mask=mask.to(self.device)).float().cpu()
+            for j, i in enumerate(batch):
+                res[sentences[i]] = (embeddings[j, :lens[j]], torch.tensor(tokens[i], dtype=torch.long))
+        self.embedded += len(res)
+        return res
+
+    def idf_dict(self, refs: List[str]) -> Dict[int, float]:
+        tokenizer = self.scorer._tokenizer
+        if self.idf:
+            return get_idf_dict(refs, tokenizer, nthreads=self.scorer.nthreads)
+        idf_dict = defaultdict(lambda: 1.0)
+        idf_dict[tokenizer.sep_token_id] = 0
+        idf_dict[tokenizer.cls_token_id] = 0
+        return idf_dict
+
+    def _pad(self, stats: List[Tuple[torch.Tensor, torch.Tensor]], idf_dict: Dict[int, float]) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        emb = [e.to(self.device) for e, _ in stats]
+        idf = [torch.tensor([idf_dict[t] for t in tokens.tolist()], dtype=torch.float, device=self.device) for _, tokens in stats]
+        lens = torch.tensor([e.size(0) for e in emb], dtype=torch.long)
+        emb_pad = pad_sequence(emb, batch_first=True, padding_value=2.0)
+        idf_pad = pad_sequence(idf, batch_first=True)
+        pad_mask = torch.arange(int(lens.max())).expand(len(lens), -1) < lens.unsqueeze(1)
+        return emb_pad, pad_mask.to(self.device), idf_pad
+
+    def match(
+        self, cands: List[str], refs: List[str],
+        stats: Dict[str, Tuple[torch.Tensor, torch.Tensor]],
+        idf_dict: Dict[int, float],
+    ) -> torch.Tensor:
+        """Greedy cosine matching of each candidate/reference pair, [pairs, 3] (P, R, F1) before rescaling."""
+        if self.token_budget:
+            lengths = [max(stats[ref][1].size(0), stats[cand][1].size(0)) for cand, ref in zip(cands, refs)]
+            batches = token_budget_batches(lengths, self.token_budget)
+        else:
+            batches = fixed_batches(len(refs), self.batch_size)
+        preds = torch.zeros(len(refs), 3)
+        with torch.no_grad():
+            for batch in batches:
+                ref_stats = self._pad([stats[refs[i]] for i in batch], idf_dict)
+                hyp_stats = self._pad([stats[cands[i]] for i in batch], idf_dict)
+                P, R, F1 = greedy_cos_idf(*ref_stats, *hyp_stats, False)
+                # scatter back to the pair order
+                preds[batch] = torch.stack((P, R, F1), dim=-1).float().cpu()
+        return preds
+
+    def _score(self, cands: List[str], refs: List[str], verbose: bool = False, idf_refs: Optional[List[str]] = None) -> torch.Tensor:
+        scorer = self.scorer
+        stats = {}
+        if self.embedding_cache is not None:
+            for sentence, (embeddings, tokens) in self.embedding_cache.get_many(refs).items():
+                stats[sentence] = (torch.tensor(embeddings), torch.tensor(tokens, dtype=torch.long))
+        missing_refs = [ref for ref in dict.fromkeys(refs) if ref not in stats]
+        stats.update(self.embed(missing_refs + list(cands), verbose=verbose))
+        if self.embedding_cache is not None and missing_refs:
+            self.embedding_cache.put_many({ref: (stats[ref][0].numpy(), stats[ref][1].numpy()) for ref in missing_refs})
+
+        preds = self.match(cands, refs, stats, self.idf_dict(refs if idf_refs is None else idf_refs))
+        if self.rescale_with_baseline:
+            preds = (preds - scorer.baseline_vals) / (1 - scorer.baseline_vals)
+        return preds
+
+    def score(
+        self, cands: List[str], refs: List[str], verbose: bool = False, idf_refs: Optional[List[str]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            idf_refs: Reference corpus of the IDF weights (with `idf`), defaults to `refs`.
+
+        Returns:
+            tuple: (P, R, F1) float32 CPU tensors, one value per candidate/reference pair.
+        """
+        with self.lock:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    start = time.time()
+                    preds = self._score(cands, refs, verbose=verbose, idf_refs=idf_refs)
+                    self.score_seconds += time.time() - start
+                    self.calls += 1
+                    self.pairs += len(cands)
+                    return preds[:, 0], preds[:, 1], preds[:, 2]
+                except Exception as e:
+                    if attempt == self.max_retries:
+                        raise
+                    self.retries += 1
+                    if is_out_of_memory(e) and (self.batch_size > 1 or (self.token_budget or 0) > 1):
+                        self.batch_size = max(1, self.batch_size // 2)
+                        if self.token_budget:
+                            self.token_budget = max(1, self.token_budget // 2)
+                        if torch.cuda.is_available():
+                            torch.cuda.empty_cache()
+                        delay = 0.0
+                    else:
+                        delay = self.retry_delay * (attempt + 1)
+                    tqdm.write(f"[BERTScore] {type(e).__name__}: {e}; retrying in {delay:.0f}s with {self._batching()} ({attempt + 1}/{self.max_retries})")
+                    time.sleep(delay)
+
+    def _batching(self) -> str:
+        return f"token budget {self.token_budget}" if self.token_budget else f"batch size {self.batch_size}"
+
+    def summary(self) -> str:
+        model = self._scorer.model_type if self._scorer is not None else (self.model_type or self.lang)
+        padding_pct = 100 * (1 - self.real_tokens / self.padded_tokens) if self.padded_tokens else 0.0
+        return (
+            f"[BERTScore] {model} on {self.device} ({self.dtype}, {self._batching()}): "
+            f"loaded once in {self.load_seconds:.1f}s, {self.calls} calls, {self.pairs} pairs in {self.score_seconds:.1f}s, "
+            f"{self.embedded} sentences embedded ({padding_pct:.1f}% padding), retries: {self.retries}"
+        ) + (f"\n{self.embedding_cache.summary()}" if self.embedding_cache is not None else "")
+
+
+BERT_SCORERS: Dict[Tuple, BertScoreEngine] = {}
+
+def get_bert_scorer(**options) -> BertScoreEngine:
+    """Process-wide BertScoreEngine for the given options (see BertScoreEngine.__init__), created on first use."""
+    key = tuple(sorted(options.items()))
+    if key not in BERT_SCORERS:
+        BERT_SCORERS[key] = BertScoreEngine(**options)
+    return BERT_SCORERS[key]
+
+def bert_scorer_from_args(args) -> BertScoreEngine:
+    return get_bert_scorer(
+        lang="en",
+        model_type=args.bertscore_model,
+        num_layers=args.bertscore_num_layers,
+        baseline_path=args.bertscore_baseline_path,
+        device=args.bertscore_device,
+        batch_size=args.bertscore_batch_size,
+        token_budget=args.bertscore_token_budget,
+        dtype=args.bertscore_dtype,
+        idf=args.bertscore_idf,
+        cache_root=args.bertscore_cache_dir if args.bertscore_cache else None,
+        max_retries=args.bertscore_max_retries,
+    )
@@ -0,0 +1,99 @@
+"""
+Padding and throughput of BERTScore batching on the captioning benchmark.
+
+    python -m src.utils.bertscore_benchmark --token_budget 16384 --device cpu
+
+Scores the captions of data/captioning.json against the predictions of `--predictions`
+(a prediction results.json), or against the reference of the next sample when it is not
+given, once with fixed `--batch_size` batches and once with token-budget batches, and
+reports the padding ratio of both and the samples/sec of the two runs.
+"""
+import argparse
+import time
+
+from bert_score.utils import sent_encode
+from tqdm import tqdm
+
+from src.utils.bert_scorer import BertScoreEngine
+from src.utils.file_io import load_captioning_data, load_data
+from src.utils.length_batching import fixed_batches, padding_ratio, token_budget_batches
+
+
+def load_pairs(predictions_path=None):
+    label_json = load_captioning_data()
+    keys = list(label_json)
+    if predictions_path:
+        vlm_json = load_data(predictions_path)
+        keys = [k for k in keys if k in vlm_json]
+        cands = [str(vlm_json[k]["description"]) for k in keys]
+    else:
+        cands = [str(label_json[k]["description"]) for k in keys[1:] + keys[:1]]
+    refs = [str(label_json[k]["description"]) for k in keys]
+    return keys, cands, refs
+
+def padding_report(engine: BertScoreEngine, cands, refs, token_budget: int) -> dict:
+    """Padding ratio of the embedding batches and the matching batches for each schedule."""
+    tokenizer = engine.scorer._tokenizer
+    lengths = {s: len(sent_encode(tokenizer, s)) for s in set(cands) | set(refs)}
+    unique = list(dict.fromkeys(refs + cands))
+    by_words = sorted(set(unique), key=lambda x: len(x.split(" ")), reverse=True)
+    pair_lengths = [max(lengths[c], lengths[r]) for c, r in zip(cands, refs)]
+    return {
+        "dataset order": (
+            padding_ratio([lengths[s] for s in unique], fixed_batches(len(unique), engine.batch_size)),
+            padding_ratio(pair_lengths, fixed_batches(len(pair_lengths), engine.batch_size)),
+        ),
+        f"fixed (batch size {engine.batch_size})": (
+            padding_ratio([lengths[s] for s in by_words], fixed_batches(len(by_words), engine.batch_size)),
+            padding_ratio(pair_lengths, fixed_batches(len(pair_lengths), engine.batch_size)),
+        ),
+        f"token budget {token_budget}": (
+            padding_ratio([lengths[s] for s in unique], token_budget_batches([lengths[s] for s in unique], token_budget)),
+            padding_ratio(pair_lengths, token_budget_batches(pair_lengths, token_budget)),
+        ),
+    }
+
+def timed_score(engine: BertScoreEngine, cands, refs, repeat: int):
+    best, F1 = float("inf"), None
+    for _ in range(repeat):
+        start = time.time()
+        _, _, F1 = engine.score(cands, refs)
+        best = min(best, time.time() - start)
+    return best, F1
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--predictions", type=str, default=None, help="Prediction results.json to use as candidates (default: the reference of the next sample)")
+    parser.add_argument("--model", type=str, default=None, help="BERTScore model name or local path (default: roberta-large)")
+    parser.add_argument("--num_layers", type=int, default=None, help="BERTScore representation layer")
+    parser.add_argument("--baseline_path", type=str, default=None, help="Rescale baseline file, needed when --model is a local path")
+    parser.add_argument("--device", type=str, default=None, help="Torch device (default: cuda if available)")
+    parser.add_argument("--dtype", type=str, choices=["float32", "float16", "bfloat16"], default="float32")
+    parser.add_argument("--batch_size", type=int, default=64, help="Batch size of the fixed schedule")
+    parser.add_argument("--token_budget", type=int, default=16384, help="Padded tokens per batch of the token-budget schedule")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per schedule, the fastest counts")
+    args = parser.parse_args()
+
+    keys, cands, refs = load_pairs(args.predictions)
+    engine = BertScoreEngine(
+        model_type=args.model, num_layers=args.num_layers, baseline_path=args.baseline_path,
+        device=args.device, batch_size=args.batch_size, dtype=args.dtype,
+    )
+    tqdm.write(f"[BERTScore benchmark] {len(keys)} pairs, {len(set(cands) | set(refs))} distinct captions")
+    for name, (embedding, matching) in padding_report(engine, cands, refs, args.token_budget).items():
+        tqdm.write(f"  {name:<24} padding: embedding {100 * embedding:5.1f}%, matching {100 * matching:5.1f}%")
+
+    # warm-up (first call pays for lazy initialization inside torch)
+    engine.score(cands[:2], refs[:2])
+    fixed_seconds, fixed_F1 = timed_score(engine, cands, refs, args.repeat)
+    engine.token_budget = args.token_budget
+    bucketed_seconds, bucketed_F1 = timed_score(engine, cands, refs, args.repeat)
+
+    tqdm.write(f"  fixed (batch size {args.batch_size}): {len(keys) / fixed_seconds:.2f} samples/s ({fixed_seconds:.2f}s)")
+    tqdm.write(f"  token budget {args.token_budget}: {len(keys) / bucketed_seconds:.2f} samples/s ({bucketed_seconds:.2f}s), "
+               f"speedup x{fixed_seconds / bucketed_seconds:.2f}")
+    tqdm.write(f"  max |F1 difference|: {(fixed_F1 - bucketed_F1).abs().max().item():.2e}")
+
+
+if __name__ == "__main__":
+    main()
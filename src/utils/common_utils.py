@@ -5,6 +5,8 @@ from pathlib import Path
 
 from tqdm import tqdm
 
+from src.utils.result_store import get_result_store
+
 
 def encode_image(image_path: str) -> str:
     """
@@ -208,6 +210,9 @@ def confirm_restart_if_exists(args: Namespace, completed: set) -> set:
                     if os.path.exists(fpath):
                         os.remove(fpath)
                         tqdm.write(f"Deleted '{fpath}'.")
+                if args.result_store == "sqlite":
+                    get_result_store(os.path.dirname(args.outfile)).clear()
+                    tqdm.write(f"Cleared the result store of '{os.path.dirname(args.outfile)}'.")
                 tqdm.write("Previous data deleted. Starting fresh.")
             except Exception as e:
                 tqdm.write(f"Failed to delete files: {e}")
@@ -218,3 +223,26 @@ def confirm_restart_if_exists(args: Namespace, completed: set) -> set:
             return completed
         else:
             tqdm.write("Invalid input. Please enter 'Y' or 'N'.")
+
+def set_output_files(args: Namespace) -> None:
+    """
+    Set the JSONL output files of `args.model_name` for generation, prediction and captioning
+    evaluation (args.outfile, args.translatefile, args.failfile and args.refinefile) and delete
+    the failures of the previous run.
+    """
+    args.outfile = os.path.join(args.save_root_dir, args.task, args.subtask, args.model_name, "results.jsonl")
+    os.makedirs(os.path.dirname(args.outfile), exist_ok=True)
+    args.translatefile = os.path.join(args.save_root_dir, args.task, args.subtask, args.model_name, "translate.jsonl")
+    os.makedirs(os.path.dirname(args.translatefile), exist_ok=True)
+    args.failfile = os.path.join(args.save_root_dir, args.task, args.subtask, args.model_name, "failures.jsonl")
+    os.makedirs(os.path.dirname(args.failfile), exist_ok=True)
+
+    if os.path.exists(args.failfile):
+        os.remove(args.failfile)
+        print(f"Deleted '{args.failfile}'.")
+    if args.result_store == "sqlite":
+        get_result_store(os.path.dirname(args.outfile)).clear("failures")
+
+    # captioning
+    args.refinefile = os.path.join(args.save_root_dir, args.task, args.subtask, args.model_name, "refine.jsonl")
+    os.makedirs(os.path.dirname(args.refinefile), exist_ok=True)
@@ -35,7 +35,7 @@ def load_model_config(args: argparse.Namespace):
 
 def load_args():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--model_name", type=str, required=True, help="Model name or path to use (for local or API mode).")
+    parser.add_argument("--model_name", type=str, default=None, help="Model name or path to use (for local or API mode). Required for all tasks except 'mirror'.")
     parser.add_argument("--evaluator_model_name", type=str, default=None, help="Name or path of the LLM used for evaluation. This parameter is required only when the task is 'evaluation' and the subtask is 'captioning'. The evaluator model must be available either locally or via an API, and it will be used to assess the generated captions.")
     parser.add_argument("--do_sample", action="store_true", default=False, help="Whether to sample from the model.")
     parser.add_argument("--temperature", type=float, default=0.0, help="Temperature for sampling. Higher temperature results in more random output.")
@@ -43,20 +43,72 @@ def load_args():
     parser.add_argument("--client_type",  type=str, choices=["local", "api"], default="api", help="Choose how to load the model: 'local' for local weights, or 'api' for remote (OpenAI/vLLM-compatible) endpoints.")
     
     parser.add_argument("--gpus", type=str, default=None, help="GPUs to use (comma-separated), e.g. 0,1,2,3. If not specified, all GPUs will be used.")
+    parser.add_argument("--device", type=str, default="cuda", help="Torch device for local models, e.g. cuda, cuda:1 or cpu")
+    parser.add_argument("--local_batch_size", type=int, default=1, help="Batch up to this many concurrent requests into one generate call for local models (1 = no batching). Also sets the number of producer threads.")
+    parser.add_argument("--local_batch_wait_ms", type=float, default=50, help="Maximum time a local batch waits to fill up before it is dispatched")
     parser.add_argument("--api_base_url", type=str, default=None, help="Base URL for the OpenAI-compatible API (e.g. http://localhost:8000/v1)")
     parser.add_argument("--api_key", type=str, default=None, help="API key for the OpenAI-compatible API.")
     
-    parser.add_argument("--task", type=str, required=True, choices=["generation", "prediction", "evaluation"], help="Main task type: 'generation' to generate data, 'prediction' to run VLM, 'evaluation' to compute evaluation metrics")
-    parser.add_argument("--subtask", type=str, required=True, choices=["vqa", "classification", "captioning"], help="Sub-task type")
+    parser.add_argument("--task", type=str, required=True, choices=["generation", "prediction", "evaluation", "mirror", "translate"], help="Main task type: 'generation' to generate data, 'prediction' to run VLM, 'evaluation' to compute evaluation metrics, 'mirror' to sync the LFSS metadata of [start, end] into the local mirror, 'translate' to prefill the translation store with the cn labels of [start, end]")
+    parser.add_argument("--subtask", type=str, default=None, choices=["vqa", "classification", "captioning"], help="Sub-task type. Required for all tasks except 'mirror' and 'translate'.")
     
     parser.add_argument("--start", type=int, default=1, help="Start index (inclusive)")
     parser.add_argument("--end", type=int, default=100, help="End index (inclusive)")
     parser.add_argument("--workers", type=int, default=8, help="Number of threads to use")
+    parser.add_argument("--async_mode", action="store_true", default=False, help="Drive API requests from a single asyncio event loop (AsyncOpenAI) instead of one thread per request. Only for --client_type api.")
+    parser.add_argument("--max_inflight", type=int, default=1024, help="Maximum number of in-flight API requests in --async_mode")
+    
+    parser.add_argument("--pipeline_fetch_workers", type=int, default=None, help="[Generation] Threads reading labels from LFSS (default: --workers)")
+    parser.add_argument("--pipeline_translate_workers", type=int, default=None, help="[Generation] Threads running zh->en translation calls for cn labels (default: --workers)")
+    parser.add_argument("--pipeline_generate_workers", type=int, default=None, help="[Generation] Threads running generation calls (default: --workers)")
+    parser.add_argument("--pipeline_verify_workers", type=int, default=None, help="[VQA generation] Threads running verifier calls (default: --workers)")
+    parser.add_argument("--pipeline_queue_size", type=int, default=64, help="[Generation] Capacity of the queue in front of each pipeline stage")
+    
+    parser.add_argument("--image_cache_mb", type=float, default=512, help="Memory budget of the shared LRU cache of base64-encoded images")
+    parser.add_argument("--response_cache", action="store_true", default=False, help="Cache model responses on disk (SQLite) and replay them for identical calls (model, prompt, image content, temperature, output type).")
+    parser.add_argument("--response_cache_path", type=str, default="data/cache/responses.sqlite", help="Path of the response cache database")
+    parser.add_argument("--response_cache_max_mb", type=float, default=2048, help="Evict least recently used responses above this size (0 = unlimited)")
+    parser.add_argument("--response_cache_max_age_days", type=float, default=30, help="Evict responses older than this many days (0 = never)")
+    parser.add_argument("--response_cache_sampled", action="store_true", default=False, help="Also cache calls with temperature > 0 (by default only deterministic calls are cached)")
+    parser.add_argument("--prefix_cache_prompts", action="store_true", default=False, help="Build every prompt with its static instructions first and the per-sample inputs last, so requests share a long prefix for the server's prefix cache (vLLM automatic prefix caching). Changes the prompt text.")
+    
+    parser.add_argument("--rate_limit_db", type=str, default="data/cache/rate_limits.sqlite", help="State file of the rate limits configured under `rate_limits` in config.yaml, shared by all processes on this host")
     
     parser.add_argument("--lfss_meta_type", type=str, choices=["cn", "en"], default="en", help="Language of the meta data, cn or en")
+    parser.add_argument("--lfss_pool_size", type=int, default=None, help="Keep-alive connections in the shared LFSS connector pool (default: --workers)")
+    parser.add_argument("--lfss_mirror", action="store_true", default=False, help="Read skip/label/info.json from the local metadata mirror (see --task mirror); ids that were never mirrored are read from LFSS")
+    parser.add_argument("--lfss_mirror_path", type=str, default="data/cache/lfss_meta.sqlite", help="Path of the local LFSS metadata mirror")
+    parser.add_argument("--translation_store", action="store_true", default=False, help="Look up zh->en label translations in the shared translation store (see --task translate) and add new ones to it; shared by the generators of all subtasks and the captioning evaluator")
+    parser.add_argument("--translation_store_path", type=str, default="data/cache/translations.sqlite", help="Path of the translation store")
+    parser.add_argument("--translation_version", type=str, default="", help="Version tag of the stored translations; a new tag translates again instead of reusing translations stored under another one")
+    parser.add_argument("--result_store", type=str, choices=["jsonl", "sqlite"], default="jsonl", help="Backend of the per-sample outputs of a run: 'jsonl' appends to results/translate/failures/refine.jsonl, 'sqlite' upserts into an indexed results.sqlite (WAL) in the same directory, importing existing JSONL files once. Both export the same results.json.")
+    parser.add_argument("--writer_batch_size", type=int, default=64, help="Records written together by the background output writer (one write + flush per file, or one SQLite transaction)")
+    parser.add_argument("--writer_flush_interval", type=float, default=1.0, help="Seconds a record waits at most in the output writer before its batch is written")
+    parser.add_argument("--fsync", type=str, choices=["never", "batch", "close"], default="close", help="When the outputs are forced to disk: after every written batch, once at the end of the run, or never (left to the OS)")
     parser.add_argument("--test_mode", action="store_true", default=False, help="Whether to run in test mode (use private data)")
     
+    # evaluation
+    parser.add_argument("--sweep", action="store_true", default=False, help="[Evaluation] Evaluate every model with predictions under data/prediction/<subtask>/ (no --model_name needed), sharing the loaded data, and write metric/<subtask>/leaderboard.csv")
+    parser.add_argument("--sweep_workers", type=int, default=None, help="[Evaluation] Processes evaluating models in parallel in --sweep for vqa and classification (default: CPU count); captioning models are evaluated one by one with the shared BERTScore model and evaluator client")
+    
+    parser.add_argument("--incremental", action="store_true", default=False, help="[Evaluation] Only evaluate samples whose prediction or reference changed since the last evaluation (per-sample fingerprints in eval_state.json) and merge them into the existing per_sample.json")
+    
+    # vqa
+    parser.add_argument("--vqa_batch_questions", action="store_true", default=False, help="[VQA prediction] Answer all questions of a sample in a single request (one image upload/prefill); malformed replies fall back to one request per question")
+    parser.add_argument("--vqa_batch_verify", action="store_true", default=False, help="[VQA generation] Verify all generated questions of a sample in a single request; malformed replies fall back to one request per question")
+    
     # captioning
     parser.add_argument("--chunk", action="store_true", help="Whether to chunk the data into smaller batches to avoid GPU memory issues")
     parser.add_argument("--chunk_size", type=int, default=512, help="Size of each chunk")
+    parser.add_argument("--bertscore_model", type=str, default=None, help="[Captioning evaluation] BERTScore model name or local path (default: roberta-large)")
+    parser.add_argument("--bertscore_num_layers", type=int, default=None, help="[Captioning evaluation] BERTScore representation layer (default: the tuned layer of the model)")
+    parser.add_argument("--bertscore_baseline_path", type=str, default=None, help="[Captioning evaluation] Rescale baseline file, needed when --bertscore_model is a local path")
+    parser.add_argument("--bertscore_device", type=str, default=None, help="[Captioning evaluation] Torch device of the BERTScore model, e.g. cuda, cuda:1 or cpu (default: cuda if available)")
+    parser.add_argument("--bertscore_batch_size", type=int, default=64, help="[Captioning evaluation] BERTScore batch size")
+    parser.add_argument("--bertscore_token_budget", type=int, default=None, help="[Captioning evaluation] Batch BERTScore sentences and pairs by token length, up to this many padded tokens per batch (e.g. 16384), instead of --bertscore_batch_size at a time in input order")
+    parser.add_argument("--bertscore_dtype", type=str, choices=["float32", "float16", "bfloat16"], default="float32", help="[Captioning evaluation] BERTScore model dtype (bfloat16 is the usual choice for reduced precision on CPU)")
+    parser.add_argument("--bertscore_idf", action="store_true", default=False, help="[Captioning evaluation] Weight BERTScore tokens by IDF computed on the references")
+    parser.add_argument("--bertscore_cache", action="store_true", default=False, help="[Captioning evaluation] Keep the reference caption embeddings on disk and reuse them for every evaluated model")
+    parser.add_argument("--bertscore_cache_dir", type=str, default="data/cache/bertscore", help="[Captioning evaluation] Root directory of the reference embedding cache (one subdirectory per scorer model/layer/dtype)")
+    parser.add_argument("--bertscore_max_retries", type=int, default=3, help="[Captioning evaluation] Retries of a failed BERTScore call; out-of-memory errors halve the batch size")
     return parser.parse_args()
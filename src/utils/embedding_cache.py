@@ -0,0 +1,133 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+EMBEDDING_DTYPE = np.float32
+TOKEN_DTYPE = np.int32
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of contextual token embeddings of sentences (the captioning references).
+
+    Embeddings are appended to a flat float32 file (`embeddings.f32`, one row of `dim` values
+    per token) and token ids to `tokens.i32`. Both are read through np.memmap, so a lookup
+    only pages in the rows it touches. An SQLite index maps the caption hash to its
+    (offset, length) in rows. IDF weights depend on the reference corpus, so they are not
+    stored: they are derived from the stored token ids when needed.
+
+    One cache directory holds the embeddings of one scorer (model, layer, dtype, max length),
+    see `cache_dir_for`. Appends are serialized across processes by the SQLite write lock,
+    rows written by a process that dies before committing are never referenced.
+    """
+
+    def __init__(self, cache_dir: str, dim: int):
+        self.cache_dir = cache_dir
+        self.dim = dim
+        os.makedirs(cache_dir, exist_ok=True)
+        self.emb_path = os.path.join(cache_dir, "embeddings.f32")
+        self.tok_path = os.path.join(cache_dir, "tokens.i32")
+        for path in (self.emb_path, self.tok_path):
+            open(path, "ab").close()
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS entries (hash TEXT PRIMARY KEY, offset INTEGER, length INTEGER)")
+        self.conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('dim', ?)", (str(dim),))
+        stored_dim = int(self.conn.execute("SELECT value FROM meta WHERE key = 'dim'").fetchone()[0])
+        if stored_dim != dim:
+            raise ValueError(f"{cache_dir} holds {stored_dim}-dim embeddings, expected {dim}")
+
+        self._rows = -1
+        self._emb: Optional[np.memmap] = None
+        self._tok: Optional[np.memmap] = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _views(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Memory maps of both files, re-opened when another writer has appended rows."""
+        rows = min(
+            os.path.getsize(self.emb_path) // (self.dim * np.dtype(EMBEDDING_DTYPE).itemsize),
+            os.path.getsize(self.tok_path) // np.dtype(TOKEN_DTYPE).itemsize,
+        )
+        if rows != self._rows:
+            self._rows = rows
+            if rows:
+                self._emb = np.memmap(self.emb_path, dtype=EMBEDDING_DTYPE, mode="r", shape=(rows, self.dim))
+                self._tok = np.memmap(self.tok_path, dtype=TOKEN_DTYPE, mode="r", shape=(rows,))
+            else:
+                self._emb = np.zeros((0, self.dim), dtype=EMBEDDING_DTYPE)
+                self._tok = np.zeros(0, dtype=TOKEN_DTYPE)
+        return self._emb, self._tok
+
+    def get_many(self, texts: Iterable[str]) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """
+        Returns:
+            dict: text -> (embeddings [tokens, dim], token ids [tokens]) read-only views, for the cached texts.
+        """
+        texts = list(dict.fromkeys(texts))
+        hashes = {self.text_hash(text): text for text in texts}
+        res = {}
+        with self.lock:
+            rows = []
+            keys = list(hashes)
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                rows += self.conn.execute(
+                    f"SELECT hash, offset, length FROM entries WHERE hash IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+            emb, tok = self._views()
+            for h, offset, length in rows:
+                res[hashes[h]] = (emb[offset:offset + length], tok[offset:offset + length])
+            self.hits += len(res)
+            self.misses += len(texts) - len(res)
+        return res
+
+    def put_many(self, items: Dict[str, Tuple[np.ndarray, np.ndarray]]) -> None:
+        """Append (embeddings [tokens, dim], token ids [tokens]) of each text."""
+        if not items:
+            return
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                offset = os.path.getsize(self.emb_path) // (self.dim * np.dtype(EMBEDDING_DTYPE).itemsize)
+                # a crashed writer may have left a partial row or unmatched token ids, start after them
+                offset = max(offset, os.path.getsize(self.tok_path) // np.dtype(TOKEN_DTYPE).itemsize)
+                entries = []
+                with open(self.emb_path, "r+b") as f_emb, open(self.tok_path, "r+b") as f_tok:
+                    f_emb.seek(offset * self.dim * np.dtype(EMBEDDING_DTYPE).itemsize)
+                    f_tok.seek(offset * np.dtype(TOKEN_DTYPE).itemsize)
+                    for text, (embeddings, tokens) in items.items():
+                        embeddings = np.ascontiguousarray(embeddings, dtype=EMBEDDING_DTYPE).reshape(-1, self.dim)
+                        tokens = np.ascontiguousarray(tokens, dtype=TOKEN_DTYPE)
+                        f_emb.write(embeddings.tobytes())
+                        f_tok.write(tokens.tobytes())
+                        entries.append((self.text_hash(text), offset, len(tokens)))
+                        offset += len(tokens)
+                self.conn.executemany("INSERT OR REPLACE INTO entries (hash, offset, length) VALUES (?, ?, ?)", entries)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def summary(self) -> str:
+        size_mb = (os.path.getsize(self.emb_path) + os.path.getsize(self.tok_path)) / 1024 / 1024
+        entries = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return f"[EmbeddingCache] {self.cache_dir}: hits: {self.hits}, misses: {self.misses}, entries: {entries} ({size_mb:.1f} MB)"
+
+
+def cache_dir_for(root: str, model_type: str, num_layers: int, dtype: str, max_length: int) -> str:
+    """Cache directory of one scorer configuration under `root`."""
+    slug = re.sub(r"[^A-Za-z0-9._-]+", "_", model_type.strip("/"))
+    return os.path.join(root, f"{slug}-L{num_layers}-{dtype}-{max_length}")
@@ -0,0 +1,69 @@
+import hashlib
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional
+
+STATE_FILE = "eval_state.json"
+
+
+def fingerprint(*parts: Any) -> str:
+    """Content hash of the inputs of one sample's metrics (prediction, reference, ...)."""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+class EvaluationState:
+    """
+    Fingerprints of the inputs each sample of a `per_sample.json` was evaluated on.
+
+    Stored as `eval_state.json` next to the per-sample output it describes. With `--incremental`
+    an evaluator compares the fingerprints of the current predictions/references with the stored
+    ones and only recomputes the samples that are new or changed; the other per-sample metrics
+    are taken over from the previous `per_sample.json`, and the aggregates are refreshed from the
+    merged result. `config` describes everything else the metrics depend on (e.g. the BERTScore
+    model): when it changes, every sample is recomputed. Optional per-sample `payloads` keep
+    intermediate results that are costly to rebuild (e.g. parsed predictions).
+    """
+
+    def __init__(self, save_dir: str, config: Optional[Dict[str, Any]] = None):
+        self.path = os.path.join(save_dir, STATE_FILE)
+        self.config = fingerprint(config or {})
+        self.fingerprints: Dict[str, str] = {}
+        self.payloads: Dict[str, Any] = {}
+        self.exists = False
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            if state.get("config") == self.config:
+                self.fingerprints = state["fingerprints"]
+                self.payloads = state.get("payloads", {})
+                self.exists = True
+
+    def changed(self, fingerprints: Dict[str, str], previous: Optional[Iterable[str]] = None) -> List[str]:
+        """
+        Keys of `fingerprints` (in order) that have to be evaluated: new or changed samples, and
+        samples missing from `previous` (the keys of the previous per-sample output).
+        """
+        previous = set(previous) if previous is not None else None
+        return [
+            key for key, fp in fingerprints.items()
+            if self.fingerprints.get(key) != fp or (previous is not None and key not in previous)
+        ]
+
+    def save(self, fingerprints: Dict[str, str], payloads: Optional[Dict[str, Any]] = None) -> None:
+        self.fingerprints = dict(fingerprints)
+        self.payloads = dict(payloads or {})
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"config": self.config, "fingerprints": self.fingerprints, "payloads": self.payloads}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self.exists = True
+
+
+def merge_per_sample(previous: Dict[str, Any], updated: Dict[str, Any], keys: Iterable[str]) -> Dict[str, Any]:
+    """Per-sample results of `keys` (in that order), from `updated` where present, else from `previous`."""
+    return {key: updated[key] if key in updated else previous[key] for key in keys}
+
+def incremental_summary(name: str, changed: int, total: int, removed: int = 0) -> str:
+    return f"[Incremental] {name}: {changed}/{total} samples evaluated, {total - changed} reused" + (f", {removed} removed" if removed else "")
@@ -1,12 +1,16 @@
 import json
 import os
 from argparse import Namespace
-from typing import Any, Dict, Literal
+from typing import Any, Dict, Iterator, Literal, Mapping, Optional, Tuple
 
 import pandas as pd
 from tqdm import tqdm
 
 from src.utils.common_utils import *
+from src.utils.json_stream import iter_json_object, iter_jsonl_records, iter_jsonl_sorted, write_json_entries
+from src.utils.packed_dataset import PACK_SUFFIX, PackedDataset
+from src.utils.record_writer import RecordOutput, get_record_writer
+from src.utils.result_store import get_result_store
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 project_root = os.path.dirname(os.path.dirname(current_dir))
@@ -15,36 +19,76 @@ data_dir = os.path.join(project_root, "data")
 def load_distribution_data(data_path=os.path.join(data_dir, "distribution.json")) -> Dict[str, Any]:
     if not os.path.exists(data_path):
         raise FileNotFoundError(f"Data file not found: {data_path}")
-    return json.load(open(data_path, "r", encoding="utf-8"))
+    with open(data_path, "r", encoding="utf-8") as f:
+        return json.load(f)
 
-def load_vqa_data(data_path=os.path.join(data_dir, "vqa.json")) -> Dict[str, Any]:
+def load_dataset(data_path: str) -> Mapping[str, Any]:
+    """
+    {sample id: record} of a benchmark dataset. When a compiled `.pack` of the file is up to
+    date (see `src.utils.packed_dataset`) it is opened instead: constant-time startup, and a
+    record is only decoded when it is accessed. Otherwise the JSON file is parsed.
+    """
+    pack_path = change_path_suffix(data_path, PACK_SUFFIX)
+    if os.path.exists(pack_path):
+        dataset = PackedDataset(pack_path)
+        if not os.path.exists(data_path) or dataset.is_current(data_path):
+            return dataset
+        dataset.close()
+        tqdm.write(f"[PackedDataset] '{pack_path}' was compiled from another version of '{data_path}', parsing the JSON (recompile with `python -m src.utils.packed_dataset {data_path}`)")
     if not os.path.exists(data_path):
         raise FileNotFoundError(f"Data file not found: {data_path}")
-    return json.load(open(data_path, "r", encoding="utf-8"))
+    with open(data_path, "r", encoding="utf-8") as f:
+        return json.load(f)
 
-def load_classification_data(data_path=os.path.join(data_dir, "classification.json")) -> Dict[str, Any]:
-    if not os.path.exists(data_path):
-        raise FileNotFoundError(f"Data file not found: {data_path}")
-    return json.load(open(data_path, "r", encoding="utf-8"))
+def load_vqa_data(data_path=os.path.join(data_dir, "vqa.json")) -> Mapping[str, Any]:
+    return load_dataset(data_path)
+
+def load_classification_data(data_path=os.path.join(data_dir, "classification.json")) -> Mapping[str, Any]:
+    return load_dataset(data_path)
+
+def load_captioning_data(data_path=os.path.join(data_dir, "captioning.json")) -> Mapping[str, Any]:
+    return load_dataset(data_path)
 
-def load_captioning_data(data_path=os.path.join(data_dir, "captioning.json")) -> Dict[str, Any]:
+def load_data(data_path: str) -> Dict[str, Any]:
     if not os.path.exists(data_path):
         raise FileNotFoundError(f"Data file not found: {data_path}")
-    return json.load(open(data_path, "r", encoding="utf-8"))
+    with open(data_path, "r", encoding="utf-8") as f:
+        return json.load(f)
 
-def load_data(data_path: str) -> Dict[str, Any]:
+def iter_data(data_path: str) -> Iterator[Tuple[str, Any]]:
+    """
+    (sample id, record) pairs of a JSON object file ({sample id: record}) or of a JSONL file,
+    read incrementally instead of loading the whole file. Use it for prediction and result
+    files, which can be larger than memory.
+    """
     if not os.path.exists(data_path):
         raise FileNotFoundError(f"Data file not found: {data_path}")
-    return json.load(open(data_path, "r", encoding="utf-8"))
+    if data_path.endswith(".jsonl"):
+        return iter_jsonl_records(data_path)
+    return iter_json_object(data_path)
 
 def save_json_data(data: Dict[str, Any], save_dir: str, save_file_name: str, title: str = "Saved") -> None:
     save_path = os.path.join(strip_trailing_slash(save_dir), save_file_name)
     try:
         os.makedirs(os.path.dirname(save_path), exist_ok=True)
-        json.dump(data, open(save_path, "w", encoding="utf-8"), ensure_ascii=False, indent=2)
+        with open(save_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        tqdm.write(f"[{title}] Saved data to '{save_path}'")
+    except Exception as e:
+        tqdm.write(f"[{title}] Failed to save data to '{save_path}': {e}")
+
+def save_json_entries(entries: Iterator[Tuple[str, Any]], save_dir: str, save_file_name: str, title: str = "Saved") -> int:
+    """Like `save_json_data` for a {key: value} object given as (key, value) pairs, written one entry at a time."""
+    save_path = os.path.join(strip_trailing_slash(save_dir), save_file_name)
+    try:
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        with open(save_path, "w", encoding="utf-8") as f:
+            n = write_json_entries(f, entries)
         tqdm.write(f"[{title}] Saved data to '{save_path}'")
+        return n
     except Exception as e:
         tqdm.write(f"[{title}] Failed to save data to '{save_path}': {e}")
+        return 0
 
 def save_csv_data(data: pd.DataFrame, save_dir: str, save_file_name: str, title: str = "Saved") -> None:
     save_path = os.path.join(strip_trailing_slash(save_dir), save_file_name)
@@ -55,7 +99,39 @@ def save_csv_data(data: pd.DataFrame, save_dir: str, save_file_name: str, title:
     except Exception as e:
         tqdm.write(f"[{title}] Failed to save data to '{save_path}': {e}")
 
+def save_parquet_data(data: pd.DataFrame, save_dir: str, save_file_name: str, title: str = "Saved") -> None:
+    save_path = os.path.join(strip_trailing_slash(save_dir), save_file_name)
+    try:
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        data.to_parquet(save_path, index=False)
+        tqdm.write(f"[{title}] Saved data to '{save_path}'")
+    except Exception as e:
+        tqdm.write(f"[{title}] Failed to save data to '{save_path}': {e}")
+
+def output_path(args: Namespace, jsonl_type: Literal["results", "translate", "failures", "refine"]) -> str:
+    return {"results": args.outfile, "translate": args.translatefile, "failures": args.failfile, "refine": args.refinefile}[jsonl_type]
+
+def open_output(args: Namespace, jsonl_type: Literal["results", "translate", "failures", "refine"]) -> RecordOutput:
+    """
+    Open the output of one record type for appending: the JSONL file, or with
+    `--result_store sqlite` the matching record kind of the run's ResultStore.
+
+    All outputs of a run share one RecordWriter, which serializes and writes the records
+    in a background thread in batches (`--writer_batch_size`, `--writer_flush_interval`,
+    `--fsync`); it is drained when the last output is closed. Records are written with `write_record`.
+    """
+    run_dir = os.path.dirname(args.outfile)
+    store = get_result_store(run_dir) if args.result_store == "sqlite" else None
+    writer = get_record_writer(run_dir, store, args.writer_batch_size, args.writer_flush_interval, args.fsync)
+    return writer.open(jsonl_type, output_path(args, jsonl_type))
+
+def write_record(f: RecordOutput, record: Dict[str, Any]) -> None:
+    """Append a record {sample id: value} to an output opened with `open_output`."""
+    f.put(record)
+
 def load_completed_indices(args: Namespace) -> set:
+    if args.result_store == "sqlite":
+        return get_result_store(os.path.dirname(args.outfile)).ids("results", f"{args.start:09d}", f"{args.end:09d}")
     completed = set()
     if os.path.exists(args.outfile):
         with open(args.outfile, "r", encoding="utf-8") as f:
@@ -68,66 +144,39 @@ def load_completed_indices(args: Namespace) -> set:
                     continue
     return completed
 
+def write_task_output(out: Optional[Dict[str, Any]], outputs: Dict[str, RecordOutput], f_fail: RecordOutput) -> None:
+    """
+    Append the records of one task() output to their outputs.
+
+    Args:
+        out (dict | None): Task output, e.g. {"case_en": {idx: ...}, "res": {idx: ...}}.
+        outputs (dict): Maps an output key ("case_en", "refine", "res") to its output (`open_output`).
+        f_fail (RecordOutput): Failures output; records containing "failed" are written here.
+    """
+    if not out:
+        return
+    for key, f in outputs.items():
+        record = out.get(key)
+        if not record:
+            continue
+        if "failed" in record or (isinstance(record, dict) and "failed" in record[list(record.keys())[0]]):
+            write_record(f_fail, record)
+        else:
+            write_record(f, record)
+
 def convert_jsonl_to_json(args: Namespace, jsonl_type: Literal["results", "translate", "failures", "refine"] = "results"):
-    results = {}
-    
-    if jsonl_type == "results":
-        if os.path.exists(args.outfile):
-            with open(args.outfile, "r", encoding="utf-8") as f:
-                for line in f:
-                    try:
-                        data = json.loads(line.strip())
-                        results.update(data)
-                    except Exception:
-                        continue
-    elif jsonl_type == "translate":
-        if os.path.exists(args.translatefile):
-            with open(args.translatefile, "r", encoding="utf-8") as f:
-                for line in f:
-                    try:
-                        data = json.loads(line.strip())
-                        results.update(data)
-                    except Exception:
-                        continue
-    elif jsonl_type == "failures":
-        if os.path.exists(args.failfile):
-            with open(args.failfile, "r", encoding="utf-8") as f:
-                for line in f:
-                    try:
-                        data = json.loads(line.strip())
-                        results.update(data)
-                    except Exception:
-                        continue
-    elif jsonl_type == "refine":
-        if os.path.exists(args.refinefile):
-            with open(args.refinefile, "r", encoding="utf-8") as f:
-                for line in f:
-                    try:
-                        data = json.loads(line.strip())
-                        results.update(data)
-                    except Exception:
-                        continue
-
-    sorted_results = {k: results[k] for k in sorted(results.keys())}
-    
-    if jsonl_type == "results":
-        with open(change_path_suffix(args.outfile, ".json"), "w", encoding="utf-8") as f:
-            json.dump(sorted_results, f, ensure_ascii=False, indent=2)
-        tqdm.write(f"[{args.task} - {args.subtask} - {args.model_name}] Saved data to '{change_path_suffix(args.outfile, '.json')}'")
-    
-    elif jsonl_type == "translate":
-        with open(change_path_suffix(args.translatefile, ".json"), "w", encoding="utf-8") as f:
-            json.dump(sorted_results, f, ensure_ascii=False, indent=2)
-        tqdm.write(f"[{args.task} - {args.subtask} - {args.model_name}] Saved data to '{change_path_suffix(args.translatefile, '.json')}'")
-    
-    elif jsonl_type == "failures":
-        with open(change_path_suffix(args.failfile, ".json"), "w", encoding="utf-8") as f:
-            json.dump(sorted_results, f, ensure_ascii=False, indent=2)
-        tqdm.write(f"[{args.task} - {args.subtask} - {args.model_name}] Saved data to '{change_path_suffix(args.failfile, '.json')}'")
-        if sorted_results:
-            tqdm.write(f"\033[91m[WARNING] [{args.task} - {args.subtask} - {args.model_name}] Failed tasks: {len(sorted_results)}\033[0m")
-
-    elif jsonl_type == "refine":
-        with open(change_path_suffix(args.refinefile, ".json"), "w", encoding="utf-8") as f:
-            json.dump(sorted_results, f, ensure_ascii=False, indent=2)
-        tqdm.write(f"[{args.task} - {args.subtask} - {args.model_name}] Saved data to '{change_path_suffix(args.refinefile, '.json')}'")
+    """
+    Write the ordered `<kind>.json` of a run ({sample id: latest record}, sorted by id),
+    streaming from the result store or from the JSONL file without loading the records.
+    """
+    json_path = change_path_suffix(output_path(args, jsonl_type), ".json")
+    if args.result_store == "sqlite":
+        # ordered export straight from the store's primary key, no parse/sort of the whole run
+        n = get_result_store(os.path.dirname(args.outfile)).export_json(jsonl_type, json_path)
+    else:
+        jsonl_path = output_path(args, jsonl_type)
+        with open(json_path, "w", encoding="utf-8") as f:
+            n = write_json_entries(f, iter_jsonl_sorted(jsonl_path) if os.path.exists(jsonl_path) else iter(()))
+    tqdm.write(f"[{args.task} - {args.subtask} - {args.model_name}] Saved data to '{json_path}'")
+    if jsonl_type == "failures" and n:
+        tqdm.write(f"\033[91m[WARNING] [{args.task} - {args.subtask} - {args.model_name}] Failed tasks: {n}\033[0m")
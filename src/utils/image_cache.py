@@ -0,0 +1,108 @@
+import base64
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Tuple
+
+
+@dataclass(frozen=True)
+class EncodedImage:
+    data_url: str   # "data:image/png;base64,..." payload sent to the API
+    digest: str     # sha256 of the raw image bytes
+    size: int       # size of `data_url` in bytes
+
+
+class EncodedImageCache:
+    """
+    Process-wide, memory-bounded LRU cache of base64-encoded image payloads.
+
+    Entries are keyed by (path, mtime, size), so an image rewritten on disk is re-read.
+    Concurrent requests for the same image (e.g. all questions of one VQA sample) wait
+    for a single read/encode instead of repeating it.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[Tuple[str, int, int], EncodedImage]" = OrderedDict()
+        self.loading: Dict[Tuple[str, int, int], threading.Event] = {}
+        self.cur_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_read = 0
+        self.bytes_served = 0
+
+    def get(self, image_path: str) -> EncodedImage:
+        st = os.stat(image_path)
+        key = (image_path, st.st_mtime_ns, st.st_size)
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry is not None:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    self.bytes_served += entry.size
+                    return entry
+                event = self.loading.get(key)
+                if event is None:
+                    event = self.loading[key] = threading.Event()
+                    self.misses += 1
+                    break
+            # another thread is encoding this image, wait and look again
+            event.wait()
+
+        try:
+            with open(image_path, "rb") as f:
+                raw = f.read()
+            data_url = f"data:image/png;base64,{base64.b64encode(raw).decode('utf-8')}"
+            entry = EncodedImage(data_url=data_url, digest=hashlib.sha256(raw).hexdigest(), size=len(data_url))
+            with self.lock:
+                self.bytes_read += len(raw)
+                self.bytes_served += entry.size
+                if entry.size <= self.max_bytes:
+                    self.entries[key] = entry
+                    self.cur_bytes += entry.size
+                    while self.cur_bytes > self.max_bytes:
+                        _, old = self.entries.popitem(last=False)
+                        self.cur_bytes -= old.size
+                        self.evictions += 1
+            return entry
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.cur_bytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self.entries),
+                "cached_mb": self.cur_bytes / 1024 / 1024,
+                "max_mb": self.max_bytes / 1024 / 1024,
+                "evictions": self.evictions,
+                "read_mb": self.bytes_read / 1024 / 1024,
+                "served_mb": self.bytes_served / 1024 / 1024,
+            }
+
+    def summary(self) -> str:
+        s = self.stats()
+        return (f"[ImageCache] hits: {s['hits']}, misses: {s['misses']}, hit_rate: {s['hit_rate']:.2%}, "
+                f"entries: {s['entries']}, cached: {s['cached_mb']:.1f}/{s['max_mb']:.0f} MB, evictions: {s['evictions']}, "
+                f"read from disk: {s['read_mb']:.1f} MB, served: {s['served_mb']:.1f} MB")
+
+
+IMAGE_CACHE = EncodedImageCache()
+
+def get_encoded_image(image_path: str) -> EncodedImage:
+    """Encoded payload of `image_path` from the shared IMAGE_CACHE."""
+    return IMAGE_CACHE.get(image_path)
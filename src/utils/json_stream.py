@@ -0,0 +1,124 @@
+import json
+import re
+from json.encoder import encode_basestring
+from typing import Any, Dict, Iterator, TextIO, Tuple
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_NUMBER_CHARS = "0123456789+-.eE"
+# the encoder of json.dump(..., ensure_ascii=False, indent=2)
+INDENT_ENCODER = json.JSONEncoder(ensure_ascii=False, indent=2)
+
+
+def iter_json_object(path: str, chunk_size: int = 1 << 20) -> Iterator[Tuple[str, Any]]:
+    """
+    (key, value) pairs of the top-level object of a JSON file ({sample id: record, ...}), in file order.
+
+    The file is read `chunk_size` characters at a time and only the record being decoded is held
+    in memory, so a multi-GB `results.json` can be scanned in constant memory. Same values as
+    `json.load(f).items()`, except that a key repeated in the file is yielded every time.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8") as f:
+        buf, pos, eof = "", 0, False
+
+        def read_more():
+            nonlocal buf, pos, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buf, pos = buf[pos:] + chunk, 0
+
+        def peek() -> str:
+            # next non-whitespace character ("" at the end of the file)
+            nonlocal pos
+            while True:
+                pos = _WHITESPACE.match(buf, pos).end()
+                if pos < len(buf) or eof:
+                    return buf[pos:pos + 1]
+                read_more()
+
+        def expect(chars: str) -> str:
+            nonlocal pos
+            c = peek()
+            if not c or c not in chars:
+                raise ValueError(f"Expecting one of '{chars}' in '{path}', got '{c}'")
+            pos += 1
+            return c
+
+        def decode() -> Any:
+            nonlocal pos
+            peek()
+            while True:
+                try:
+                    value, end = decoder.raw_decode(buf, pos)
+                    # a number cut by the end of the buffer may continue in the next chunk
+                    if eof or (end < len(buf) and buf[end] not in _NUMBER_CHARS):
+                        pos = end
+                        return value
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                read_more()
+
+        expect("{")
+        if peek() == "}":
+            return
+        while True:
+            key = decode()
+            expect(":")
+            yield key, decode()
+            if expect(",}") == "}":
+                return
+
+def iter_jsonl_records(path: str) -> Iterator[Tuple[str, Any]]:
+    """(key, value) pairs of every record line of a JSONL file, in file order; malformed lines are skipped."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                data = json.loads(line.strip())
+            except Exception:
+                continue
+            if isinstance(data, dict):
+                yield from data.items()
+
+def iter_jsonl_sorted(path: str) -> Iterator[Tuple[str, Any]]:
+    """
+    (key, value) pairs of a JSONL file in key order, the last record of a key winning: the
+    `{k: results[k] for k in sorted(results)}` of the folded file, without holding the values.
+
+    A first pass keeps only the byte offset of the last line of each key, the records are then
+    read back one line at a time in key order.
+    """
+    offsets: Dict[str, int] = {}
+    with open(path, "rb") as f:
+        offset = 0
+        for line in f:
+            try:
+                data = json.loads(line)
+            except Exception:
+                data = None
+            if isinstance(data, dict):
+                for key in data:
+                    offsets[key] = offset
+            offset += len(line)
+        cached_offset, cached = -1, None
+        for key in sorted(offsets):
+            if offsets[key] != cached_offset:
+                f.seek(offsets[key])
+                cached_offset, cached = offsets[key], json.loads(f.readline())
+            yield key, cached[key]
+
+def write_json_entries(f: TextIO, entries: Iterator[Tuple[str, Any]]) -> int:
+    """
+    Write {key: value, ...} from (key, value) pairs, byte-identical to
+    `json.dump(dict(entries), f, ensure_ascii=False, indent=2)` but one entry at a time.
+
+    Returns:
+        int: Number of entries written.
+    """
+    n = 0
+    for key, value in entries:
+        body = INDENT_ENCODER.encode(value).replace("\n", "\n  ")
+        f.write(("{\n  " if n == 0 else ",\n  ") + encode_basestring(key) + ": " + body)
+        n += 1
+    f.write("\n}" if n else "{}")
+    return n
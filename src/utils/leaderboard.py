@@ -0,0 +1,50 @@
+import os
+from typing import Dict, List
+
+import pandas as pd
+
+# metrics of each metric directory that go on the leaderboard, the first one ranks the models
+LEADERBOARD_METRICS = {
+    "Accuracy": ["total_acc", "multiple_choice_acc", "judge_acc"],
+    "Exact_Match": ["Avg_Exact_Match", "Avg_F1", "Avg_P", "Avg_R"],
+    "BertScore": ["Avg_F1", "Avg_P", "Avg_R"],
+    "confusion_matrix": ["Avg_F1", "Avg_P", "Avg_R"],
+}
+
+
+def find_prediction_models(prediction_dir: str) -> List[str]:
+    """
+    Names of the models with a `results.json` under `prediction_dir` (data/prediction/<subtask>).
+    A name is the relative directory, so `org/model` is found at `<prediction_dir>/org/model/`.
+    """
+    models = []
+    for root, dirs, files in os.walk(prediction_dir):
+        dirs.sort()
+        if "results.json" in files and root != prediction_dir:
+            models.append(os.path.relpath(root, prediction_dir).replace(os.sep, "/"))
+    return models
+
+def leaderboard_row(model_name: str, summaries: Dict[str, Dict]) -> Dict:
+    """
+    One leaderboard row from the results.json summaries of a model ({metric directory: summary}):
+    the overall value of every LEADERBOARD_METRICS metric, then its value on every dataset.
+    """
+    row = {"model": model_name}
+    for metric_dir, summary in summaries.items():
+        metrics = LEADERBOARD_METRICS.get(metric_dir, [])
+        for metric in metrics:
+            row[f"{metric_dir} {metric}"] = summary[model_name][metric] if model_name in summary else None
+        for dataset, value in summary.items():
+            if dataset == model_name:
+                continue
+            for metric in metrics:
+                row[f"{metric_dir} {metric} ({dataset})"] = value[model_name][metric]
+    return row
+
+def build_leaderboard(rows: List[Dict]) -> pd.DataFrame:
+    """Leaderboard of the rows, best model first by the first metric column."""
+    leaderboard = pd.DataFrame(rows)
+    if len(leaderboard.columns) > 1:
+        leaderboard = leaderboard.sort_values(leaderboard.columns[1], ascending=False, kind="stable", na_position="last")
+    leaderboard.insert(0, "rank", range(1, len(leaderboard) + 1))
+    return leaderboard.reset_index(drop=True)
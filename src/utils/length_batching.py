@@ -0,0 +1,41 @@
+from typing import List, Optional, Sequence
+
+
+def fixed_batches(n: int, batch_size: int) -> List[List[int]]:
+    """Consecutive batches of `batch_size` positions, in input order."""
+    return [list(range(start, min(start + batch_size, n))) for start in range(0, n, batch_size)]
+
+def token_budget_batches(lengths: Sequence[int], token_budget: int, max_batch_size: Optional[int] = None) -> List[List[int]]:
+    """
+    Batch positions of items by length under a budget of padded tokens per batch.
+
+    Items are sorted by length (longest first, ties in input order) and cut greedily, so a
+    batch of n items padded to its longest item L satisfies n * L <= token_budget: batches
+    of short captions hold many of them, batches of long captions few. An item longer than
+    the budget gets a batch of its own. Callers scatter results back with the positions.
+
+    Example:
+        >>> token_budget_batches([3, 10, 4, 9], token_budget=20)
+        [[1, 3], [2, 0]]
+    """
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    batches, batch, longest = [], [], 0
+    for i in order:
+        longest_with = max(longest, lengths[i])
+        if batch and ((len(batch) + 1) * longest_with > token_budget or (max_batch_size and len(batch) >= max_batch_size)):
+            batches.append(batch)
+            batch, longest_with = [], lengths[i]
+        batch.append(i)
+        longest = longest_with
+    if batch:
+        batches.append(batch)
+    return batches
+
+def padded_tokens(lengths: Sequence[int], batches: List[List[int]]) -> int:
+    """Number of token slots (real + padding) the batches occupy once padded to their longest item."""
+    return sum(len(batch) * max(lengths[i] for i in batch) for batch in batches if batch)
+
+def padding_ratio(lengths: Sequence[int], batches: List[List[int]]) -> float:
+    """Fraction of the padded token slots of `batches` that are padding."""
+    total = padded_tokens(lengths, batches)
+    return 1 - sum(lengths[i] for batch in batches for i in batch) / total if total else 0.0
@@ -1,13 +1,87 @@
 import base64
 import os
+import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from io import BytesIO
-from typing import Dict, List, Optional
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
 
+import ujson
 from lfss.api import Connector
 from PIL import Image
 
+from src.utils.rate_limiter import RateLimiter, backoff_delay, get_rate_limiter
+
+
+class ConnectorPool:
+    """
+    Thread-safe LFSS connector shared by all readers of a run.
+
+    The connector is opened lazily with a keep-alive `requests` session whose HTTP
+    connection pool holds up to `pool_size` connections, so readers reuse established
+    connections instead of paying a new connection/TLS handshake per request.
+    Retries stay with the readers (`max_retries`/`delay`), the session itself does not retry.
+    If config.yaml sets `rate_limits` for the LFSS endpoint, the readers share its limiter.
+    """
+
+    def __init__(self, pool_size: int = 16):
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.session: Optional[Connector.Session] = None
+        self.connector: Optional[Connector] = None
+        self.rate_limiter: Optional[RateLimiter] = None
+
+    def get(self) -> Connector:
+        with self.lock:
+            if self.connector is None:
+                c = Connector()
+                self.session = c.session(pool_size=self.pool_size, retry=0)
+                self.session.open()
+                self.connector = c
+                self.rate_limiter = get_rate_limiter(c.config.endpoint)
+            return self.connector
+
+    def close(self) -> None:
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+            self.session = None
+            self.connector = None
+
+    def stats(self) -> Dict[str, int]:
+        """Connections opened and requests sent over them, summed over the urllib3 host pools."""
+        connections, requests = 0, 0
+        with self.lock:
+            if self.connector is not None and self.connector._session is not None:
+                # the same adapter is mounted for http:// and https://
+                for adapter in {id(a): a for a in self.connector._session.adapters.values()}.values():
+                    pools = adapter.poolmanager.pools
+                    for key in pools.keys():
+                        pool = pools.get(key)
+                        if pool is not None:
+                            connections += pool.num_connections
+                            requests += pool.num_requests
+        return {"connections": connections, "requests": requests, "reused": max(requests - connections, 0)}
+
+    def summary(self) -> str:
+        s = self.stats()
+        res = (f"[LFSS] requests: {s['requests']}, connections opened: {s['connections']}, "
+               f"reused: {s['reused']} (pool size {self.pool_size})")
+        if self.rate_limiter is not None:
+            res += "\n" + self.rate_limiter.summary()
+        return res
+
+
+LFSS_POOL = ConnectorPool()
+
+def lfss_retry_delay(e: Exception, attempt: int, delay: float, limiter: Optional[RateLimiter]) -> float:
+    """Seconds to wait before retry `attempt` of a reader: Retry-After if the server sent one, else exponential backoff from `delay`."""
+    if limiter is not None:
+        return limiter.retry_delay(e, attempt, base=delay)
+    return backoff_delay(attempt, delay)
+
 
 @dataclass
 class Label:
@@ -21,6 +95,21 @@ class Label:
     overall_description: str
     it: List[LabelItem]
 
+    @classmethod
+    def from_json(cls, content: Dict) -> "Label":
+        return cls(
+            annotators=content["annotators"],
+            overall_description=content["overallDescription"],
+            it=[
+                cls.LabelItem(
+                    id=item["id"],
+                    low_confidence=item["lowConfidence"],
+                    description=item["description"],
+                    contours=item["contours"]
+                ) for item in content["items"]
+            ]
+        )
+
     def compact_json(self) -> Dict:
         return {
             "overall_description": self.overall_description,
@@ -38,6 +127,13 @@ class Skip:
     reason: str
     skipTime: str
 
+    @classmethod
+    def from_json(cls, content: Dict) -> "Skip":
+        return cls(
+            reason=content["reason"],
+            skipTime=content["skipTime"]
+        )
+
     def compact_json(self) -> Dict:
         return {
             "reason": self.reason,
@@ -50,6 +146,14 @@ class Info:
     path: str
     source: str
 
+    @classmethod
+    def from_json(cls, content: Dict) -> "Info":
+        return cls(
+            file_name=content["file_name"],
+            path=content["path"],
+            source=content["source"]
+        )
+
     def compact_json(self) -> Dict:
         return {
             "file_name": self.file_name,
@@ -58,9 +162,26 @@ class Info:
         }
 
 
+@dataclass
+class SampleMeta:
+    skip: Optional[Skip] = None
+    label: Optional[Label] = None
+    info: Optional[Info] = None
+
+    @classmethod
+    def from_json(cls, raw: Dict[str, Optional[Dict]]) -> "SampleMeta":
+        return cls(
+            skip=Skip.from_json(raw["skip"]) if raw.get("skip") is not None else None,
+            label=Label.from_json(raw["label"]) if raw.get("label") is not None else None,
+            info=Info.from_json(raw["info"]) if raw.get("info") is not None else None,
+        )
+
+
 class ImageReader:
-    def __init__(self, image_dir: str):
-        self.c = Connector()
+    def __init__(self, image_dir: str, pool: Optional[ConnectorPool] = None):
+        pool = pool or LFSS_POOL
+        self.c = pool.get()
+        self.rate_limiter = pool.rate_limiter
         self.image_dir = image_dir
 
     def read_as_bytes(
@@ -78,13 +199,15 @@ class ImageReader:
 
         while retry_count <= max_retries:
             try:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
                 image_bytes = self.c.get(fpath)
                 return image_bytes
             except Exception as e:
                 retry_count += 1
                 if retry_count > max_retries:
                     raise ValueError(f"Max retries exceeded for {fpath}: {e}")
-                time.sleep(delay)
+                time.sleep(lfss_retry_delay(e, retry_count, delay, self.rate_limiter))
                 print(f"retrying...")
 
     def read_as_base64(
@@ -117,8 +240,10 @@ class ImageReader:
 
 
 class InfoReader:
-    def __init__(self, lbl_meta_dir):
-        self.c = Connector()
+    def __init__(self, lbl_meta_dir, pool: Optional[ConnectorPool] = None):
+        pool = pool or LFSS_POOL
+        self.c = pool.get()
+        self.rate_limiter = pool.rate_limiter
         self.lbl_meta_dir = lbl_meta_dir
 
     def get_raw_data(
@@ -143,6 +268,8 @@ class InfoReader:
 
         while retry_count <= max_retries:
             try:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
                 content = self.c.get_json(lbl_fpath)
                 if content is None:
                     raise FileNotFoundError(f"{lbl_fpath} not found")
@@ -153,7 +280,7 @@ class InfoReader:
                 retry_count += 1
                 if retry_count > max_retries:
                     raise ValueError(f"Max retries exceeded for {lbl_fpath}: {e}")
-                time.sleep(delay)
+                time.sleep(lfss_retry_delay(e, retry_count, delay, self.rate_limiter))
 
     def get(
         self, label_id: str | int,
@@ -166,16 +293,13 @@ class InfoReader:
             delay=delay,
         )
 
-        lbl = Info(
-            file_name=content["file_name"],
-            path=content["path"],
-            source=content["source"]
-        )
-        return lbl
+        return Info.from_json(content)
 
 class LabelReader:
-    def __init__(self, lbl_meta_dir):
-        self.c = Connector()
+    def __init__(self, lbl_meta_dir, pool: Optional[ConnectorPool] = None):
+        pool = pool or LFSS_POOL
+        self.c = pool.get()
+        self.rate_limiter = pool.rate_limiter
         self.lbl_meta_dir = lbl_meta_dir
 
     def get_raw_data(
@@ -189,6 +313,8 @@ class LabelReader:
 
         while retry_count <= max_retries:
             try:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
                 content = self.c.get_json(lbl_fpath)
                 return content
             except Exception as e:
@@ -198,30 +324,20 @@ class LabelReader:
                 retry_count += 1
                 if retry_count > max_retries:
                     raise ValueError(f"Max retries exceeded for {lbl_fpath}: {e}")
-                time.sleep(delay)
+                time.sleep(lfss_retry_delay(e, retry_count, delay, self.rate_limiter))
 
     def get(self, label_id: str) -> Optional[Label]:
         content = self.get_raw_data(label_id)
         if content is None:
             return None
 
-        lbl = Label(
-            annotators=content["annotators"],
-            overall_description=content["overallDescription"],
-            it=[
-                Label.LabelItem(
-                    id=item["id"],
-                    low_confidence=item["lowConfidence"],
-                    description=item["description"],
-                    contours=item["contours"]
-                ) for item in content["items"]
-            ]
-        )
-        return lbl
+        return Label.from_json(content)
 
 class SkipReader:
-    def __init__(self, lbl_meta_dir):
-        self.c = Connector()
+    def __init__(self, lbl_meta_dir, pool: Optional[ConnectorPool] = None):
+        pool = pool or LFSS_POOL
+        self.c = pool.get()
+        self.rate_limiter = pool.rate_limiter
         self.lbl_meta_dir = lbl_meta_dir
 
     def get_raw_data(
@@ -235,6 +351,8 @@ class SkipReader:
 
         while retry_count <= max_retries:
             try:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
                 content = self.c.get_json(lbl_fpath)
                 return content
             except Exception as e:
@@ -244,15 +362,91 @@ class SkipReader:
                 retry_count += 1
                 if retry_count > max_retries:
                     raise ValueError(f"Max retries exceeded for {lbl_fpath}: {e}")
-                time.sleep(delay)
+                time.sleep(lfss_retry_delay(e, retry_count, delay, self.rate_limiter))
 
     def get(self, label_id: str) -> Optional[Skip]:
         content = self.get_raw_data(label_id)
         if content is None:
             return None
 
-        lbl = Skip(
-            reason=content["reason"],
-            skipTime=content["skipTime"]
-        )
-        return lbl
+        return Skip.from_json(content)
+
+
+class MetaBatchReader:
+    """
+    Reads `skip.json`, `label.json` and `info.json` of many label ids together: one LFSS
+    get-multiple request per `chunk_size` ids instead of one request per file.
+    Missing files come back as None instead of going through a "Not Found" exception.
+    """
+    FIELDS = ("skip", "label", "info")
+
+    def __init__(self, lbl_meta_dir, pool: Optional[ConnectorPool] = None, chunk_size: int = 32):
+        pool = pool or LFSS_POOL
+        self.c = pool.get()
+        self.rate_limiter = pool.rate_limiter
+        self.lbl_meta_dir = lbl_meta_dir
+        self.chunk_size = chunk_size
+
+    def get_multiple(
+        self, paths: List[str],
+        max_retries: int = 3,
+        delay: float = 1.0,
+    ) -> Dict[str, Optional[str]]:
+        retry_count = 0
+
+        while retry_count <= max_retries:
+            try:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
+                return self.c.get_multiple_text(*paths)
+            except Exception as e:
+                retry_count += 1
+                if retry_count > max_retries:
+                    raise ValueError(f"Max retries exceeded for {len(paths)} files under {self.lbl_meta_dir}: {e}")
+                time.sleep(lfss_retry_delay(e, retry_count, delay, self.rate_limiter))
+
+    def get_raw_data(
+        self, label_ids: Sequence[str | int],
+        fields: Sequence[str] = FIELDS,
+        max_retries: int = 3,
+        delay: float = 1.0,
+    ) -> Dict[str, Dict[str, Optional[Dict]]]:
+        """
+        Get the raw meta data of several label ids
+
+        :param label_ids: The unique identifiers of the labels
+        :param fields: Which of "skip", "label" and "info" to fetch
+        :return: {label_id (9 digits): {field: content, or None if the file does not exist}}
+        """
+        res = {}
+        label_ids = [str(label_id).zfill(9) for label_id in label_ids]
+        for i in range(0, len(label_ids), self.chunk_size):
+            paths = {
+                (label_id, field): os.path.join(self.lbl_meta_dir, label_id, f"{field}.json").lstrip("/")
+                for label_id in label_ids[i:i + self.chunk_size] for field in fields
+            }
+            contents = self.get_multiple(list(paths.values()), max_retries=max_retries, delay=delay)
+            for (label_id, field), path in paths.items():
+                text = contents.get(path)
+                res.setdefault(label_id, {})[field] = ujson.loads(text) if text is not None else None
+        return res
+
+    def get(self, label_ids: Sequence[str | int], fields: Sequence[str] = FIELDS) -> Dict[str, SampleMeta]:
+        return {label_id: SampleMeta.from_json(raw) for label_id, raw in self.get_raw_data(label_ids, fields).items()}
+
+    def iter(
+        self, label_ids: Sequence[str | int],
+        fields: Sequence[str] = FIELDS,
+        workers: int = 4,
+    ) -> Iterator[Tuple[str, SampleMeta]]:
+        """Yield (label_id, SampleMeta) in order, keeping up to `workers` chunk requests in flight."""
+        label_ids = [str(label_id).zfill(9) for label_id in label_ids]
+        chunks = [label_ids[i:i + self.chunk_size] for i in range(0, len(label_ids), self.chunk_size)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            window = deque()
+            for chunk in chunks:
+                window.append(executor.submit(self.get, chunk, fields))
+                if len(window) >= workers:
+                    yield from window.popleft().result().items()
+            while window:
+                yield from window.popleft().result().items()
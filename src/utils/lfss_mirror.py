@@ -0,0 +1,268 @@
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import ujson
+from lfss.api import Connector
+
+from src.utils.lfss_io import LFSS_POOL, ConnectorPool, InfoReader, LabelReader, MetaBatchReader, SkipReader
+from src.utils.rate_limiter import RateLimiter
+
+META_FILES = ("skip.json", "label.json", "info.json")
+
+
+class MetaMirror:
+    """
+    Local SQLite copy of the per-label `skip.json`, `label.json` and `info.json` files of
+    an LFSS meta dir.
+
+    `sync()` lists the remote files once (paged, flat), compares each file's LFSS
+    `file_id` and `create_time` with the mirrored copy and only downloads the files that
+    are new or changed, several per request. Label ids covered by a sync are recorded, so
+    a missing file in a synced id means the file does not exist on LFSS either.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS meta ("
+            "meta_dir TEXT, label_id TEXT, name TEXT, content TEXT, file_id TEXT, create_time TEXT, "
+            "PRIMARY KEY (meta_dir, label_id, name))"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS synced ("
+            "meta_dir TEXT, label_id TEXT, synced_at REAL, PRIMARY KEY (meta_dir, label_id))"
+        )
+
+    def lookup(self, meta_dir: str, label_id: str, name: str) -> Tuple[bool, Optional[Dict]]:
+        """
+        Returns:
+            tuple: (whether `label_id` is mirrored, parsed file content or None if the file does not exist).
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT m.content FROM synced s LEFT JOIN meta m "
+                "ON m.meta_dir = s.meta_dir AND m.label_id = s.label_id AND m.name = ? "
+                "WHERE s.meta_dir = ? AND s.label_id = ?",
+                (name, meta_dir.strip("/"), label_id),
+            ).fetchone()
+        if row is None:
+            return False, None
+        return True, ujson.loads(row[0]) if row[0] is not None else None
+
+    @staticmethod
+    def first_offset(c: Connector, meta_dir: str, label_id: str) -> int:
+        """
+        Offset of the first file of `meta_dir` (listed by url) at or after the dir of `label_id`,
+        found by binary search with one-file listings instead of listing everything before it.
+        """
+        first = f"{meta_dir}/{label_id}/"
+        lo, hi = 0, c.count_files(meta_dir + "/", flat=True)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            records = c.list_files(meta_dir + "/", offset=mid, limit=1, order_by="url", flat=True)
+            if records and records[0].url.lstrip("/") < first:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def list_remote(self, c: Connector, meta_dir: str, start: int, end: int, page_size: int = 1000) -> Dict[Tuple[str, str], Tuple[str, str, str]]:
+        """(label_id, name) -> (path, file_id, create_time) of the remote meta files in [start, end]."""
+        meta_dir = meta_dir.strip("/")
+        last_id = f"{end:09d}"
+        remote = {}
+        # a shard of a large dir starts listing at its first id, not at the start of the dir
+        offset = self.first_offset(c, meta_dir, f"{start:09d}")
+        while True:
+            records = c.list_files(meta_dir + "/", offset=offset, limit=page_size, order_by="url", flat=True)
+            for r in records:
+                rel = r.url.lstrip("/")
+                if not rel.startswith(meta_dir + "/"):
+                    continue
+                parts = rel[len(meta_dir) + 1:].split("/")
+                if len(parts) != 2 or parts[1] not in META_FILES or not parts[0].isdigit():
+                    continue
+                if start <= int(parts[0]) <= end:
+                    remote[(parts[0], parts[1])] = (rel, r.file_id, r.create_time)
+            offset += len(records)
+            # listing is ordered by url and ids are zero-padded, nothing after `end` is needed
+            if len(records) < page_size or rel > f"{meta_dir}/{last_id}/~":
+                break
+        return remote
+
+    def sync(
+        self, c: Connector, meta_dir: str, start: int, end: int,
+        page_size: int = 1000, chunk_size: int = 200, workers: int = 8,
+    ) -> Dict[str, int]:
+        """
+        Bring the mirror of `meta_dir` for label ids [start, end] up to date.
+
+        Returns:
+            dict: Number of remote files listed, downloaded, unchanged and removed.
+        """
+        meta_dir = meta_dir.strip("/")
+        remote = self.list_remote(c, meta_dir, start, end, page_size=page_size)
+        with self.lock:
+            local = {
+                (label_id, name): (file_id, create_time)
+                for label_id, name, file_id, create_time in self.conn.execute(
+                    "SELECT label_id, name, file_id, create_time FROM meta WHERE meta_dir = ? AND label_id BETWEEN ? AND ?",
+                    (meta_dir, f"{start:09d}", f"{end:09d}"),
+                )
+            }
+        changed = [key for key, (_, file_id, create_time) in remote.items() if local.get(key) != (file_id, create_time)]
+        removed = [key for key in local if key not in remote]
+
+        chunks = [changed[i:i + chunk_size] for i in range(0, len(changed), chunk_size)]
+        def fetch(chunk: List[Tuple[str, str]]) -> Dict[str, Optional[str]]:
+            return c.get_multiple_text(*[remote[key][0] for key in chunk])
+
+        rows = []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for chunk, contents in zip(chunks, executor.map(fetch, chunks)):
+                for key in chunk:
+                    path, file_id, create_time = remote[key]
+                    content = contents.get(path)
+                    if content is None:
+                        # deleted between listing and download
+                        removed.append(key)
+                        continue
+                    rows.append((meta_dir, key[0], key[1], content, file_id, create_time))
+
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO meta (meta_dir, label_id, name, content, file_id, create_time) VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.conn.executemany(
+                "DELETE FROM meta WHERE meta_dir = ? AND label_id = ? AND name = ?",
+                [(meta_dir, label_id, name) for label_id, name in removed],
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO synced (meta_dir, label_id, synced_at) VALUES (?, ?, ?)",
+                [(meta_dir, f"{i:09d}", now) for i in range(start, end + 1)],
+            )
+            self.conn.execute("COMMIT")
+
+        return {
+            "listed": len(remote),
+            "downloaded": len(rows),
+            "unchanged": len(remote) - len(changed),
+            "removed": len(removed),
+        }
+
+
+class _LazyConnector:
+    """
+    Takes the LFSS connector from the pool on the first fallback fetch instead of on construction,
+    so runs served entirely from the mirror need no LFSS_TOKEN.
+    """
+
+    def __init__(self, lbl_meta_dir: str, pool: Optional[ConnectorPool] = None):
+        self.pool = pool or LFSS_POOL
+        self.lbl_meta_dir = lbl_meta_dir
+
+    @property
+    def c(self) -> Connector:
+        return self.pool.get()
+
+    @property
+    def rate_limiter(self) -> Optional[RateLimiter]:
+        # the pool looks the limiter up when it creates the connector
+        self.pool.get()
+        return self.pool.rate_limiter
+
+class _MirrorReader(_LazyConnector):
+    """Serves `get_raw_data` from a MetaMirror, falling back to LFSS for ids that are not mirrored."""
+    FILE_NAME = ""
+
+    def __init__(self, lbl_meta_dir: str, mirror: MetaMirror):
+        super().__init__(lbl_meta_dir)
+        self.mirror = mirror
+
+    def get_raw_data(
+        self, label_id: str | int,
+        max_retries: int = 3,
+        delay: float = 1.0,
+    ) -> Dict | None:
+        label_id = str(label_id).zfill(9)
+        found, content = self.mirror.lookup(self.lbl_meta_dir, label_id, self.FILE_NAME)
+        if not found:
+            return super().get_raw_data(label_id, max_retries=max_retries, delay=delay)
+        return content
+
+class MirrorSkipReader(_MirrorReader, SkipReader):
+    FILE_NAME = "skip.json"
+
+class MirrorLabelReader(_MirrorReader, LabelReader):
+    FILE_NAME = "label.json"
+
+class MirrorInfoReader(_MirrorReader, InfoReader):
+    FILE_NAME = "info.json"
+
+    def get_raw_data(self, label_id: str | int, max_retries: int = 3, delay: float = 1.0) -> Dict:
+        content = super().get_raw_data(label_id, max_retries=max_retries, delay=delay)
+        if content is None:
+            raise FileNotFoundError(f"{os.path.join(self.lbl_meta_dir, str(label_id).zfill(9), self.FILE_NAME)} not found")
+        return content
+
+class MirrorMetaBatchReader(_LazyConnector, MetaBatchReader):
+    """MetaBatchReader served from a MetaMirror; ids that are not mirrored are fetched from LFSS."""
+
+    def __init__(self, lbl_meta_dir: str, mirror: MetaMirror, chunk_size: int = 32):
+        _LazyConnector.__init__(self, lbl_meta_dir)
+        self.mirror = mirror
+        self.chunk_size = chunk_size
+
+    def get_raw_data(
+        self, label_ids: Sequence[str | int],
+        fields: Sequence[str] = MetaBatchReader.FIELDS,
+        max_retries: int = 3,
+        delay: float = 1.0,
+    ) -> Dict[str, Dict[str, Optional[Dict]]]:
+        res, missing = {}, []
+        for label_id in label_ids:
+            label_id = str(label_id).zfill(9)
+            found, raw = True, {}
+            for field in fields:
+                found, raw[field] = self.mirror.lookup(self.lbl_meta_dir, label_id, f"{field}.json")
+                if not found:
+                    break
+            # placeholders keep the order of label_ids
+            res[label_id] = raw if found else None
+            if not found:
+                missing.append(label_id)
+        if missing:
+            res.update(super().get_raw_data(missing, fields, max_retries=max_retries, delay=delay))
+        return res
+
+
+META_MIRROR: Optional[MetaMirror] = None
+
+def open_meta_mirror(db_path: str) -> MetaMirror:
+    """Open the mirror at `db_path` and serve all readers created by the factories below from it."""
+    global META_MIRROR
+    META_MIRROR = MetaMirror(db_path)
+    return META_MIRROR
+
+def skip_reader(lbl_meta_dir: str) -> SkipReader:
+    return MirrorSkipReader(lbl_meta_dir, META_MIRROR) if META_MIRROR else SkipReader(lbl_meta_dir=lbl_meta_dir)
+
+def label_reader(lbl_meta_dir: str) -> LabelReader:
+    return MirrorLabelReader(lbl_meta_dir, META_MIRROR) if META_MIRROR else LabelReader(lbl_meta_dir=lbl_meta_dir)
+
+def info_reader(lbl_meta_dir: str) -> InfoReader:
+    return MirrorInfoReader(lbl_meta_dir, META_MIRROR) if META_MIRROR else InfoReader(lbl_meta_dir=lbl_meta_dir)
+
+def meta_batch_reader(lbl_meta_dir: str) -> MetaBatchReader:
+    return MirrorMetaBatchReader(lbl_meta_dir, META_MIRROR) if META_MIRROR else MetaBatchReader(lbl_meta_dir)
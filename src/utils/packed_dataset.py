@@ -0,0 +1,180 @@
+"""
+Compiled benchmark datasets with random access by sample id.
+
+    python -m src.utils.packed_dataset data/vqa.json data/classification.json data/captioning.json
+
+Compiles each {sample id: record} JSON file into a `.pack` file next to it. The loaders of
+`src.utils.file_io` open the `.pack` instead of parsing the JSON as long as it is up to date.
+
+Layout of a `.pack` file (little endian, sections 8-byte aligned):
+
+    MAGIC | header length (uint32) | header (JSON) | ids | starts | ends | order | records
+
+- ids: the sample ids, utf-8, null-padded to the longest id, sorted (binary search).
+- starts, ends: uint64 byte range of each record (in id order) in the records section.
+- order: uint32 position in `ids` of the n-th sample of the source file (iteration order).
+- records: the compact JSON of every record, in source order.
+
+Opening maps the file and reads the header; a record is decoded when it is accessed.
+"""
+import argparse
+import json
+import mmap
+import os
+import struct
+from collections.abc import Mapping
+from typing import Any, Iterator, List
+
+import numpy as np
+from tqdm import tqdm
+
+from src.utils.json_stream import iter_json_object
+
+MAGIC = b"MDPACK01"
+PACK_SUFFIX = ".pack"
+
+
+def _source_stamp(source_path: str) -> dict:
+    stat = os.stat(source_path)
+    return {"source_size": stat.st_size, "source_mtime_ns": stat.st_mtime_ns}
+
+def _align(n: int) -> int:
+    return (n + 7) // 8 * 8
+
+def compile_dataset(source_path: str, pack_path: str = None) -> str:
+    """
+    Compile a {sample id: record} JSON file into a `.pack` file (default: next to it).
+    The source is streamed; only the ids and record offsets are held in memory.
+
+    Returns:
+        str: Path of the `.pack` file.
+    """
+    pack_path = pack_path or os.path.splitext(source_path)[0] + PACK_SUFFIX
+    stamp = _source_stamp(source_path)
+    tmp_path = pack_path + ".tmp"
+    positions, starts, ends = {}, [], []
+    # records are written to a scratch file first, the index sections come before them
+    with open(tmp_path + ".records", "wb") as records:
+        offset = 0
+        for key, value in iter_json_object(source_path):
+            data = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            records.write(data)
+            if key in positions:
+                # a repeated key keeps its position and takes the last value, as json.load does
+                starts[positions[key]], ends[positions[key]] = offset, offset + len(data)
+            else:
+                positions[key] = len(starts)
+                starts.append(offset)
+                ends.append(offset + len(data))
+            offset += len(data)
+    keys = [key.encode("utf-8") for key in positions]
+    id_width = max((len(key) for key in keys), default=1)
+    ids = np.array(keys, dtype=f"S{id_width}")
+    by_id = np.argsort(ids, kind="stable")
+    order = np.empty(len(keys), dtype="<u4")
+    order[by_id] = np.arange(len(keys), dtype="<u4")
+
+    header = {"source": os.path.basename(source_path), **stamp, "count": len(keys), "id_width": id_width}
+    header_bytes = json.dumps(header).encode("utf-8")
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(MAGIC + struct.pack("<I", len(header_bytes)) + header_bytes)
+            sections = (
+                ids[by_id].tobytes(),
+                np.asarray(starts, dtype="<u8")[by_id].tobytes() + np.asarray(ends, dtype="<u8")[by_id].tobytes(),
+                order.tobytes(),
+            )
+            for section in sections:
+                f.write(b"\0" * (_align(f.tell()) - f.tell()))
+                f.write(section)
+            f.write(b"\0" * (_align(f.tell()) - f.tell()))
+            with open(tmp_path + ".records", "rb") as records:
+                while chunk := records.read(1 << 20):
+                    f.write(chunk)
+        os.replace(tmp_path, pack_path)
+    finally:
+        os.remove(tmp_path + ".records")
+    return pack_path
+
+
+class PackedDataset(Mapping):
+    """
+    Read-only {sample id: record} view of a `.pack` file, used like the dict of the JSON file.
+
+    Opening maps the file and reads the header, independent of the number of samples. A lookup
+    is a binary search over the memory-mapped ids and decodes only that record; iterating yields
+    the ids in the order of the source file. Pickling reopens the file (sweep worker processes).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"Not a packed dataset: '{path}'")
+        (header_length,) = struct.unpack_from("<I", self.mm, len(MAGIC))
+        start = len(MAGIC) + 4
+        self.header = json.loads(self.mm[start:start + header_length])
+        count, width = self.header["count"], self.header["id_width"]
+        pos = _align(start + header_length)
+        self.ids = np.frombuffer(self.mm, dtype=f"S{width}", count=count, offset=pos)
+        pos = _align(pos + count * width)
+        self.starts = np.frombuffer(self.mm, dtype="<u8", count=count, offset=pos)
+        self.ends = np.frombuffer(self.mm, dtype="<u8", count=count, offset=pos + 8 * count)
+        pos = _align(pos + 16 * count)
+        self.order = np.frombuffer(self.mm, dtype="<u4", count=count, offset=pos)
+        self.records_offset = _align(pos + 4 * count)
+
+    def is_current(self, source_path: str) -> bool:
+        """Whether the pack was compiled from the current version of `source_path`."""
+        stamp = _source_stamp(source_path)
+        return all(self.header.get(name) == value for name, value in stamp.items())
+
+    def _find(self, key: str) -> int:
+        if not isinstance(key, str):
+            return -1
+        encoded = key.encode("utf-8")
+        if len(encoded) > self.ids.dtype.itemsize:
+            return -1
+        i = int(np.searchsorted(self.ids, encoded))
+        return i if i < len(self.ids) and self.ids[i] == encoded else -1
+
+    def __getitem__(self, key: str) -> Any:
+        i = self._find(key)
+        if i < 0:
+            raise KeyError(key)
+        return json.loads(self.mm[self.records_offset + int(self.starts[i]):self.records_offset + int(self.ends[i])])
+
+    def __contains__(self, key) -> bool:
+        return self._find(key) >= 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __iter__(self) -> Iterator[str]:
+        for block in range(0, len(self.order), 1 << 16):
+            for key in self.ids[self.order[block:block + (1 << 16)]].tolist():
+                yield key.decode("utf-8")
+
+    def __reduce__(self):
+        return (PackedDataset, (self.path,))
+
+    def close(self) -> None:
+        # the numpy views keep the map alive, drop them first
+        self.ids = self.starts = self.ends = self.order = None
+        self.mm.close()
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("sources", nargs="+", help="{sample id: record} JSON files, e.g. data/vqa.json")
+    args = parser.parse_args(argv)
+    for source in args.sources:
+        pack_path = compile_dataset(source)
+        dataset = PackedDataset(pack_path)
+        tqdm.write(f"[PackedDataset] Compiled '{source}' -> '{pack_path}' ({len(dataset)} samples, {os.path.getsize(pack_path) / 1e6:.1f} MB)")
+        dataset.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import queue
+import threading
+import time
+from argparse import Namespace
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, List, Optional
+
+from tqdm import tqdm
+
+_STOP = object()
+
+
+@dataclass
+class Stage:
+    """
+    One step of a Pipeline.
+
+    `fn` takes the item produced by the previous stage and returns the item for the next one;
+    the return value of the last stage is the output of the pipeline. Returning `Finished(output)`
+    ends an item early (e.g. a skipped sample). If `on_error` is given, an exception of `fn` is
+    turned into the output `on_error(item, exc)`, otherwise it stops the pipeline and is raised.
+    """
+    name: str
+    fn: Callable[[Any], Any]
+    workers: int = 1
+    on_error: Optional[Callable[[Any, Exception], Any]] = None
+
+
+@dataclass
+class Finished:
+    """Output of an item that skips the remaining stages."""
+    output: Any
+
+
+class _Failure:
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+class StageStats:
+    def __init__(self, stage: Stage):
+        self.stage = stage
+        self.lock = threading.Lock()
+        self.items = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.depth_sum = 0
+        self.depth_max = 0
+        self.first = None
+        self.last = None
+
+    def record(self, start: float, end: float, depth: int, error: bool) -> None:
+        with self.lock:
+            self.items += 1
+            self.errors += error
+            self.busy += end - start
+            self.depth_sum += depth
+            self.depth_max = max(self.depth_max, depth)
+            self.first = start if self.first is None else min(self.first, start)
+            self.last = end if self.last is None else max(self.last, end)
+
+    def summary(self) -> str:
+        with self.lock:
+            span = (self.last - self.first) if self.items else 0.0
+            rate = self.items / span if span > 0 else 0.0
+            utilization = self.busy / (span * self.stage.workers) if span > 0 else 0.0
+            depth = self.depth_sum / self.items if self.items else 0.0
+            return (f"  {self.stage.name:<10} workers: {self.stage.workers:>3}, items: {self.items}, errors: {self.errors}, "
+                    f"{rate:.2f} items/s, utilization: {100 * utilization:.0f}%, "
+                    f"input queue depth: avg {depth:.1f}, max {self.depth_max}")
+
+
+class Pipeline:
+    """
+    Runs items through a sequence of stages, each stage with its own pool of worker threads.
+
+    Stages are connected by bounded queues (`queue_size`): a stage runs as soon as its input is
+    there, so a slow stage (e.g. generation) no longer holds up the fast ones (LFSS reads), and
+    a full queue blocks the stage in front of it instead of piling items up in memory. The
+    concurrency of a stage is its number of workers, so each kind of call gets its own limit.
+    Outputs are handed to `on_result` on the calling thread, in completion order.
+    """
+
+    def __init__(self, stages: List[Stage], queue_size: int = 64, name: str = "Pipeline"):
+        self.stages = stages
+        self.queue_size = max(1, queue_size)
+        self.name = name
+        self.stats = [StageStats(stage) for stage in stages]
+        self.cancelled = threading.Event()
+
+    def _put(self, q: queue.Queue, item: Any) -> bool:
+        # blocking put that gives up once the pipeline is cancelled
+        while not self.cancelled.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _feed(self, items: List[Any], q: queue.Queue, workers: int) -> None:
+        for item in items:
+            if not self._put(q, item):
+                return
+        for _ in range(workers):
+            self._put(q, _STOP)
+
+    def _work(self, i: int, inq: queue.Queue, outq: queue.Queue, results: queue.Queue, remaining: List[int], lock: threading.Lock) -> None:
+        stage, stats = self.stages[i], self.stats[i]
+        last = i == len(self.stages) - 1
+        while not self.cancelled.is_set():
+            try:
+                item = inq.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _STOP:
+                break
+            depth = inq.qsize()
+            start, error = time.monotonic(), False
+            try:
+                out = stage.fn(item)
+            except Exception as e:
+                error = True
+                try:
+                    if stage.on_error is None:
+                        raise
+                    out = Finished(stage.on_error(item, e))
+                except Exception as failure:
+                    stats.record(start, time.monotonic(), depth, True)
+                    results.put(_Failure(failure))
+                    return
+            stats.record(start, time.monotonic(), depth, error)
+            if isinstance(out, Finished):
+                results.put(out.output)
+            elif last:
+                results.put(out)
+            elif not self._put(outq, out):
+                return
+        with lock:
+            remaining[i] -= 1
+            done = remaining[i] == 0
+        # the last worker of a stage stops the next one
+        if done and not last:
+            for _ in range(self.stages[i + 1].workers):
+                self._put(outq, _STOP)
+
+    def run(self, items: Iterable[Any], on_result: Callable[[Any], None], desc: str = "Processing") -> None:
+        """Process all items, calling `on_result` with each output; raises the first unhandled stage error."""
+        items = list(items)
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages] + [None]
+        results: queue.Queue = queue.Queue()
+        remaining = [stage.workers for stage in self.stages]
+        lock = threading.Lock()
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0], self.stages[0].workers), name=f"{self.name}-feed", daemon=True)]
+        for i, stage in enumerate(self.stages):
+            for n in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work, args=(i, queues[i], queues[i + 1], results, remaining, lock),
+                    name=f"{self.name}-{stage.name}-{n}", daemon=True,
+                ))
+        for thread in threads:
+            thread.start()
+        try:
+            for _ in tqdm(range(len(items)), desc=desc, unit="task", dynamic_ncols=True):
+                out = results.get()
+                if isinstance(out, _Failure):
+                    raise out.exc
+                on_result(out)
+        finally:
+            # on an error or Ctrl-C the workers drop what they hold and exit
+            self.cancelled.set()
+
+    def summary(self) -> str:
+        return "\n".join([f"[{self.name}] per-stage stats:"] + [stats.summary() for stats in self.stats])
+
+
+def stage_workers(args: Namespace, stage: str) -> int:
+    """Workers of a generation pipeline stage: `--pipeline_<stage>_workers`, by default `--workers`."""
+    return getattr(args, f"pipeline_{stage}_workers", None) or args.workers
@@ -1,3 +1,4 @@
+import json
 import string
 
 translate_dent_json_zh2en = string.Template("""\
@@ -164,6 +165,9 @@ label_desc_en = {
     }
 }
 
+# serialized once, as model.j2t() would
+label_desc_en_json = json.dumps(label_desc_en, ensure_ascii=False, indent=2)
+
 
 classify_intraoral_condition = string.Template("""\
 You are a professional dentist. Now you have some descriptive diagnostic texts about patients in JSON format. 
@@ -418,6 +422,37 @@ Do not include any additional explanations, text, or formatting outside the JSON
 ```
 """)
 
+vqa_answer_intraoral_condition_batch = string.Template("""\
+You are a professional dentist. You are now presented with a clinical image of a patient and a list of $count questions about this image.
+Please answer every question independently, selecting only one correct answer for each question based on the visual evidence from the image.
+
+Below are the questions:
+[Questions]:
+```json
+$questions
+```
+
+Each question has an "index", the "question" text, its "choice" options and the allowed "answer_options".
+
+Your output should be a JSON array with exactly $count elements, one for each question and in the same order as the questions. Each element is a JSON object with the following keys:
+- "index": The index of the question being answered.
+- "answer": Your selected option for this question, represented as one of its answer_options.
+- "reason": The reasoning and supporting visual evidence for your chosen answer.
+
+Do not include any additional explanations, text, or formatting outside the JSON.
+
+[Output Template]:
+```json
+[
+    {
+        "index": <fill in the question index>,
+        "answer": <fill in the selected answer as specified above>,
+        "reason": <fill in the reasoning and supporting evidence as specified above>
+    }
+]
+```
+""")
+
 verifier_intraoral_condition = string.Template("""\
 
 You are a professional dentist with expertise in oral diagnostics and imaging. You will be provided with two inputs in JSON format:
@@ -498,3 +533,88 @@ The output must be in JSON format.
 }
 ```
 """)
+
+verifier_intraoral_condition_batch = string.Template("""\
+
+You are a professional dentist with expertise in oral diagnostics and imaging. You will be provided with two inputs in JSON format:
+- A descriptive diagnostic text detailing clinical findings from a patient’s intraoral images.
+- A list of $count AI-generated Visual Question Answering (VQA) items, each consisting of a question and its answer about the same images.
+Your task is to evaluate the consistency of every AI-generated VQA item against the diagnostic text, independently of the other items, and revise it as necessary to ensure full alignment.
+
+If you determine that a VQA item does not match the texts, you must revise that item so that it satisfies the requirements. 
+Note that: 
+1. The question must focus on the region described in the text or using the region inferred from the description. For example, an image showing only the upper jaw should not have questions about the lower jaw (or the answer should be "Unknown" if the question is about the lower jaw, or the question should be about the visibility of the lower jaw). 
+2. Any abnormalities/disease not mentioned in the text (but within the described region) are assumed absent, constructing questions based on such deduced non-existent abnormalities is acceptable.
+3. If any item in the diagnostic text is marked with low_confidence: true, it must not be used to generate or support any question or answer. Any VQA content relying on such uncertain observations must be revised or removed.
+4. Be conservative in your judgement and revisions. If you are unsure, it is better to mark the VQA as valid. If the VQA content is largely correct with only minor issues, make minimal necessary changes to ensure accuracy and alignment with the text.
+5. When describing tooth positions, the FDI notation is used by default. Sometimes the # symbol is omitted in the description. For example, "11" refers to "Upper Right Central Incisor," and "18" refers to "Upper Right Third Molar.". Interpret tooth ranges as inclusive sequences: ranges spanning opposite quadrants (e.g., 12–22 or 22–12) include all teeth crossing the midline (12,11,21,22); ranges within the same quadrant (e.g., 21–25) include sequential teeth in that quadrant (21,22,23,24,25).
+
+**FDI Tooth Numbering System**:
+| Upper Right | Upper Left |
+| Lower Right | Lower Left |
+
+```Permanent tooth
+| #18, #17, #16, #15, #14, #13, #12, #11 | #21, #22, #23, #24, #25, #26, #27, #28 |  
+| #48, #47, #46, #45, #44, #43, #42, #41 | #31, #32, #33, #34, #35, #36, #37, #38 |
+```
+
+```Deciduous tooth
+| #55, #54, #53, #52, #51 | #61, #62, #63, #64, #65 |
+| #85, #84, #83, #82, #81 | #71, #72, #73, #74, #75 |
+```
+
+Below is the patient's descriptive diagnostic text:
+[Diagnostic Text Input]:
+```json
+$case
+```
+
+Below are the AI-generated VQA items, each with an "index":
+[AI Input]:
+```json
+$ai_input
+```
+
+Your output should be a JSON array with exactly $count elements, one for each VQA item and in the same order as the items. Each element is a JSON object with the following keys:
+- "index": The index of the VQA item being evaluated.
+- "invalid": Whether there is an error with this VQA item. (true/false)
+- "error_type": One of the following error categories: 
+    * multiple answers present
+    * using uncertain information
+    * incorrect answer
+    * common knowledge error
+    * original annotation insufficient detail
+    * out-of-region question
+    * incorrect tooth position
+    * hallucination (error within the described region)
+    * other
+    * null (if "invalid" is false)
+- "evidence": The evidence text from the input that supports your judgment.
+- "new_question": A dictionary containing the corrected VQA data of this item. This field is required only when "invalid" is true. 
+
+Note on construction of the revised question if new_question is needed (besides the above criteria): 
+The question should be a JSON array, where each element is a dictionary containing the following keys:
+- "question_type": The question type ID (for single-choice: multiple_choice; for true/false: judge)
+- "question": The question text
+- "choice": The options, formatted as a dictionary where the key is the option label (A–D for single-choice, A–B for true/false) and the value is the corresponding option text
+- "answer": The correct answer (A-D for single-choice; A-B for true/false)
+- "reason": The rationale and supporting evidence for why the correct answer is chosen
+1. Generate questions only for the content of the image. Do not include any treatment suggestions, or basic dental knowledge. 
+2. Be professional about the wording, carefully review before answering to avoid incorrect dental terminology or descriptions.
+3. The questions must be concise and precise, avoiding vague or ambiguous wording. No need to mention "based on the description" or "The description mentions"...
+4. All questions should be generated strictly within the region described in the given text. Any findings not mentioned in the description should be considered normal within that region and may be used to construct questions and answers. For non-existent abnormality questions, you may choose from conditions such as dental caries, non-carious tooth defects, tooth wear or erosion, gingival redness and swelling, gingival recession, dental plaque or calculus, tooth discoloration, dentition defects, residual roots, restorations, fixed prostheses, removable dentures, interdental spacing, dental crowding or malocclusion, traditional orthodontic appliances, clear aligners, or oral ulcers. You may also generate questions based on your other dental knowledge, as long as the content remains consistent with the described region. Any abnormal findings not provided in the text should be treated as normal for that region. We require a diverse set of questions. Options may include 'All of the above', 'None of the above' or 'Unknown'.
+
+The output must be in JSON format.
+[Output Template]:
+```json
+[
+    {
+        "index": <fill in the VQA item index>,
+        "invalid": true/false,
+        "error_type": ...,
+        "evidence": ...,
+        "new_question": ...
+    }
+]
+```
+""")
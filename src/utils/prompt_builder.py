@@ -0,0 +1,48 @@
+import re
+import string
+from functools import lru_cache
+
+# placeholders that take the same value in every prompt of a run, they are part of the static text
+STATIC_FIELDS = frozenset({"label_desc"})
+# an input section: optional "Below is ..." line, optional "[Name]:" line and a ```json block
+_SECTION = re.compile(r"^(?:Below (?:is|are) [^\n]*\n)?(?:\[[^\]\n]+\]:\n)?```json\n.*?^```[ \t]*(?:\n|$)", re.M | re.S)
+_PLACEHOLDER = re.compile(r"\$(?:(\w+)|\{(\w+)\})")
+
+PREFIX_FIRST = False
+
+
+def configure_prompts(prefix_first: bool) -> None:
+    """Layout of all prompts built by this process, see build_prompt()."""
+    global PREFIX_FIRST
+    PREFIX_FIRST = prefix_first
+
+def is_sample_section(section: str) -> bool:
+    """Whether an input section holds per-sample content (a placeholder other than STATIC_FIELDS)."""
+    return any((name or braced) not in STATIC_FIELDS for name, braced in _PLACEHOLDER.findall(section))
+
+@lru_cache(maxsize=None)
+def prefix_first_template(template: string.Template) -> string.Template:
+    """
+    `template` with its per-sample input sections moved behind the static text (instructions,
+    output format, constant blocks), in their original order.
+
+    Requests built from the same template then share everything up to the first per-sample
+    section, which a server with prefix caching (vLLM automatic prefix caching) prefills once.
+    """
+    sections = [m.group(0) for m in _SECTION.finditer(template.template) if is_sample_section(m.group(0))]
+    if not sections:
+        return template
+    static = template.template
+    for section in sections:
+        static = static.replace(section, "", 1)
+    static = re.sub(r"\n{3,}", "\n\n", static).rstrip("\n")
+    return string.Template(static + "\n\n" + "\n".join(section.rstrip("\n") + "\n" for section in sections))
+
+def build_prompt(template: string.Template, **values) -> str:
+    """
+    `template.substitute(**values)`; with `--prefix_cache_prompts` the per-sample input
+    sections come last (see prefix_first_template()).
+    """
+    if PREFIX_FIRST:
+        template = prefix_first_template(template)
+    return template.substitute(**values)
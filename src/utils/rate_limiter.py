@@ -0,0 +1,238 @@
+import asyncio
+import os
+import random
+import sqlite3
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+import requests
+from openai import APIConnectionError
+
+T = TypeVar("T")
+
+
+def status_code(e: BaseException) -> Optional[int]:
+    """HTTP status of an openai/requests error, if any."""
+    status = getattr(e, "status_code", None)
+    if status is None:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+    return status
+
+def retry_after_seconds(e: BaseException) -> Optional[float]:
+    """Delay requested by the server through `Retry-After` (seconds or HTTP date) or `retry-after-ms`."""
+    headers = getattr(getattr(e, "response", None), "headers", None)
+    if not headers:
+        return None
+    if (ms := headers.get("retry-after-ms")) is not None:
+        try:
+            return float(ms) / 1000
+        except ValueError:
+            pass
+    if (value := headers.get("retry-after")) is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+def is_retryable(e: BaseException) -> bool:
+    """Rate limiting (429), server errors (5xx) and connection failures/timeouts."""
+    status = status_code(e)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(e, (APIConnectionError, requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError))
+
+def backoff_delay(attempt: int, base: float = 1.0, max_delay: float = 60.0) -> float:
+    """Exponential backoff with jitter: a random delay in [d/2, d] with d = base * 2^(attempt-1)."""
+    d = min(max_delay, base * 2 ** (attempt - 1))
+    return d / 2 + random.uniform(0, d / 2)
+
+def retry_delay(e: BaseException, attempt: int, base: float = 1.0, max_delay: float = 60.0, limiter: Optional["RateLimiter"] = None) -> float:
+    """Delay before retry `attempt`: the server's Retry-After (shared through `limiter`) or exponential backoff."""
+    if (retry_after := retry_after_seconds(e)) is not None:
+        if limiter is not None:
+            limiter.block_for(retry_after)
+        return retry_after
+    return backoff_delay(attempt, base, max_delay)
+
+
+class RateLimiter:
+    """
+    Token-bucket limiter for requests/sec and tokens/min, shared by all processes on a host.
+
+    The bucket state of each endpoint lives in one row of a small SQLite table and is
+    updated in `BEGIN IMMEDIATE` transactions, so shards that use the same endpoint (and
+    key) draw from the same budget. A `Retry-After` received by any process pauses all of
+    them until it expires.
+
+    Token usage is not known before a request: callers acquire an estimate and `settle()`
+    the difference once the response reports its usage. A request larger than the whole
+    per-minute budget is let through when the bucket is full.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        name: str,
+        requests_per_sec: float = 0,
+        tokens_per_min: float = 0,
+        max_retries: int = 5,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+    ):
+        self.db_path = db_path
+        self.name = name
+        self.requests_per_sec = requests_per_sec
+        self.tokens_per_min = tokens_per_min
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # allow a burst of one second of requests
+        self.request_capacity = max(1.0, requests_per_sec)
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS rate_limits ("
+            "name TEXT PRIMARY KEY, requests REAL, tokens REAL, updated_at REAL, blocked_until REAL)"
+        )
+        self.conn.execute(
+            "INSERT OR IGNORE INTO rate_limits (name, requests, tokens, updated_at, blocked_until) VALUES (?, ?, ?, ?, 0)",
+            (name, self.request_capacity, float(tokens_per_min), time.time()),
+        )
+
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.retries = 0
+
+    def try_acquire(self, tokens: float = 0) -> float:
+        """Take one request and `tokens` tokens if available. Returns 0 on success, else the seconds to wait."""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                req, tok, updated_at, blocked_until = self.conn.execute(
+                    "SELECT requests, tokens, updated_at, blocked_until FROM rate_limits WHERE name = ?", (self.name,)
+                ).fetchone()
+                now = time.time()
+                if blocked_until > now:
+                    return blocked_until - now
+                elapsed = max(0.0, now - updated_at)
+                wait = 0.0
+                if self.requests_per_sec:
+                    req = min(self.request_capacity, req + elapsed * self.requests_per_sec)
+                    if req < 1:
+                        wait = (1 - req) / self.requests_per_sec
+                if self.tokens_per_min:
+                    tok = min(self.tokens_per_min, tok + elapsed * self.tokens_per_min / 60)
+                    need = min(tokens, self.tokens_per_min)
+                    if tok < need:
+                        wait = max(wait, (need - tok) / (self.tokens_per_min / 60))
+                if wait == 0:
+                    req -= 1
+                    tok -= tokens
+                self.conn.execute(
+                    "UPDATE rate_limits SET requests = ?, tokens = ?, updated_at = ? WHERE name = ?",
+                    (req, tok, now, self.name),
+                )
+                return wait
+            finally:
+                self.conn.execute("COMMIT")
+
+    def acquire(self, tokens: float = 0) -> None:
+        while (wait := self.try_acquire(tokens)) > 0:
+            self._count_wait(wait)
+            time.sleep(wait)
+
+    async def async_acquire(self, tokens: float = 0) -> None:
+        # try_acquire() may block on the shared SQLite lock (busy timeout 60s), keep it off the event loop
+        while (wait := await asyncio.to_thread(self.try_acquire, tokens)) > 0:
+            self._count_wait(wait)
+            await asyncio.sleep(wait)
+
+    def _count_wait(self, wait: float) -> None:
+        with self.lock:
+            self.waits += 1
+            self.wait_seconds += wait
+
+    def settle(self, estimated_tokens: float, actual_tokens: Optional[float]) -> None:
+        """Correct the token bucket once the real usage of a request is known."""
+        if not self.tokens_per_min or actual_tokens is None or actual_tokens == estimated_tokens:
+            return
+        with self.lock:
+            self.conn.execute(
+                "UPDATE rate_limits SET tokens = tokens - ? WHERE name = ?",
+                (actual_tokens - estimated_tokens, self.name),
+            )
+
+    def block_for(self, seconds: float) -> None:
+        """Pause all users of this endpoint for `seconds` (e.g. from a Retry-After header)."""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE rate_limits SET blocked_until = MAX(blocked_until, ?) WHERE name = ?",
+                (time.time() + seconds, self.name),
+            )
+
+    def retry_delay(self, e: BaseException, attempt: int, base: Optional[float] = None) -> float:
+        with self.lock:
+            self.retries += 1
+        return retry_delay(e, attempt, base or self.backoff_base, self.backoff_max, limiter=self)
+
+    def call(self, fn: Callable[[], T], tokens: float = 0) -> T:
+        """Run `fn` within the limits, retrying retryable errors up to `max_retries` times."""
+        attempt = 0
+        while True:
+            self.acquire(tokens)
+            try:
+                return fn()
+            except Exception as e:
+                attempt += 1
+                if attempt > self.max_retries or not is_retryable(e):
+                    raise
+                time.sleep(self.retry_delay(e, attempt))
+
+    async def async_call(self, fn: Callable[[], Awaitable[T]], tokens: float = 0) -> T:
+        attempt = 0
+        while True:
+            await self.async_acquire(tokens)
+            try:
+                return await fn()
+            except Exception as e:
+                attempt += 1
+                if attempt > self.max_retries or not is_retryable(e):
+                    raise
+                await asyncio.sleep(await asyncio.to_thread(self.retry_delay, e, attempt))
+
+    def summary(self) -> str:
+        with self.lock:
+            return (f"[RateLimiter] '{self.name}': waits: {self.waits} ({self.wait_seconds:.1f}s), retries: {self.retries} "
+                    f"(limits: {self.requests_per_sec or '-'} req/s, {self.tokens_per_min or '-'} tokens/min)")
+
+
+RATE_LIMITS: Dict[str, Dict[str, Any]] = {}
+RATE_LIMIT_DB = "data/cache/rate_limits.sqlite"
+_LIMITERS: Dict[str, RateLimiter] = {}
+_LIMITERS_LOCK = threading.Lock()
+
+def configure_rate_limits(rate_limits: Optional[Dict[str, Dict[str, Any]]], db_path: str) -> None:
+    """Set the per-endpoint limits (the `rate_limits` section of config.yaml) and the shared state file."""
+    global RATE_LIMIT_DB
+    RATE_LIMITS.clear()
+    for endpoint, cfg in (rate_limits or {}).items():
+        RATE_LIMITS[endpoint.rstrip("/")] = cfg or {}
+    RATE_LIMIT_DB = db_path
+
+def get_rate_limiter(endpoint: Optional[str]) -> Optional[RateLimiter]:
+    """The process-wide limiter of `endpoint`, or None if config.yaml sets no limits for it."""
+    if not endpoint or (endpoint := endpoint.rstrip("/")) not in RATE_LIMITS:
+        return None
+    with _LIMITERS_LOCK:
+        if endpoint not in _LIMITERS:
+            _LIMITERS[endpoint] = RateLimiter(RATE_LIMIT_DB, endpoint, **RATE_LIMITS[endpoint])
+        return _LIMITERS[endpoint]
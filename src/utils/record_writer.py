@@ -0,0 +1,208 @@
+import json
+import os
+import queue
+import threading
+import time
+from typing import Any, Dict, List, Literal, Optional, TextIO, Tuple
+
+from tqdm import tqdm
+
+from src.utils.result_store import ResultStore
+
+FSYNC_POLICIES = ("never", "batch", "close")
+_STOP = object()
+
+
+class RecordWriter:
+    """
+    Group-commit writer of the per-sample records of one run directory.
+
+    Producers (the `as_completed` loop, async callbacks, worker threads) only put records
+    on a queue; a background thread serializes them and writes them in batches: a batch is
+    written as soon as it holds `batch_size` records, or `flush_interval` seconds after its
+    first record arrived, with one write + flush per JSONL file (or one SQLite transaction
+    with `--result_store sqlite`) instead of one per record.
+
+    `fsync` decides when the written data is forced to disk: "batch" after every batch,
+    "close" once when the writer is closed, "never" leaves it to the OS. A record is
+    acknowledged once `put` returns: closing the writer (also on Ctrl-C, when the `with`
+    blocks of the outputs unwind) drains the queue before returning. Only a hard kill can
+    lose the records of the last `flush_interval` seconds, and resuming redoes them.
+    """
+
+    def __init__(self, store: Optional[ResultStore] = None, batch_size: int = 64, flush_interval: float = 1.0,
+                 fsync: Literal["never", "batch", "close"] = "close", name: str = ""):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"fsync must be one of {FSYNC_POLICIES}, got '{fsync}'")
+        self.store = store
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.name = name
+        self.files: Dict[str, TextIO] = {}
+        self.queue: "queue.Queue[Any]" = queue.Queue()
+        self.lock = threading.Lock()
+        self.refs = 0
+        self.closed = False
+        self.error: Optional[BaseException] = None
+        self.records = 0
+        self.batches = 0
+        self.fsyncs = 0
+        if store is not None and fsync == "batch":
+            store.set_synchronous("FULL")
+        # not a daemon: even if the main thread is interrupted while waiting, the interpreter waits for the queue to drain
+        self.worker = threading.Thread(target=self._loop, name="record-writer", daemon=False)
+        self.worker.start()
+
+    def open(self, kind: str, path: str) -> "RecordOutput":
+        """Output of one record kind (`path` is its JSONL file, unused with a store); the writer closes with its last output."""
+        try:
+            with self.lock:
+                if self.closed:
+                    raise RuntimeError(f"RecordWriter of '{self.name}' is closed")
+                if self.store is None and kind not in self.files:
+                    self.files[kind] = open(path, "a", encoding="utf-8")
+                self.refs += 1
+        except BaseException:
+            if self.refs == 0:
+                # the writer thread is not a daemon, a writer without outputs has to be stopped
+                self.close()
+            raise
+        return RecordOutput(self, kind)
+
+    def put(self, kind: str, record: Dict[str, Any]) -> None:
+        if self.error is not None:
+            raise self.error
+        self.queue.put((kind, record))
+
+    def release(self) -> None:
+        with self.lock:
+            self.refs -= 1
+            last = self.refs == 0
+        if last:
+            self.close()
+
+    def close(self) -> None:
+        """Write everything queued so far, apply the fsync policy and stop the writer thread."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.queue.put(_STOP)
+        self.worker.join()
+        for f in self.files.values():
+            f.close()
+        if self.records:
+            tqdm.write(self.summary())
+        if self.error is not None:
+            raise self.error
+
+    def _collect(self) -> Tuple[List[Tuple[str, Dict[str, Any]]], bool]:
+        item = self.queue.get()
+        if item is _STOP:
+            return [], True
+        batch = [item]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                # records that are already queued are taken without waiting
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if item is _STOP:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _loop(self):
+        stop = False
+        while not stop:
+            batch, stop = self._collect()
+            if not batch or self.error is not None:
+                continue
+            try:
+                self._write(batch)
+            except BaseException as e:
+                # keep draining so producers never block, the error is raised on their next put / close
+                tqdm.write(f"[RecordWriter] Failed to write {len(batch)} records of '{self.name}': {e}")
+                self.error = e
+        if self.error is None and self.fsync == "close":
+            try:
+                self._sync()
+            except BaseException as e:
+                self.error = e
+
+    def _write(self, batch: List[Tuple[str, Dict[str, Any]]]) -> None:
+        if self.store is not None:
+            self.store.put_many(batch)
+        else:
+            lines: Dict[str, List[str]] = {}
+            for kind, record in batch:
+                lines.setdefault(kind, []).append(json.dumps(record, ensure_ascii=False) + "\n")
+            for kind, kind_lines in lines.items():
+                self.files[kind].write("".join(kind_lines))
+                self.files[kind].flush()
+        if self.fsync == "batch":
+            self._sync()
+        with self.lock:
+            self.records += len(batch)
+            self.batches += 1
+
+    def _sync(self) -> None:
+        if self.store is None:
+            for f in self.files.values():
+                os.fsync(f.fileno())
+        elif self.fsync == "close":
+            self.store.checkpoint()
+        # with "batch", synchronous=FULL has already synced the WAL on commit
+        with self.lock:
+            self.fsyncs += 1
+
+    def summary(self) -> str:
+        with self.lock:
+            avg = self.records / self.batches if self.batches else 0.0
+            return (f"[RecordWriter] '{self.name}': {self.records} records in {self.batches} writes "
+                    f"(avg {avg:.1f} per write), fsync: {self.fsync} ({self.fsyncs})")
+
+
+class RecordOutput:
+    """Output of one record kind of a RecordWriter, used in place of an open JSONL file."""
+
+    def __init__(self, writer: RecordWriter, kind: str):
+        self.writer = writer
+        self.kind = kind
+        self.closed = False
+
+    def put(self, record: Dict[str, Any]) -> None:
+        self.writer.put(self.kind, record)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.writer.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+RECORD_WRITERS: Dict[str, RecordWriter] = {}
+RECORD_WRITERS_LOCK = threading.Lock()
+
+def get_record_writer(run_dir: str, store: Optional[ResultStore] = None, batch_size: int = 64,
+                      flush_interval: float = 1.0, fsync: str = "close") -> RecordWriter:
+    """RecordWriter shared by all outputs of a run directory, started when the first output is opened."""
+    run_dir = os.path.abspath(run_dir)
+    with RECORD_WRITERS_LOCK:
+        writer = RECORD_WRITERS.get(run_dir)
+        if writer is None or writer.closed:
+            writer = RECORD_WRITERS[run_dir] = RecordWriter(store, batch_size, flush_interval, fsync, name=run_dir)
+        return writer
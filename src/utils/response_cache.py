@@ -0,0 +1,127 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+from src.utils.image_cache import get_encoded_image
+
+
+class ResponseCache:
+    """
+    Content-addressed, on-disk cache of model responses backed by SQLite (WAL mode).
+
+    Entries are keyed by served model name, prompt hash, image content hash, temperature
+    and output type, so replaying a run costs no request for any call whose inputs did not
+    change. Several processes on one host can share the same file.
+
+    Only successfully parsed responses are stored. By default only deterministic calls
+    (temperature 0) are cached; pass `cache_sampled=True` to also replay sampled calls.
+    """
+
+    EVICT_EVERY = 1000
+
+    def __init__(
+        self,
+        db_path: str,
+        max_size_mb: float = 2048,
+        max_age_days: float = 30,
+        cache_sampled: bool = False,
+    ):
+        self.db_path = db_path
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else 0
+        self.max_age_seconds = max_age_days * 86400 if max_age_days else 0
+        self.cache_sampled = cache_sampled
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, created_at REAL, accessed_at REAL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.evict()
+
+    def enabled_for(self, temperature: Optional[float]) -> bool:
+        return self.cache_sampled or not temperature
+
+    def make_key(
+        self,
+        model_name: str,
+        prompt: str,
+        image_path: Optional[str],
+        temperature: Optional[float],
+        output_type: type,
+    ) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        image_hash = get_encoded_image(image_path).digest if image_path else ""
+        parts = [model_name, prompt_hash, image_hash, repr(float(temperature or 0.0)), output_type.__name__]
+        return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, key: str, model_name: str, response: str) -> None:
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_name, response, len(response.encode("utf-8")), now, now),
+            )
+            self.puts += 1
+            evict = self.puts % self.EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> int:
+        """Drop entries older than the age limit, then least recently used ones until under the size limit."""
+        removed = 0
+        with self.lock:
+            if self.max_age_seconds:
+                cur = self.conn.execute("DELETE FROM responses WHERE created_at < ?", (time.time() - self.max_age_seconds,))
+                removed += cur.rowcount
+            if self.max_size_bytes:
+                total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                if total > self.max_size_bytes:
+                    excess = total - self.max_size_bytes
+                    keys = []
+                    for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+                        if excess <= 0:
+                            break
+                        keys.append((key,))
+                        excess -= size
+                    self.conn.executemany("DELETE FROM responses WHERE key = ?", keys)
+                    removed += len(keys)
+        return removed
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            entries, size = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "size_mb": size / 1024 / 1024,
+        }
+
+    def summary(self) -> str:
+        s = self.stats()
+        return (f"[ResponseCache] hits: {s['hits']}, misses: {s['misses']}, hit_rate: {s['hit_rate']:.2%}, "
+                f"entries: {s['entries']}, size: {s['size_mb']:.1f} MB ('{self.db_path}')")
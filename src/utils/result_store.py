@@ -0,0 +1,154 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Set, Tuple
+
+from tqdm import tqdm
+
+from src.utils.json_stream import write_json_entries
+
+# record kinds and the JSONL file each of them replaces
+KINDS = ("results", "translate", "failures", "refine")
+JSONL_FILES = {"results": "results.jsonl", "translate": "translate.jsonl", "failures": "failures.jsonl", "refine": "refine.jsonl"}
+STORE_FILE = "results.sqlite"
+
+
+class ResultStore:
+    """
+    Indexed store of the per-sample records of one run directory, replacing the JSONL files.
+
+    One SQLite database (WAL mode) per `data/<task>/<subtask>/<model>/`, one row per
+    (kind, sample id). A record is an upsert (the latest record of an id wins, as when the
+    JSONL files are folded into a dict), "which ids are done" is a range query on the primary
+    key, and the ordered `<kind>.json` export streams rows in key order instead of parsing and
+    sorting the whole JSONL file. Existing JSONL files of the directory are imported once.
+    """
+
+    def __init__(self, run_dir: str):
+        self.run_dir = run_dir
+        self.path = os.path.join(run_dir, STORE_FILE)
+        os.makedirs(run_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # WAL with synchronous=NORMAL: a commit is an append to the log, fsync happens at checkpoints
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS records (kind TEXT, id TEXT, value TEXT, updated REAL, PRIMARY KEY (kind, id)) WITHOUT ROWID")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.writes = 0
+        for kind in KINDS:
+            self.migrate_jsonl(kind)
+
+    def migrate_jsonl(self, kind: str) -> int:
+        """Import `<kind>.jsonl` of the run directory once (later lines win), the file is left in place."""
+        jsonl_path = os.path.join(self.run_dir, JSONL_FILES[kind])
+        with self.lock:
+            if not os.path.exists(jsonl_path) or self.conn.execute("SELECT 1 FROM meta WHERE key = ?", (f"migrated:{kind}",)).fetchone():
+                return 0
+            start, n = time.time(), 0
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                with open(jsonl_path, "r", encoding="utf-8") as f:
+                    rows = []
+                    for line in f:
+                        try:
+                            data = json.loads(line.strip())
+                        except Exception:
+                            continue
+                        rows += [(kind, key, json.dumps(value, ensure_ascii=False), start) for key, value in data.items()]
+                        if len(rows) >= 10000:
+                            self.conn.executemany("INSERT OR REPLACE INTO records (kind, id, value, updated) VALUES (?, ?, ?, ?)", rows)
+                            n, rows = n + len(rows), []
+                    self.conn.executemany("INSERT OR REPLACE INTO records (kind, id, value, updated) VALUES (?, ?, ?, ?)", rows)
+                    n += len(rows)
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"migrated:{kind}", jsonl_path))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        tqdm.write(f"[ResultStore] Imported {n} records of '{jsonl_path}' into '{self.path}' ({time.time() - start:.1f}s)")
+        return n
+
+    def put(self, kind: str, record: Dict[str, Any]) -> None:
+        """Upsert a record {sample id: value} (one task output) in one transaction."""
+        self.put_many([(kind, record)])
+
+    def put_many(self, records: List[Tuple[str, Dict[str, Any]]]) -> None:
+        """Upsert (kind, record) pairs in one transaction, later records of an id win."""
+        now = time.time()
+        rows = [(kind, key, json.dumps(value, ensure_ascii=False), now) for kind, record in records for key, value in record.items()]
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                self.conn.executemany("INSERT OR REPLACE INTO records (kind, id, value, updated) VALUES (?, ?, ?, ?)", rows)
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.writes += len(rows)
+
+    def ids(self, kind: str, start: Optional[str] = None, end: Optional[str] = None) -> Set[str]:
+        """Ids that have a `kind` record, optionally limited to [start, end]."""
+        query, params = "SELECT id FROM records WHERE kind = ?", [kind]
+        if start is not None:
+            query, params = query + " AND id >= ?", params + [start]
+        if end is not None:
+            query, params = query + " AND id <= ?", params + [end]
+        with self.lock:
+            return {row[0] for row in self.conn.execute(query, params)}
+
+    def count(self, kind: str) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM records WHERE kind = ?", (kind,)).fetchone()[0]
+
+    def iter_sorted(self, kind: str, batch_size: int = 1000) -> Iterator[Tuple[str, Any]]:
+        """(id, value) of every `kind` record in id order (SQLite's binary collation is code point order, as sorted())."""
+        last = None
+        while True:
+            with self.lock:
+                if last is None:
+                    rows = self.conn.execute("SELECT id, value FROM records WHERE kind = ? ORDER BY id LIMIT ?", (kind, batch_size)).fetchall()
+                else:
+                    rows = self.conn.execute("SELECT id, value FROM records WHERE kind = ? AND id > ? ORDER BY id LIMIT ?", (kind, last, batch_size)).fetchall()
+            if not rows:
+                return
+            for key, value in rows:
+                yield key, json.loads(value)
+            last = rows[-1][0]
+
+    def export_json(self, kind: str, json_path: str) -> int:
+        """Write the ordered `{id: value}` JSON of `kind`, streaming (same bytes as the JSONL conversion)."""
+        tmp_path = json_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            n = write_json_entries(f, self.iter_sorted(kind))
+        os.replace(tmp_path, json_path)
+        return n
+
+    def set_synchronous(self, level: str) -> None:
+        """SQLite `synchronous` level of the commits: NORMAL (default) or FULL (fsync the WAL on every commit)."""
+        with self.lock:
+            self.conn.execute(f"PRAGMA synchronous={level}")
+
+    def checkpoint(self) -> None:
+        """Copy the WAL into the database file and fsync it."""
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(FULL)")
+
+    def clear(self, kind: Optional[str] = None) -> None:
+        with self.lock:
+            if kind is None:
+                self.conn.execute("DELETE FROM records")
+            else:
+                self.conn.execute("DELETE FROM records WHERE kind = ?", (kind,))
+
+
+RESULT_STORES: Dict[str, ResultStore] = {}
+
+def get_result_store(run_dir: str) -> ResultStore:
+    """Process-wide ResultStore of a run directory, opened (and migrated) on first use."""
+    run_dir = os.path.abspath(run_dir)
+    if run_dir not in RESULT_STORES:
+        RESULT_STORES[run_dir] = ResultStore(run_dir)
+    return RESULT_STORES[run_dir]
@@ -0,0 +1,138 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from src.models.base_model import BaseModel
+from src.utils import prompt, prompt_builder
+from src.utils.prompt_builder import build_prompt, prefix_first_template
+from src.utils.usage_meter import usage_tag
+
+
+def prompt_version() -> str:
+    """Hash of the translation prompt as this process builds it (template and layout); translations made with another prompt are not reused."""
+    template = prompt.translate_dent_json_zh2en
+    if prompt_builder.PREFIX_FIRST:
+        template = prefix_first_template(template)
+    return hashlib.sha256(template.template.encode("utf-8")).hexdigest()[:12]
+
+
+class TranslationStore:
+    """
+    Shared on-disk store of zh->en label translations, backed by SQLite (WAL mode).
+
+    A translation is keyed by the content hash of the label JSON, the translator model and a
+    version (hash of the translation prompt, plus the optional `--translation_version` tag), so
+    the generators of all subtasks and the captioning evaluator translate an identical label once.
+    Editing the prompt or bumping the tag translates again instead of reusing older translations,
+    which stay in the file. Several processes on one host can share the same file.
+    """
+
+    def __init__(self, db_path: str, version_tag: str = ""):
+        self.db_path = db_path
+        self.version = f"{prompt_version()}-{version_tag}" if version_tag else prompt_version()
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS translations ("
+            "label_hash TEXT, model TEXT, version TEXT, translation TEXT, created_at REAL, "
+            "PRIMARY KEY (label_hash, model, version)) WITHOUT ROWID"
+        )
+
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+
+    @staticmethod
+    def label_hash(label: Any) -> str:
+        return hashlib.sha256(json.dumps(label, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+    def get(self, label: Any, model_name: str) -> Optional[Any]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT translation FROM translations WHERE label_hash = ? AND model = ? AND version = ?",
+                (self.label_hash(label), model_name, self.version),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def contains(self, label: Any, model_name: str) -> bool:
+        """Whether `label` has a translation, without counting a hit or miss."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT 1 FROM translations WHERE label_hash = ? AND model = ? AND version = ?",
+                (self.label_hash(label), model_name, self.version),
+            ).fetchone() is not None
+
+    def put(self, label: Any, model_name: str, translation: Any) -> None:
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO translations (label_hash, model, version, translation, created_at) VALUES (?, ?, ?, ?, ?)",
+                (self.label_hash(label), model_name, self.version, json.dumps(translation, ensure_ascii=False), time.time()),
+            )
+            self.puts += 1
+
+    def stats(self) -> Dict[str, float]:
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM translations WHERE version = ?", (self.version,)).fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "stored": self.puts,
+            "entries": entries,
+        }
+
+    def summary(self) -> str:
+        s = self.stats()
+        return (f"[TranslationStore] hits: {s['hits']}, misses: {s['misses']}, hit_rate: {s['hit_rate']:.2%}, "
+                f"stored: {s['stored']}, entries of version {self.version}: {s['entries']} ('{self.db_path}')")
+
+
+TRANSLATION_STORE: Optional[TranslationStore] = None
+
+def open_translation_store(db_path: str, version_tag: str = "") -> TranslationStore:
+    """Open the store at `db_path` and use it for all translations of this process."""
+    global TRANSLATION_STORE
+    TRANSLATION_STORE = TranslationStore(db_path, version_tag)
+    return TRANSLATION_STORE
+
+def translate_case(label: Any, model: BaseModel) -> Any:
+    """zh->en translation of a label, looked up in the translation store first if it is open."""
+    store = TRANSLATION_STORE
+    if store is not None and (case_en := store.get(label, model.model_name)) is not None:
+        return case_en
+    p = build_prompt(prompt.translate_dent_json_zh2en,
+        case=model.j2t(label)
+        )
+    with usage_tag("translate"):
+        case_en = model.generate_from_text(prompt=p)
+    if store is not None:
+        store.put(label, model.model_name, case_en)
+    return case_en
+
+async def async_translate_case(label: Any, model: BaseModel) -> Any:
+    """Coroutine version of translate_case(), for AsyncAPIModel."""
+    store = TRANSLATION_STORE
+    if store is not None and (case_en := await asyncio.to_thread(store.get, label, model.model_name)) is not None:
+        return case_en
+    p = build_prompt(prompt.translate_dent_json_zh2en,
+        case=model.j2t(label)
+        )
+    with usage_tag("translate"):
+        case_en = await model.generate_from_text(prompt=p)
+    if store is not None:
+        await asyncio.to_thread(store.put, label, model.model_name, case_en)
+    return case_en
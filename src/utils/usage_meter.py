@@ -0,0 +1,78 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict
+
+# rough chars-per-token ratio, only used to estimate prompt sizes before the API reports usage
+CHARS_PER_TOKEN = 4
+
+USAGE_TAG: ContextVar[str] = ContextVar("usage_tag", default="default")
+
+@contextmanager
+def usage_tag(tag: str):
+    """
+    Attribute the requests made inside the block to `tag`.
+
+    Backed by a ContextVar, so it is local to the current thread or asyncio task.
+
+    Example:
+        >>> with usage_tag("vqa_batch"):
+        ...     model.generate_from_image_and_text(image_path, p)
+    """
+    token = USAGE_TAG.set(tag)
+    try:
+        yield
+    finally:
+        USAGE_TAG.reset(token)
+
+
+class UsageMeter:
+    """Thread-safe per-tag counters of requests and the token usage reported by the API."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+
+    def record(self, usage: Any) -> None:
+        """Add one request and its `response.usage` (may be None) to the current tag."""
+        prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+        completion_tokens = getattr(usage, "completion_tokens", None) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", None) or 0
+        with self.lock:
+            c = self.counters[USAGE_TAG.get()]
+            c["requests"] += 1
+            c["prompt_tokens"] += prompt_tokens
+            c["completion_tokens"] += completion_tokens
+            c["cached_tokens"] += cached_tokens
+
+    def get(self, tag: str) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counters.get(tag, {}))
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self.lock:
+            return {tag: dict(c) for tag, c in self.counters.items()}
+
+    def summary(self, name: str) -> str:
+        """
+        Requests and tokens of a run, in total and per tag. `cached` is the part of the prompt
+        tokens the server reported as served from its prefix cache (`prompt_tokens_details.cached_tokens`).
+        """
+        counters = self.snapshot()
+        total: Dict[str, int] = defaultdict(int)
+        for c in counters.values():
+            for key, value in c.items():
+                total[key] += value
+
+        def line(label: str, c: Dict[str, int]) -> str:
+            prompt_tokens, cached_tokens = c.get("prompt_tokens", 0), c.get("cached_tokens", 0)
+            cached = cached_tokens / prompt_tokens if prompt_tokens else 0.0
+            return (f"{label} requests: {c.get('requests', 0)}, prompt tokens: {prompt_tokens}, "
+                    f"cached: {cached_tokens} ({cached:.1%}), completion tokens: {c.get('completion_tokens', 0)}")
+
+        lines = [line(f"[Usage] {name}:", total)]
+        if len(counters) > 1:
+            lines += [line(f"  {tag:<18}", c) for tag, c in sorted(counters.items())]
+        return "\n".join(lines)
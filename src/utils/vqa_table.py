@@ -0,0 +1,153 @@
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from src.utils.aggregation import build_id_index
+
+QUESTION_COLUMNS = ["model", "id", "dataset", "question_index", "question_type", "answer", "AI_answer", "answered", "is_correct"]
+COUNT_COLUMNS = ["multiple_choice_acc_count", "multiple_choice_count", "judge_acc_count", "judge_count"]
+# low-cardinality columns are dictionary-encoded, grouping on them is then a pass over small ints
+QUESTION_DTYPES = {
+    "model": "category", "dataset": "category", "question_type": "category",
+    "answer": "category", "AI_answer": "category",
+    "question_index": np.int32, "answered": bool, "is_correct": bool,
+}
+
+
+def _as_text(value) -> Optional[str]:
+    return None if value is None else str(value)
+
+def build_question_table(
+    model_json: Dict[str, List[Dict]],
+    distribution: Dict[str, List[str]],
+    model_name: str,
+    sample_ids: Optional[Iterable[str]] = None,
+) -> pd.DataFrame:
+    """
+    Flatten a VQA prediction `results.json` into one row per question.
+
+    Args:
+        model_json: {sample id: [question with `question_type`, `answer` and `AI_answer`, ...]}.
+        distribution: distribution.json, the dataset of a sample is the first one listing it.
+        model_name: Value of the `model` column, so tables of several models can be concatenated.
+        sample_ids: Samples to include, in order. Defaults to all samples of `model_json`.
+
+    Returns:
+        pd.DataFrame: Columns QUESTION_COLUMNS. A question is `answered` if the model gave a
+            non-empty answer, only answered questions count towards the accuracies.
+    """
+    index = build_id_index(distribution)
+    datasets = list(distribution.keys())
+    columns = {name: [] for name in QUESTION_COLUMNS}
+    for key in (model_json.keys() if sample_ids is None else sample_ids):
+        code = index.get(key)
+        for i, item in enumerate(model_json[key]):
+            columns["id"].append(key)
+            columns["dataset"].append(None if code is None else datasets[code])
+            columns["question_index"].append(i)
+            columns["question_type"].append(item["question_type"])
+            columns["answer"].append(_as_text(item["answer"]))
+            columns["AI_answer"].append(_as_text(item["AI_answer"]))
+            columns["answered"].append(bool(item["AI_answer"]))
+            columns["is_correct"].append(item["answer"] == item["AI_answer"])
+    columns["model"] = [model_name] * len(columns["id"])
+    return pd.DataFrame(columns, columns=QUESTION_COLUMNS).astype(QUESTION_DTYPES)
+
+def merge_question_tables(previous: pd.DataFrame, updated: pd.DataFrame, sample_ids: Sequence[str], changed: Sequence[str]) -> pd.DataFrame:
+    """
+    Question table of `sample_ids` (in that order): the rows of `updated` for the `changed`
+    samples, the rows of `previous` for the others. Same result as rebuilding the table,
+    also for a changed sample that has no questions any more.
+    """
+    keep = previous[previous["id"].isin(set(sample_ids) - set(changed))]
+    # categoricals with different categories concatenate to object, QUESTION_DTYPES re-encodes them
+    table = pd.concat([keep, updated], ignore_index=True)
+    position = pd.Series(np.arange(len(sample_ids)), index=pd.Index(sample_ids))
+    order = np.lexsort((table["question_index"].to_numpy(dtype=np.int64), position.reindex(table["id"]).to_numpy()))
+    return table.iloc[order].reset_index(drop=True)[QUESTION_COLUMNS].astype(QUESTION_DTYPES)
+
+def load_question_tables(paths: Sequence[str]) -> pd.DataFrame:
+    """Concatenate the question tables of several runs (e.g. one per model) for cross-model slicing."""
+    return pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
+
+def _ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """numerator / denominator, 1.0 where the denominator is 0 (nothing to get wrong)."""
+    return np.divide(numerator, denominator, out=np.ones(len(numerator)), where=denominator > 0)
+
+def _group_codes(table: pd.DataFrame, by: Sequence[str]) -> Tuple[np.ndarray, pd.Index]:
+    """Group number (0..n-1) of every row of `table` and the index of the n groups that occur."""
+    codes, levels = [], []
+    for column in by:
+        values = table[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            code, uniques = values.array.codes, values.cat.categories
+        else:
+            code, uniques = pd.factorize(values)
+        # missing values (-1) are a level of their own
+        codes.append(np.where(code < 0, len(uniques), code).astype(np.intp))
+        levels.append(np.asarray([*uniques, None], dtype=object))
+    dims = [len(level) for level in levels]
+    group = np.ravel_multi_index(codes, dims) if len(codes) > 1 else codes[0]
+    if np.prod(dims, dtype=np.float64) > 4 * len(table) + 1024:
+        # sparse combination of many levels, number the groups that occur instead
+        present, group = np.unique(group, return_inverse=True)
+    else:
+        present = np.flatnonzero(np.bincount(group, minlength=int(np.prod(dims))))
+        compact = np.zeros(int(np.prod(dims)), dtype=np.intp)
+        compact[present] = np.arange(len(present))
+        group = compact[group]
+    positions = np.unravel_index(present, dims)
+    index = pd.MultiIndex.from_arrays([level[pos] for level, pos in zip(levels, positions)], names=list(by))
+    return group, index if len(by) > 1 else index.get_level_values(0)
+
+def question_accuracy(table: pd.DataFrame, by: Sequence[str]) -> pd.DataFrame:
+    """
+    Multiple-choice, true/false and total accuracy of the answered questions of `table`, grouped by `by`.
+
+    Every question falls into one of five outcomes (unanswered, judge wrong/correct, multiple
+    choice wrong/correct), so all counts come from a single bincount over (group, outcome).
+
+    Example:
+        >>> question_accuracy(table, ["dataset", "question_type"])
+        >>> question_accuracy(load_question_tables(paths), ["model", "dataset"])
+
+    Returns:
+        pd.DataFrame: One row per group with COUNT_COLUMNS and the `multiple_choice_acc`,
+            `judge_acc` and `total_acc` columns.
+    """
+    group, index = _group_codes(table, by)
+    multiple_choice = (table["question_type"] == "multiple_choice").to_numpy()
+    outcome = table["answered"].to_numpy() * (1 + 2 * multiple_choice.astype(np.intp) + table["is_correct"].to_numpy())
+    hist = np.bincount(group * 5 + outcome, minlength=len(index) * 5).reshape(-1, 5)
+
+    mc_acc_count, mc_count = hist[:, 4], hist[:, 3] + hist[:, 4]
+    judge_acc_count, judge_count = hist[:, 2], hist[:, 1] + hist[:, 2]
+    return pd.DataFrame({
+        "multiple_choice_acc_count": mc_acc_count,
+        "multiple_choice_count": mc_count,
+        "multiple_choice_acc": _ratio(mc_acc_count, mc_count),
+        "judge_acc_count": judge_acc_count,
+        "judge_count": judge_count,
+        "judge_acc": _ratio(judge_acc_count, judge_count),
+        "total_acc": _ratio(mc_acc_count + judge_acc_count, mc_count + judge_count),
+    }, index=index)
+
+def per_sample_accuracy(table: pd.DataFrame, sample_ids: Sequence[str]) -> Dict[str, Dict]:
+    """
+    Per-sample metrics of `per_sample.json`. Samples without answered questions get zero counts
+    and accuracies of 1.
+    """
+    counts = question_accuracy(table, ["id"])[COUNT_COLUMNS].reindex(sample_ids, fill_value=0)
+    per_sample = {}
+    for key, (mc_acc_count, mc_count, judge_acc_count, judge_count) in zip(sample_ids, counts.to_numpy().tolist()):
+        per_sample[key] = {
+            "multiple_choice_acc_count": mc_acc_count,
+            "multiple_choice_count": mc_count,
+            "multiple_choice_acc": mc_acc_count / mc_count if mc_count else 1,
+            "judge_acc_count": judge_acc_count,
+            "judge_count": judge_count,
+            "judge_acc": judge_acc_count / judge_count if judge_count else 1,
+            "total_acc": (mc_acc_count + judge_acc_count) / (mc_count + judge_count) if mc_count + judge_count > 0 else 1,
+        }
+    return per_sample
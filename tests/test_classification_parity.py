@@ -0,0 +1,344 @@
+"""
+Parity of the vectorized classification evaluator (multi_hot / sample_metrics / class_metrics)
+with the previous per-sample pandas/sklearn implementation, kept below as `legacy_evaluation`.
+Both write their metric files for the same predictions and the files must be identical: on the
+labels of data/classification.json with predictions perturbed from them, and on hand-written
+special cases.
+"""
+import os
+from argparse import Namespace
+from collections import defaultdict
+from decimal import Decimal
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.metrics import confusion_matrix, f1_score, precision_score, recall_score
+
+from src.tasks.classification.evaluator import (
+    CLASSIFICATION_CATEGORIES,
+    class_metrics,
+    compute_confusion_matrix,
+    compute_metrics,
+    multi_hot,
+    run_classification_evaluation,
+    sample_metrics,
+)
+from src.utils.file_io import load_classification_data, save_csv_data, save_json_data
+
+OUTPUT_FILES = ["per_sample.json", "results.csv", "classwise_metrics.csv", "overall_metrics.csv", "per_class_acc.csv", "results.json"]
+
+LABELS = {
+    "000000001": ["C1", "C3"],
+    "000000002": ["C2"],
+    "000000003": ["C5", "C12"],
+    "000000004": [],                 # empty label, empty prediction
+    "000000005": ["C18"],
+    "000000006": ["C7", "C20"],      # label outside C1-C18
+    "000000007": ["C4"],
+    "000000008": ["C9", "C10"],
+    "000000009": ["C11"],
+    "000000010": [],
+    "000000011": ["C6"],
+    "000000012": ["C13", "C14"],     # not predicted
+    "000000013": ["C15"],            # not in distribution.json
+}
+
+PREDICTIONS = {
+    "000000001": [{"id": "C1"}, {"id": "C3"}],
+    "000000002": [[{"id": "C2"}, {"id": "C8"}]],
+    "000000003": [{"1": "C5"}, {"id": "C16"}],
+    "000000004": [],
+    "000000005": ["no finding", None, {"id": "C18"}],
+    "000000006": [{"id": "C7"}],
+    "000000007": [{"id": "C4"}, {"id": "C21"}],                     # prediction outside C1-C18
+    "000000008": [{"category": "C9"}, {"id": "C10"}],               # malformed, string matched
+    "000000009": [[{"id": "C11"}, {"name": "C1 and C17"}]],         # malformed inside a list
+    "000000010": [{"id": "C2"}],
+    "000000011": [{"id": "C6"}],
+    "000000012": [],
+    "000000013": [{"id": "C15"}],
+    "000000099": [{"id": "C1"}],                                     # no label
+}
+
+DISTRIBUTION = {
+    "DS1": ["000000001", "000000002", "000000003", "000000004", "000000005"],
+    "DS2": ["000000006", "000000007", "000000008", "000000009"],
+    "DS3": ["000000010", "000000011", "000000012"],
+}
+
+
+def legacy_calculate_all_metrics(model_json: dict, distribution: dict, save_dir: str, args: Namespace):
+    model_summary = defaultdict(dict)
+    point = '0.000'
+
+    def init(summary):
+        for category in CLASSIFICATION_CATEGORIES:
+            summary[category] = 0
+            summary[f"{category}_cnt"] = 0
+            summary[f"Avg_{category}"] = 0
+        summary["total_C_cnt"] = 0
+
+    def add(summary, item):
+        for category in CLASSIFICATION_CATEGORIES:
+            if item[category] is None:
+                continue
+            summary[category] += item[category]
+            summary[f"{category}_cnt"] += 1
+            summary["total_C_cnt"] += 1
+            summary[f"Avg_{category}"] = summary[category] / summary[f"{category}_cnt"]
+        for name in ("P", "R", "F1", "Exact_Match"):
+            summary[f"total_{name}"] += item[name]
+        summary["count"] += 1
+        for name in ("P", "R", "F1", "Exact_Match"):
+            summary[f"Avg_{name}"] = summary[f"total_{name}"] / summary["count"]
+
+    def decimals(summary):
+        for name in ("P", "R", "F1", "Exact_Match"):
+            summary[f"Avg_{name}_decimal"] = float(Decimal(str(summary[f"Avg_{name}"])).quantize(Decimal(point), rounding="ROUND_HALF_UP"))
+
+    for key, item in model_json.items():
+        for dataset_name, ids in distribution.items():
+            if key in ids:
+                if not model_summary[dataset_name]:
+                    model_summary[dataset_name] = defaultdict(dict)
+                if not model_summary[dataset_name][args.model_name]:
+                    model_summary[dataset_name][args.model_name] = defaultdict(float)
+                    init(model_summary[dataset_name][args.model_name])
+                if not model_summary[args.model_name]:
+                    model_summary[args.model_name] = defaultdict(float)
+                    init(model_summary[args.model_name])
+                add(model_summary[dataset_name][args.model_name], item)
+                add(model_summary[args.model_name], item)
+                decimals(model_summary[dataset_name][args.model_name])
+                decimals(model_summary[args.model_name])
+                break
+
+    save_json_data(model_summary, save_dir, "results.json", title=f"{args.task} - {args.subtask} - {args.model_name}")
+
+def legacy_evaluation(args: Namespace, label_json: dict, model_json: dict, distribution_json: dict):
+    """The classification evaluation before vectorization: one pandas row per sample, sklearn metrics."""
+    cls_labels = set(CLASSIFICATION_CATEGORIES)
+    df_per_class_acc = pd.DataFrame(columns=["ID", "Label", "Prediction", *CLASSIFICATION_CATEGORIES])
+
+    per_sample = defaultdict(dict)
+    columns = ["ID"] + CLASSIFICATION_CATEGORIES
+    rows = []
+    for id_, labels in label_json.items():
+        row = {"ID": id_}
+        for label in CLASSIFICATION_CATEGORIES:
+            row[label] = 1 if label in labels else 0
+        rows.append(row)
+    gt = pd.DataFrame(rows, columns=columns)
+    rows = []
+
+    for key, value in label_json.items():
+        if key not in model_json:
+            continue
+
+        ids = set()
+        for item in model_json[key]:
+            try:
+                if not item or isinstance(item, str):
+                    continue
+                if isinstance(item, list):
+                    for tmp in item:
+                        if "id" in tmp:
+                            ids.add(tmp["id"])
+                        elif "1" in tmp:
+                            ids.add(tmp["1"])
+                        else:
+                            raise Exception("")
+                else:
+                    if "id" in item:
+                        ids.add(item["id"])
+                    elif "1" in item:
+                        ids.add(item["1"])
+                    else:
+                        raise Exception("")
+            except Exception:
+                s = str(model_json[key])
+                for l in cls_labels:
+                    if l in s:
+                        ids.add(l)
+                break
+        confusion = compute_confusion_matrix(value, list(ids))
+        row = {"ID": key}
+        for label in CLASSIFICATION_CATEGORIES:
+            row[label] = 1 if label in ids else 0
+        rows.append(row)
+
+        df_per_class_acc = pd.concat([
+            df_per_class_acc,
+            pd.DataFrame([{
+                "ID": str(key),
+                "Label": "#".join(value) if value else "None",
+                "Prediction": "#".join(list(ids)) if list(ids) else "None",
+                **{c: confusion[c] if confusion[c] is not None else 1 for c in CLASSIFICATION_CATEGORIES},
+            }])
+        ], ignore_index=True)
+
+        confusion.update(compute_metrics(confusion))
+        per_sample[key] = confusion
+
+    save_dir = os.path.join(args.project_root, "metric", args.subtask, "Exact_Match", args.model_name)
+    title = f"{args.task} - {args.subtask} - {args.model_name}"
+    save_json_data(per_sample, save_dir, "per_sample.json", title=title)
+
+    pred = pd.DataFrame(rows, columns=columns)
+    save_csv_data(pred, save_dir, "results.csv", title=title)
+    common_ids = set(gt["ID"]) & set(pred["ID"])
+    gt = gt[gt["ID"].isin(common_ids)].set_index("ID")
+    pred = pred[pred["ID"].isin(common_ids)].set_index("ID")
+    results = []
+    for c in CLASSIFICATION_CATEGORIES:
+        y_true = gt[c]
+        y_pred = pred[c]
+        tn, fp, fn, tp = confusion_matrix(y_true, y_pred, labels=[0, 1]).ravel()
+        results.append({
+            "Class": c,
+            "TP": tp,
+            "FP": fp,
+            "FN": fn,
+            "TN": tn,
+            "Precision": precision_score(y_true, y_pred, zero_division=0),
+            "Recall": recall_score(y_true, y_pred, zero_division=0),
+            "F1": f1_score(y_true, y_pred, zero_division=0),
+        })
+    df_result = pd.DataFrame(results)
+    y_true, y_pred = gt[CLASSIFICATION_CATEGORIES].values.flatten(), pred[CLASSIFICATION_CATEGORIES].values.flatten()
+    summary = pd.DataFrame({
+        "Metric": ["Macro", "Micro"],
+        "Precision": [df_result["Precision"].mean(), precision_score(y_true, y_pred, zero_division=0)],
+        "Recall": [df_result["Recall"].mean(), recall_score(y_true, y_pred, zero_division=0)],
+        "F1": [df_result["F1"].mean(), f1_score(y_true, y_pred, zero_division=0)],
+    })
+    save_csv_data(df_result, save_dir, "classwise_metrics.csv", title=title)
+    save_csv_data(summary, save_dir, "overall_metrics.csv", title=title)
+
+    df_per_class_acc = pd.concat([
+        df_per_class_acc,
+        pd.DataFrame([{
+            "ID": "Accuracy",
+            "Label": "Accuracy",
+            "Prediction": "Accuracy",
+            **{c: df_per_class_acc[c].mean() for c in CLASSIFICATION_CATEGORIES},
+        }])
+    ])
+    save_csv_data(df_per_class_acc, save_dir, "per_class_acc.csv", title=title)
+
+    legacy_calculate_all_metrics(per_sample, distribution_json, save_dir, args)
+
+
+def make_args(project_root: str) -> Namespace:
+    return Namespace(
+        project_root=project_root,
+        save_root_dir="data",
+        task="evaluation",
+        subtask="classification",
+        model_name="test-model",
+        incremental=False,
+    )
+
+def perturbed_predictions(label_json) -> dict:
+    """
+    Predictions derived from the labels, cycling through the output formats and errors the
+    evaluator handles; every 13th sample has no prediction.
+    """
+    predictions = {}
+    for i, (key, labels) in enumerate(label_json.items()):
+        labels = list(labels)
+        extra = CLASSIFICATION_CATEGORIES[(i * 7) % len(CLASSIFICATION_CATEGORIES)]
+        mode = i % 10
+        if i % 13 == 12:
+            continue
+        if mode == 0:
+            prediction = [{"id": label} for label in labels]
+        elif mode == 1:
+            prediction = [{"id": label} for label in labels[1:]]
+        elif mode == 2:
+            prediction = [{"id": label} for label in labels + [extra]]
+        elif mode == 3:
+            prediction = [[{"id": label} for label in labels]]
+        elif mode == 4:
+            prediction = [{"1": label} for label in labels[::-1]]
+        elif mode == 5:
+            prediction = [{"category": "#".join(labels + [extra])}]
+        elif mode == 6:
+            prediction = []
+        elif mode == 7:
+            prediction = [{"id": label} for label in labels] + [{"id": "C19"}]
+        elif mode == 8:
+            prediction = ["none", None, *({"id": label} for label in labels)]
+        else:
+            prediction = [{"id": extra}]
+        predictions[key] = prediction
+    return predictions
+
+def benchmark_case():
+    label_json = {key: list(labels) for key, labels in load_classification_data().items()}
+    # distribution.json is not shipped, split the samples over three datasets
+    keys = list(label_json)
+    distribution = {f"DS{d + 1}": keys[d::3] for d in range(3)}
+    return label_json, perturbed_predictions(label_json), distribution
+
+def evaluate_both(root, label_json: dict, predictions: dict, distribution: dict):
+    """Metric directories written by the current and by the legacy evaluation."""
+    args_new, args_old = make_args(str(root / "new")), make_args(str(root / "old"))
+    prediction_dir = os.path.join(args_new.project_root, args_new.save_root_dir, "prediction", args_new.subtask, args_new.model_name)
+    save_json_data(predictions, prediction_dir, "results.json")
+
+    run_classification_evaluation(args_new, label_json=label_json, distribution_json=distribution)
+    legacy_evaluation(args_old, label_json, predictions, distribution)
+    return [os.path.join(args.project_root, "metric", args.subtask, "Exact_Match", args.model_name) for args in (args_new, args_old)]
+
+@pytest.fixture(params=["benchmark", "special_cases"])
+def metric_dirs(request, tmp_path):
+    if request.param == "benchmark":
+        return evaluate_both(tmp_path, *benchmark_case())
+    return evaluate_both(tmp_path, LABELS, PREDICTIONS, DISTRIBUTION)
+
+@pytest.mark.parametrize("file_name", OUTPUT_FILES)
+def test_outputs_match_legacy_evaluation(metric_dirs, file_name):
+    new_dir, old_dir = metric_dirs
+    with open(os.path.join(old_dir, file_name), encoding="utf-8") as f:
+        expected = f.read()
+    with open(os.path.join(new_dir, file_name), encoding="utf-8") as f:
+        assert f.read() == expected
+
+def test_benchmark_case_covers_the_dataset():
+    label_json, predictions, _ = benchmark_case()
+    assert len(label_json) == len(load_classification_data()) > 0
+    assert 0 < len(predictions) < len(label_json)
+
+def test_metrics_match_sklearn():
+    rng = np.random.default_rng(0)
+    ref = (rng.random((200, len(CLASSIFICATION_CATEGORIES))) < 0.15).astype(np.uint8)
+    pred = (rng.random((200, len(CLASSIFICATION_CATEGORIES))) < 0.15).astype(np.uint8)
+    ref[:5] = pred[:5] = 0
+    df_result, summary = class_metrics(ref, pred)
+    for j, row in df_result.iterrows():
+        tn, fp, fn, tp = confusion_matrix(ref[:, j], pred[:, j], labels=[0, 1]).ravel()
+        assert (row["TP"], row["FP"], row["FN"], row["TN"]) == (tp, fp, fn, tn)
+        assert row["Precision"] == precision_score(ref[:, j], pred[:, j], zero_division=0)
+        assert row["Recall"] == recall_score(ref[:, j], pred[:, j], zero_division=0)
+        assert row["F1"] == pytest.approx(f1_score(ref[:, j], pred[:, j], zero_division=0), rel=1e-12)
+    micro = summary.set_index("Metric").loc["Micro"]
+    assert micro["Precision"] == precision_score(ref.flatten(), pred.flatten(), zero_division=0)
+    assert micro["Recall"] == recall_score(ref.flatten(), pred.flatten(), zero_division=0)
+
+    metrics = sample_metrics(ref, pred)
+    for i in range(len(ref)):
+        reference = [c for c, hit in zip(CLASSIFICATION_CATEGORIES, ref[i]) if hit]
+        prediction = [c for c, hit in zip(CLASSIFICATION_CATEGORIES, pred[i]) if hit]
+        confusion = compute_confusion_matrix(reference, prediction)
+        confusion.update(compute_metrics(confusion))
+        for name, values in metrics.items():
+            assert values[i] == confusion[name], (i, name)
+
+def test_multi_hot_ignores_unknown_labels():
+    hot = multi_hot([["C1", "C18"], [], ["C20", "C2"]])
+    assert hot.shape == (3, len(CLASSIFICATION_CATEGORIES))
+    assert hot[0].nonzero()[0].tolist() == [0, 17]
+    assert not hot[1].any()
+    assert hot[2].nonzero()[0].tolist() == [1]
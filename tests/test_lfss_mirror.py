@@ -0,0 +1,45 @@
+"""Listing of a shard of an LFSS meta dir by MetaMirror.list_remote, with a stub connector."""
+from types import SimpleNamespace
+
+import pytest
+
+from src.utils.lfss_mirror import MetaMirror
+
+
+class StubConnector:
+    """Flat, url-ordered listing of `meta/<id>/<name>` files; records the listed offsets."""
+
+    def __init__(self, n_ids: int):
+        self.urls = sorted(f"meta/{i:09d}/{name}" for i in range(1, n_ids + 1) for name in ("info.json", "label.json"))
+        self.offsets = []
+
+    def count_files(self, path: str, flat: bool = False) -> int:
+        return len(self.urls)
+
+    def list_files(self, path: str, offset: int = 0, limit: int = 1000, order_by: str = "", flat: bool = False):
+        self.offsets.append((offset, limit))
+        return [SimpleNamespace(url=url, file_id=url, create_time="t") for url in self.urls[offset:offset + limit]]
+
+@pytest.fixture
+def mirror(tmp_path):
+    return MetaMirror(str(tmp_path / "mirror.sqlite"))
+
+@pytest.mark.parametrize("start, end", [(1, 1), (1, 20), (500, 510), (995, 1200), (2000, 3000)])
+def test_list_remote_returns_the_files_of_the_range(mirror, start, end):
+    c = StubConnector(1000)
+
+    remote = mirror.list_remote(c, "meta", start, end, page_size=16)
+
+    expected = {(url.split("/")[1], url.split("/")[2]) for url in c.urls if start <= int(url.split("/")[1]) <= end}
+    assert set(remote) == expected
+
+def test_list_remote_starts_listing_at_the_first_id_of_the_shard(mirror):
+    c = StubConnector(1000)
+
+    mirror.list_remote(c, "meta", 500, 510, page_size=16)
+
+    pages = [offset for offset, limit in c.offsets if limit > 1]
+    assert pages[0] == c.urls.index("meta/000000500/info.json")
+    assert len(pages) <= 2
+    # binary search probes: about log2 of the number of files
+    assert len(c.offsets) - len(pages) <= 12
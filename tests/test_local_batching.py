@@ -0,0 +1,217 @@
+"""
+Batched local generation on CPU with a stub model, tokenizer and processor:
+BaichuanOmni1d5Model.generate_batch / _generate_padded and the MicroBatcher.
+"""
+import json
+import threading
+import time
+from argparse import Namespace
+from types import SimpleNamespace
+
+import pytest
+import torch
+from PIL import Image
+
+from src.models.load_model import load_model
+from src.models.local_model import BaichuanOmni1d5Model
+from src.models.micro_batcher import MicroBatcher, MicroBatchingModel
+from src.utils.response_cache import ResponseCache
+
+PAD_ID = 0
+END_TEXT = "<|endoftext|>"
+
+
+class StubTokenizer:
+    """One token per character; id 0 is padding and end of text."""
+    pad_token_id = PAD_ID
+    eos_token_id = PAD_ID
+
+    @staticmethod
+    def encode(text: str) -> list:
+        return [ord(ch) for ch in text]
+
+    @staticmethod
+    def decode(ids) -> str:
+        return "".join(END_TEXT if i == PAD_ID else chr(i) for i in ids.tolist())
+
+class StubModel:
+    """
+    `processor` tokenizes the message; `generate` answers every row with the JSON
+    reply of its prompt (see reply()), and records its inputs.
+    """
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.calls = []
+
+    def processor(self, messages: list):
+        ids = torch.tensor([StubTokenizer.encode(messages[0])])
+        return SimpleNamespace(input_ids=ids, attention_mask=torch.ones_like(ids), images=None, patch_nums=None, images_grid=None)
+
+    def generate(self, input_ids, attention_mask, **kwargs):
+        self.calls.append({"input_ids": input_ids, "attention_mask": attention_mask})
+        replies = []
+        for ids, mask in zip(input_ids, attention_mask):
+            prompt = StubTokenizer.decode(ids[mask.bool()])
+            replies.append(StubTokenizer.encode(self.reply(prompt)) + [PAD_ID])
+        width = max(map(len, replies))
+        new_tokens = torch.tensor([r + [PAD_ID] * (width - len(r)) for r in replies])
+        return SimpleNamespace(sequences=torch.cat([input_ids, new_tokens], dim=1))
+
+def echo_reply(message: str) -> str:
+    prompt = message.split("</img>", 1)[1].removesuffix("<C_A>")
+    return "not a list" if prompt.startswith("malformed") else json.dumps({"prompt": prompt})
+
+def make_model(reply=echo_reply, response_cache=None) -> BaichuanOmni1d5Model:
+    model = BaichuanOmni1d5Model.__new__(BaichuanOmni1d5Model)
+    model.role_prefix = {'user': '<C_Q>', 'assistant': '<C_A>'}
+    model.model_name = "stub"
+    model.do_sample = False
+    model.temperature = 0.0
+    model.max_new_tokens = 16
+    model.device = torch.device("cpu")
+    model.model = StubModel(reply)
+    model.tokenizer = StubTokenizer()
+    model.image_start_token, model.image_end_token = "<img>", "</img>"
+    model.response_cache = response_cache
+    return model
+
+@pytest.fixture
+def image_path(tmp_path):
+    path = tmp_path / "000000001.png"
+    Image.new("RGB", (4, 4)).save(path)
+    return str(path)
+
+
+def test_generate_padded_left_pads_and_slices_at_prompt_length(image_path):
+    model = make_model()
+    prompts = ["a", "a much longer prompt", "medium prompt"]
+    processed = [model.model.processor([model.build_message(image_path, p)]) for p in prompts]
+
+    texts = model._generate_padded(processed)
+
+    assert [json.loads(t) for t in texts] == [{"prompt": p} for p in prompts]
+    (call,) = model.model.calls
+    plen = max(p.input_ids.shape[1] for p in processed)
+    assert call["input_ids"].shape == call["attention_mask"].shape == (len(prompts), plen)
+    for row, (ids, mask) in enumerate(zip(call["input_ids"], call["attention_mask"])):
+        length = processed[row].input_ids.shape[1]
+        assert ids[:plen - length].eq(PAD_ID).all() and mask[:plen - length].eq(0).all()
+        assert ids[plen - length:].equal(processed[row].input_ids[0]) and mask[plen - length:].eq(1).all()
+
+def test_generate_batch_returns_per_item_errors_and_cache_hits(tmp_path, image_path):
+    cache = ResponseCache(str(tmp_path / "responses.sqlite"))
+    model = make_model(response_cache=cache)
+    cached_key = model.cache_key("cached", image_path, 0.0, dict)
+    model.cache_put(cached_key, json.dumps({"prompt": "from cache"}))
+
+    results = model.generate_batch([
+        (image_path, "first", dict),
+        (str(tmp_path / "missing.png"), "no image", dict),
+        (image_path, "cached", dict),
+        (image_path, "malformed", list),
+        (image_path, "second", dict),
+    ])
+
+    assert results[0] == {"prompt": "first"}
+    assert isinstance(results[1], FileNotFoundError)
+    assert results[2] == {"prompt": "from cache"}
+    assert isinstance(results[3], ValueError) and "Original Text: not a list" in str(results[3])
+    assert results[4] == {"prompt": "second"}
+    # one generate call for the three uncached requests, only parsed replies are cached
+    (call,) = model.model.calls
+    assert call["input_ids"].shape[0] == 3
+    assert cache.get(model.cache_key("first", image_path, 0.0, dict)) is not None
+    assert cache.get(model.cache_key("malformed", image_path, 0.0, list)) is None
+
+def test_generate_batch_reports_a_failed_generate_for_each_request(image_path):
+    def fail(prompt):
+        raise RuntimeError("out of memory")
+    model = make_model(reply=fail)
+
+    results = model.generate_batch([(image_path, "a", dict), (image_path, "b", dict)])
+
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+class RecordingBatchModel:
+    """generate_batch() stub: echoes the prompts, or fails the ones starting with "fail"."""
+    model_name = "recording"
+    response_cache = None
+    usage = None
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.batch_sizes = []
+
+    def generate_batch(self, requests):
+        self.batch_sizes.append(len(requests))
+        time.sleep(self.delay)
+        if any(prompt == "fail all" for _, prompt, _ in requests):
+            raise RuntimeError("batch failed")
+        return [ValueError(prompt) if prompt.startswith("fail") else {"prompt": prompt} for _, prompt, _ in requests]
+
+def test_micro_batcher_dispatches_full_batches_without_waiting():
+    model = RecordingBatchModel()
+    batcher = MicroBatcher(model, max_batch_size=4, max_wait_ms=10_000)
+
+    start = time.monotonic()
+    futures = [batcher.submit("img", str(i), dict) for i in range(8)]
+    results = [f.result(timeout=5) for f in futures]
+
+    assert time.monotonic() - start < 5
+    assert results == [{"prompt": str(i)} for i in range(8)]
+    assert model.batch_sizes == [4, 4]
+
+def test_micro_batcher_dispatches_a_partial_batch_after_max_wait():
+    model = RecordingBatchModel()
+    batcher = MicroBatcher(model, max_batch_size=8, max_wait_ms=50)
+
+    start = time.monotonic()
+    assert batcher.submit("img", "alone", dict).result(timeout=5) == {"prompt": "alone"}
+
+    assert 0.04 <= time.monotonic() - start < 5
+    assert model.batch_sizes == [1]
+    assert "requests: 1, batches: 1" in batcher.summary()
+
+def test_micro_batcher_routes_exceptions_to_their_futures():
+    model = RecordingBatchModel()
+    batcher = MicroBatcher(model, max_batch_size=3, max_wait_ms=10_000)
+
+    ok, failed, other = (batcher.submit("img", p, dict) for p in ("ok", "fail one", "other"))
+    assert ok.result(timeout=5) == {"prompt": "ok"}
+    with pytest.raises(ValueError, match="fail one"):
+        failed.result(timeout=5)
+    assert other.result(timeout=5) == {"prompt": "other"}
+
+    futures = [batcher.submit("img", p, dict) for p in ("a", "fail all", "b")]
+    for f in futures:
+        with pytest.raises(RuntimeError, match="batch failed"):
+            f.result(timeout=5)
+
+def test_micro_batching_model_pairs_results_with_producer_threads():
+    model = RecordingBatchModel(delay=0.01)
+    wrapped = MicroBatchingModel(model, max_batch_size=5, max_wait_ms=20)
+    results, errors = {}, []
+
+    def produce(i: int):
+        try:
+            results[i] = wrapped.generate_from_image_and_text("img", f"prompt {i}")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=produce, args=(i,)) for i in range(32)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=10)
+
+    assert not errors
+    assert results == {i: {"prompt": f"prompt {i}"} for i in range(32)}
+    assert sum(model.batch_sizes) == 32 and max(model.batch_sizes) <= 5
+    assert wrapped.model_name == "recording"
+
+def test_batched_baichuan_is_rejected_before_loading_the_checkpoint():
+    args = Namespace(task="prediction", client_type="local", served_model_name="baichuan-inc/Baichuan-Omni-1d5", local_batch_size=4)
+    with pytest.raises(ValueError, match="--local_batch_size"):
+        load_model(args, {"model_dir": "/nonexistent"})
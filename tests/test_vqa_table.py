@@ -0,0 +1,41 @@
+"""Incremental merge of VQA question tables against rebuilding them."""
+import pandas as pd
+
+from src.utils.vqa_table import build_question_table, merge_question_tables
+
+DISTRIBUTION = {"DS1": ["a", "b"], "DS2": ["c"]}
+
+
+def question(question_type: str, answer: str, ai_answer) -> dict:
+    return {"question_type": question_type, "answer": answer, "AI_answer": ai_answer}
+
+def test_merge_matches_rebuild_when_a_changed_sample_has_no_questions():
+    old = {
+        "a": [question("multiple_choice", "A", "A")],
+        "b": [question("true_false", "B", "A"), question("multiple_choice", "C", None)],
+        "c": [question("true_false", "A", "A")],
+    }
+    new = {
+        "a": [],
+        "b": [question("true_false", "B", "B")],
+        "c": old["c"],
+    }
+    sample_ids = ["a", "b", "c"]
+    changed = ["a", "b"]
+    previous = build_question_table(old, DISTRIBUTION, "m", sample_ids)
+    updated = build_question_table(new, DISTRIBUTION, "m", changed)
+
+    merged = merge_question_tables(previous, updated, sample_ids, changed)
+
+    assert "a" not in set(merged["id"])
+    pd.testing.assert_frame_equal(merged, build_question_table(new, DISTRIBUTION, "m", sample_ids))
+
+def test_merge_drops_samples_that_are_gone_and_keeps_order():
+    old = {key: [question("true_false", "A", "A")] for key in ("a", "b", "c")}
+    new = {"c": [question("true_false", "A", "B")], "a": old["a"]}
+    previous = build_question_table(old, DISTRIBUTION, "m", ["a", "b", "c"])
+    updated = build_question_table(new, DISTRIBUTION, "m", ["c"])
+
+    merged = merge_question_tables(previous, updated, ["c", "a"], ["c"])
+
+    pd.testing.assert_frame_equal(merged, build_question_table(new, DISTRIBUTION, "m", ["c", "a"]))